@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+"""
+Benchmarks for qr's data structures.
+
+Measures ops/sec and p50/p99 latency of push, pop, extend, pop_many,
+peek and len on every structure, across payload sizes, batch sizes,
+serializers and numbers of concurrent clients, CappedCollection's
+trimming modes, and packed mode. By default it spawns a
+throwaway redis-server on a free port, or with --fake runs against
+fakeredis. Results are written as JSON, so runs against different qr
+versions can be compared with --compare.
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json
+    python benchmark.py --compare before.json after.json
+    python benchmark.py --structures CappedCollection --operations push \
+        --trims exact every random window
+    python benchmark.py --structures Queue --packed 100
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import platform
+import threading
+import subprocess
+
+import redis
+import qr
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+STRUCTURES = ['Queue', 'Stack', 'Deque', 'PriorityQueue', 'CappedCollection',
+    'StreamQueue', 'BucketPriorityQueue']
+OPERATIONS = ['push', 'pop', 'extend', 'pop_many', 'peek', 'len']
+
+# Structures that can pack many elements into each list element
+PACKABLE = ['Queue', 'CappedCollection']
+
+# CappedCollection trimming modes, and the options each one sets
+TRIMS = {
+    'exact' : {},
+    'every' : {'trim': 'every'},
+    'random': {'trim': 'random'},
+    'window': {'window': 3600},
+}
+
+def unique(payload, index):
+    """
+    The payload, ending in the index instead, so that sorted sets don't
+    collapse equal members into one
+    """
+    suffix = str(index)
+    return payload[:max(0, len(payload) - len(suffix))] + suffix
+
+def push(q, payload, batch, index):
+    if isinstance(q, qr.BucketPriorityQueue):
+        q.push(unique(payload, index), index % q.levels)
+    elif isinstance(q, qr.PriorityQueue):
+        q.push(unique(payload, index), index)
+    elif isinstance(q, qr.Deque):
+        q.push_back(payload)
+    else:
+        q.push(payload)
+
+def pop(q, payload, batch, index):
+    if isinstance(q, qr.Deque):
+        q.pop_front()
+    else:
+        q.pop()
+
+def extend(q, payload, batch, index):
+    if isinstance(q, qr.BucketPriorityQueue):
+        q.extend((unique(payload, index + i), (index + i) % q.levels)
+            for i in range(batch))
+    elif isinstance(q, qr.PriorityQueue):
+        q.extend((unique(payload, index + i), index + i) for i in range(batch))
+    else:
+        q.extend([payload] * batch)
+
+def pop_many(q, payload, batch, index):
+    if isinstance(q, qr.Deque):
+        q.pop_many_front(batch)
+    else:
+        q.pop_many(batch)
+
+def peek(q, payload, batch, index):
+    q.peek()
+
+def length(q, payload, batch, index):
+    len(q)
+
+OPERATION_FUNCTIONS = {
+    'push'    : push,
+    'pop'     : pop,
+    'extend'  : extend,
+    'pop_many': pop_many,
+    'peek'    : peek,
+    'len'     : length,
+}
+
+# Operations that need elements to already be there, and how many each
+# call uses up
+CONSUMING = {'pop': 1, 'pop_many': None, 'peek': 0, 'len': 0}
+
+def percentile(values, fraction):
+    """The given percentile of a sorted list"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+def freePort():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class Server(object):
+    """Where the structures under test live"""
+    def __init__(self, args):
+        self.process = None
+        self.fake = None
+        self.kwargs = {}
+        if args.fake:
+            import fakeredis
+            self.fake = fakeredis.FakeServer()
+            self.description = 'fakeredis'
+        elif args.host:
+            self.kwargs = {'host': args.host, 'port': args.port}
+            self.description = 'redis://%s:%s' % (args.host, args.port)
+        else:
+            port = freePort()
+            self.process = subprocess.Popen([args.redis_server, '--port',
+                str(port), '--save', '', '--appendonly', 'no'],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            self.kwargs = {'host': '127.0.0.1', 'port': port}
+            self.description = 'spawned %s' % args.redis_server
+            self._wait()
+
+    def _wait(self):
+        client = redis.Redis(**self.kwargs)
+        for attempt in range(100):
+            try:
+                client.ping()
+                return
+            except redis.ConnectionError:
+                time.sleep(0.05)
+        raise RuntimeError('redis-server did not start')
+
+    def structure(self, name, key, **kwargs):
+        if name == 'CappedCollection':
+            kwargs['size'] = kwargs.pop('capacity')
+            kwargs.update(TRIMS[kwargs.pop('trim', 'exact')])
+        else:
+            kwargs.pop('capacity')
+        kwargs.update(self.kwargs)
+        q = getattr(qr, name)(key, **kwargs)
+        if self.fake is not None:
+            import fakeredis
+            q.redis = fakeredis.FakeRedis(server=self.fake)
+        return q
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+def run(server, structure, operation, payload_size, batch, serializer,
+    concurrency, iterations, key='qrbenchmark', **options):
+    """Run one benchmark, returning its result as a dictionary"""
+    payload = 'x' * payload_size
+    function = OPERATION_FUNCTIONS[operation]
+    uses = CONSUMING.get(operation)
+    if uses is None and operation in CONSUMING:
+        uses = batch
+    needed = (uses or 1) * iterations * concurrency
+    capacity = max(needed, 1000)
+    queues = [server.structure(structure, key, serializer=serializer,
+        capacity=capacity, **options) for i in range(concurrency)]
+    queues[0].clear()
+    if operation in CONSUMING:
+        filler = queues[0]
+        for start in range(0, needed, 1000):
+            extend(filler, payload, min(1000, needed - start), start)
+
+    latencies = [[] for i in range(concurrency)]
+    def client(index):
+        q, timings = queues[index], latencies[index]
+        for i in range(iterations):
+            start = clock()
+            function(q, payload, batch, index * iterations * batch + i * batch)
+            timings.append(clock() - start)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = clock()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = clock() - start
+    queues[0].clear()
+
+    timings = sorted(t for timing in latencies for t in timing)
+    calls = len(timings)
+    # Batched operations count every element they move
+    elements = calls * (operation in ('extend', 'pop_many') and batch or 1)
+    result = {
+        'structure'  : structure,
+        'operation'  : operation,
+        'payload'    : payload_size,
+        'batch'      : batch,
+        'serializer' : serializer,
+        'concurrency': concurrency,
+        'calls'      : calls,
+        'seconds'    : elapsed,
+        'ops_per_sec': elapsed and calls / elapsed or 0.0,
+        'elements_per_sec': elapsed and elements / elapsed or 0.0,
+        'p50_ms'     : percentile(timings, 0.50) * 1000,
+        'p99_ms'     : percentile(timings, 0.99) * 1000,
+    }
+    result.update(options)
+    return result
+
+def scenarios(args):
+    """Generate the keyword arguments for every benchmark to run"""
+    for structure in args.structures:
+        for operation in args.operations:
+            batches = operation in ('extend', 'pop_many') and args.batches or [1]
+            for payload_size in args.payloads:
+                for batch in batches:
+                    for serializer in args.serializers:
+                        for concurrency in args.concurrency:
+                            scenario = {
+                                'structure'   : structure,
+                                'operation'   : operation,
+                                'payload_size': payload_size,
+                                'batch'       : batch,
+                                'serializer'  : serializer,
+                                'concurrency' : concurrency,
+                            }
+                            if args.packed and structure in PACKABLE:
+                                scenario['packed'] = args.packed
+                            if structure != 'CappedCollection':
+                                yield scenario
+                                continue
+                            for trim in args.trims:
+                                # A packed collection can't have a window
+                                if trim == 'window' and 'packed' in scenario:
+                                    continue
+                                yield dict(scenario, trim=trim)
+
+def compare(before, after):
+    """Print the change in throughput between two result files"""
+    def load(fname):
+        with open(fname) as f:
+            document = json.load(f)
+        results = {}
+        for result in document['results']:
+            fields = dict((k, v) for k, v in result.items() if k not in (
+                'calls', 'seconds', 'ops_per_sec', 'elements_per_sec',
+                'p50_ms', 'p99_ms'))
+            results[json.dumps(fields, sort_keys=True)] = result
+        return document['qr_version'], results
+    old_version, old = load(before)
+    new_version, new = load(after)
+    print('%-70s %12s %12s %8s' % ('benchmark', old_version, new_version, 'change'))
+    for key in sorted(set(old) & set(new)):
+        a, b = old[key]['ops_per_sec'], new[key]['ops_per_sec']
+        fields = json.loads(key)
+        name = '%(structure)s.%(operation)s payload=%(payload)s batch=%(batch)s ' \
+            '%(serializer)s x%(concurrency)s' % fields
+        if 'trim' in fields:
+            name += ' trim=%(trim)s' % fields
+        if 'packed' in fields:
+            name += ' packed=%(packed)s' % fields
+        print('%-70s %12.0f %12.0f %+7.1f%%' % (name, a, b, a and (b - a) * 100.0 / a or 0))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--structures', nargs='+', default=STRUCTURES, choices=STRUCTURES)
+    parser.add_argument('--operations', nargs='+', default=OPERATIONS, choices=OPERATIONS)
+    parser.add_argument('--payloads', nargs='+', type=int, default=[16, 1024])
+    parser.add_argument('--batches', nargs='+', type=int, default=[10, 100])
+    parser.add_argument('--serializers', nargs='+', default=['pickle'],
+        choices=sorted(qr.serializers))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4])
+    parser.add_argument('--trims', nargs='+', default=['exact'], choices=sorted(TRIMS),
+        help='trimming modes to run CappedCollection benchmarks with')
+    parser.add_argument('--packed', type=int,
+        help='elements per chunk for packed Queue and CappedCollection benchmarks')
+    parser.add_argument('--iterations', type=int, default=1000,
+        help='calls per client in each benchmark')
+    parser.add_argument('--fake', action='store_true', help='run against fakeredis')
+    parser.add_argument('--host', help='use an already running Redis server')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--redis-server', default='redis-server',
+        help='the redis-server binary to spawn')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+        help='compare two result files instead of running')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    server = Server(args)
+    results = []
+    try:
+        for scenario in scenarios(args):
+            result = run(server, iterations=args.iterations, **scenario)
+            results.append(result)
+            sys.stderr.write('%(structure)s.%(operation)s payload=%(payload)s '
+                'batch=%(batch)s %(serializer)s x%(concurrency)s%(trimmed)s%(packing)s: '
+                '%(ops_per_sec).0f ops/s, p50 %(p50_ms).3fms, '
+                'p99 %(p99_ms).3fms\n' % dict(result,
+                trimmed='trim' in result and ' trim=%s' % result['trim'] or '',
+                packing='packed' in result and ' packed=%s' % result['packed'] or ''))
+    finally:
+        server.close()
+
+    document = json.dumps({
+        'qr_version'   : qr.__version__,
+        'redis_py'     : redis.__version__,
+        'python'       : platform.python_version(),
+        'server'       : server.description,
+        'iterations'   : args.iterations,
+        'results'      : results,
+    }, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(document)
+    else:
+        print(document)
+
+if __name__ == '__main__':
+    main()
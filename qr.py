@@ -6,8 +6,24 @@ __author__ = 'Ted Nyman'
 __version__ = '0.6.0'
 __license__ = 'MIT'
 
+import os
+import mmap
+import gzip
+import atexit
+import zlib
+import hashlib
+import base64
+import struct
 import redis
+import random
+import time
+import signal
+import socket
+import marshal
+import functools
 import logging
+import threading
+import multiprocessing
 
 try:
     import json
@@ -22,6 +38,17 @@ try:
 except ImportError:
     import pickle
 
+# Optional codecs, used when they're installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
 class NullHandler(logging.Handler):
     """A logging handler that discards all logging records"""
     def emit(self, record):
@@ -31,10 +58,238 @@ class NullHandler(logging.Handler):
 log = logging.getLogger('qr')
 log.addHandler(NullHandler())
 
+class PickleSerializer(object):
+    """Pickles values, using the highest protocol available by default"""
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, val):
+        return pickle.dumps(val, self.protocol)
+
+    def loads(self, val):
+        return pickle.loads(val)
+
+class JSONSerializer(object):
+    """Serializes values as compact JSON"""
+    def dumps(self, val):
+        return json.dumps(val, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, val):
+        return json.loads(val.decode('utf-8'))
+
+class MarshalSerializer(object):
+    """Serializes core Python types with marshal"""
+    def dumps(self, val):
+        return marshal.dumps(val)
+
+    def loads(self, val):
+        return marshal.loads(val)
+
+class MsgpackSerializer(object):
+    """Serializes values with msgpack, if it's installed"""
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('msgpack is not installed')
+
+    def dumps(self, val):
+        return msgpack.packb(val, use_bin_type=True)
+
+    def loads(self, val):
+        return msgpack.unpackb(val, raw=False)
+
+class CompressedSerializer(object):
+    """
+    Wraps another serializer, compressing any payload of at least
+    threshold bytes with zlib or lz4 (lz4 when it's installed). Every
+    payload starts with a header byte saying how the rest of it is
+    encoded, so compressed and uncompressed payloads decode correctly
+    side by side. Payloads with any other first byte were written without
+    compression turned on, and are passed to the serializer as they are.
+    """
+    PLAIN = b'\x00'
+    ZLIB = b'\x01'
+    LZ4 = b'\x02'
+
+    def __init__(self, serializer, threshold=1024, method=None):
+        if method is None:
+            method = lz4 and 'lz4' or 'zlib'
+        if method == 'lz4' and lz4 is None:
+            raise ImportError('lz4 is not installed')
+        if method not in ('zlib', 'lz4'):
+            raise ValueError('Unknown compression method %r' % method)
+        self.serializer = serializer
+        self.threshold = threshold
+        self.method = method
+
+    def dumps(self, val):
+        data = self.serializer.dumps(val)
+        if len(data) >= self.threshold:
+            if self.method == 'lz4':
+                compressed = self.LZ4 + lz4.compress(data)
+            else:
+                compressed = self.ZLIB + zlib.compress(data)
+            # Incompressible payloads are better off left alone
+            if len(compressed) <= len(data):
+                return compressed
+        return self.PLAIN + data
+
+    def loads(self, val):
+        header, data = val[:1], val[1:]
+        if header == self.ZLIB:
+            data = zlib.decompress(data)
+        elif header == self.LZ4:
+            if lz4 is None:
+                raise ImportError('lz4 is not installed')
+            data = lz4.decompress(data)
+        elif header != self.PLAIN:
+            data = val
+        return self.serializer.loads(data)
+
+# The serializers that can be asked for by name
+serializers = {
+    'pickle' : PickleSerializer,
+    'json'   : JSONSerializer,
+    'marshal': MarshalSerializer,
+    'msgpack': MsgpackSerializer,
+}
+
+def getSerializer(serializer=None, compress=None):
+    """
+    Build the serializer for a structure. The serializer may be given by
+    name (see `serializers`) or as any object with dumps and loads methods,
+    and defaults to pickle. Passing compress (True, or a size in bytes)
+    compresses payloads above that size.
+    """
+    if serializer is None:
+        serializer = PickleSerializer()
+    elif not hasattr(serializer, 'dumps'):
+        try:
+            serializer = serializers[serializer]()
+        except KeyError:
+            raise ValueError('Unknown serializer %r' % serializer)
+    if compress:
+        if compress is True:
+            return CompressedSerializer(serializer)
+        return CompressedSerializer(serializer, threshold=compress)
+    return serializer
+
 # A dictionary of connection pools, based on the parameters used
 # when connecting. This is so we don't have an unwieldy number of
-# connections
+# connections. Pools made before a fork are forgotten by the child, and
+# the lock guards against two threads making the same pool.
 connectionPools = {}
+poolsLock = threading.Lock()
+poolsPid = os.getpid()
+
+# What the reference to an offloaded payload starts with. No serializer's
+# output starts with these bytes.
+refMarker = b'\xffqr:'
+
+# Lua scripts, keyed on their source. Registering only computes the
+# script's SHA; the script itself is loaded into Redis on first use.
+luaScripts = {}
+
+def native(value):
+    """Return a key or status reply from Redis as a native string"""
+    if isinstance(value, str):
+        return value
+    return value.decode('utf-8')
+
+def lastReply(replies):
+    """The reply to the last command an operation queued in a batch"""
+    return replies[-1]
+
+def headReply(replies):
+    """The first element in the reply to the last command queued in a batch"""
+    reply = replies[-1]
+    if not reply:
+        return None
+    if isinstance(reply[0], (tuple, list)):
+        # (member, score) pairs
+        return reply[0][0]
+    return reply[0]
+
+def getScript(r, source):
+    """Return a registered Lua script for the given source"""
+    try:
+        return luaScripts[source]
+    except KeyError:
+        script = luaScripts[source] = r.register_script(source)
+        return script
+
+class PoolStats(object):
+    """
+    Mixed into redis-py's connection pools to count the connections they
+    make and hand out, and how often callers had to wait for one.
+    """
+    def __init__(self, *args, **kwargs):
+        self.statsLock = threading.Lock()
+        self.since = time.time()
+        self.created = self.checkouts = self.waits = self.in_use = 0
+        self.wait_seconds = 0.0
+        super(PoolStats, self).__init__(*args, **kwargs)
+
+    def _waiting(self):
+        """Whether a caller would have to wait for a connection"""
+        return False
+
+    def reset(self):
+        super(PoolStats, self).reset()
+        self.in_use = 0
+
+    def make_connection(self):
+        connection = super(PoolStats, self).make_connection()
+        with self.statsLock:
+            self.created += 1
+        return connection
+
+    def get_connection(self, *args, **kwargs):
+        waiting, start = self._waiting(), clock()
+        try:
+            connection = super(PoolStats, self).get_connection(*args, **kwargs)
+        finally:
+            if waiting:
+                with self.statsLock:
+                    self.waits += 1
+                    self.wait_seconds += clock() - start
+        with self.statsLock:
+            self.checkouts += 1
+            self.in_use += 1
+        return connection
+
+    def release(self, connection):
+        super(PoolStats, self).release(connection)
+        with self.statsLock:
+            self.in_use -= 1
+
+    def stats(self):
+        """Return the pool's counters, and how fast it's making connections"""
+        elapsed = max(time.time() - self.since, 1e-6)
+        return {
+            'pool'           : repr(self),
+            'max_connections': self.max_connections,
+            'in_use'         : self.in_use,
+            'created'        : self.created,
+            'created_per_sec': self.created / elapsed,
+            'checkouts'      : self.checkouts,
+            'waits'          : self.waits,
+            'wait_seconds'   : self.wait_seconds,
+        }
+
+class ConnectionPool(PoolStats, redis.ConnectionPool):
+    """A connection pool that keeps count of its connections"""
+
+class BlockingConnectionPool(PoolStats, redis.BlockingConnectionPool):
+    """
+    A connection pool that, once it has max_connections out, waits for one
+    to be released rather than failing
+    """
+    def _waiting(self):
+        return self.pool.empty()
+
+def poolKey(kwargs):
+    """The canonical registry key for a set of connection options"""
+    return repr(sorted(kwargs.items()))
 
 def getRedis(**kwargs):
     """
@@ -42,15 +297,258 @@ def getRedis(**kwargs):
     In cases where you may want a lot of queues, the redis library will
     by default open at least one connection for each. This uses redis'
     connection pool mechanism to keep the number of open file descriptors
-    tractable.
+    tractable. Pass max_connections to bound the pool, and with
+    blocking_pool=True callers wait up to pool_timeout seconds for a
+    connection to free up rather than failing.
     """
-    key = ':'.join((repr(key) + '=>' + repr(value)) for key, value in kwargs.items())
-    try:
-        return redis.Redis(connection_pool=connectionPools[key])
-    except KeyError:
-        cp = redis.ConnectionPool(**kwargs)
-        connectionPools[key] = cp
-        return redis.Redis(connection_pool=cp)
+    if poolsPid != os.getpid():
+        resetPools()
+    key = poolKey(kwargs)
+    with poolsLock:
+        try:
+            cp = connectionPools[key]
+        except KeyError:
+            options = dict(kwargs)
+            if options.pop('blocking_pool', False):
+                options['timeout'] = options.pop('pool_timeout', 20)
+                cp = BlockingConnectionPool(**options)
+            else:
+                options.pop('pool_timeout', None)
+                cp = ConnectionPool(**options)
+            connectionPools[key] = cp
+    return redis.Redis(connection_pool=cp)
+
+def poolStats():
+    """Return the stats of every connection pool in this process"""
+    with poolsLock:
+        return [cp.stats() for cp in connectionPools.values()]
+
+def resetPools():
+    """
+    Forget every connection pool without closing its connections. This
+    happens by itself in a forked child, whose inherited connections
+    belong to the parent.
+    """
+    global connectionPools, poolsLock, poolsPid
+    connectionPools, poolsLock, poolsPid = {}, threading.Lock(), os.getpid()
+
+def closePools():
+    """Disconnect every connection pool and forget them"""
+    with poolsLock:
+        pools = list(connectionPools.values())
+        connectionPools.clear()
+    for cp in pools:
+        cp.disconnect()
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+# Instrumentation hooks. While this is empty, instrumented operations
+# cost one extra check, and nothing is timed or formatted.
+hooks = []
+
+def instrument(hook):
+    """
+    Install an instrumentation hook: an object with the methods of
+    Instrument, called for every operation on every structure.
+    """
+    hooks.append(hook)
+    return hook
+
+def uninstrument(hook):
+    """Remove an instrumentation hook"""
+    hooks.remove(hook)
+
+def emit(method, *args):
+    """Pass an event to every hook, never letting one break an operation"""
+    for hook in list(hooks):
+        try:
+            getattr(hook, method)(*args)
+        except Exception:
+            log.exception('Instrumentation hook %r failed', hook)
+
+def instrumented(f):
+    """Report the latency and outcome of a structure's method to the hooks"""
+    name = f.__name__
+    @functools.wraps(f)
+    def wrapped(self, *args, **kwargs):
+        if not hooks:
+            return f(self, *args, **kwargs)
+        start = clock()
+        try:
+            result = f(self, *args, **kwargs)
+        except Exception:
+            emit('operation', type(self).__name__, self.key, name,
+                clock() - start, True)
+            raise
+        emit('operation', type(self).__name__, self.key, name,
+            clock() - start, False)
+        return result
+    return wrapped
+
+class Instrument(object):
+    """
+    The interface of an instrumentation hook. Subclasses override the
+    events they're interested in.
+    """
+    def operation(self, structure, key, name, seconds, error):
+        """A method named name was called on a structure"""
+        pass
+
+    def serialized(self, structure, key, direction, size, seconds):
+        """A payload of size bytes was packed or unpacked (direction)"""
+        pass
+
+class Histogram(object):
+    """Counts of observations falling into cumulative buckets"""
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return (upper bound, count) pairs, ending with infinity"""
+        total, results = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            results.append((bound, total))
+        return results
+
+class Metrics(Instrument):
+    """
+    Collects operation counts, errors and latencies, and payload sizes and
+    serialization times, per structure and key. snapshot() returns them as
+    plain data, and prometheus() in the Prometheus text format, ready to
+    be served from a /metrics endpoint.
+    """
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576,
+        4194304, 16777216)
+
+    def __init__(self, latency_buckets=LATENCY_BUCKETS, size_buckets=SIZE_BUCKETS):
+        self.latency_buckets = latency_buckets
+        self.size_buckets = size_buckets
+        self._lock = threading.Lock()
+        self.operations = {}
+        self.payloads = {}
+
+    def operation(self, structure, key, name, seconds, error):
+        with self._lock:
+            try:
+                stats = self.operations[(structure, key, name)]
+            except KeyError:
+                stats = self.operations[(structure, key, name)] = {
+                    'errors' : 0,
+                    'latency': Histogram(self.latency_buckets),
+                }
+            stats['latency'].observe(seconds)
+            if error:
+                stats['errors'] += 1
+
+    def serialized(self, structure, key, direction, size, seconds):
+        with self._lock:
+            try:
+                stats = self.payloads[(structure, key, direction)]
+            except KeyError:
+                stats = self.payloads[(structure, key, direction)] = {
+                    'size'   : Histogram(self.size_buckets),
+                    'latency': Histogram(self.latency_buckets),
+                }
+            stats['size'].observe(size)
+            stats['latency'].observe(seconds)
+
+    def snapshot(self):
+        """Return the counters collected so far"""
+        with self._lock:
+            return {
+                'operations': dict((k, {
+                    'count'  : v['latency'].count,
+                    'errors' : v['errors'],
+                    'seconds': v['latency'].sum,
+                }) for k, v in self.operations.items()),
+                'payloads': dict((k, {
+                    'count'  : v['size'].count,
+                    'bytes'  : v['size'].sum,
+                    'seconds': v['latency'].sum,
+                }) for k, v in self.payloads.items()),
+            }
+
+    def prometheus(self, prefix='qr'):
+        """Render the metrics in the Prometheus text exposition format"""
+        lines = []
+        def histogram(name, labels, h):
+            for bound, count in h.cumulative():
+                le = bound == float('inf') and '+Inf' or repr(float(bound))
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, le, count))
+            lines.append('%s_sum{%s} %r' % (name, labels, float(h.sum)))
+            lines.append('%s_count{%s} %d' % (name, labels, h.count))
+        with self._lock:
+            lines.append('# TYPE %s_operation_seconds histogram' % prefix)
+            for (structure, key, name), stats in sorted(self.operations.items()):
+                labels = 'structure="%s",key="%s",operation="%s"' % (
+                    structure, key, name)
+                histogram('%s_operation_seconds' % prefix, labels, stats['latency'])
+            lines.append('# TYPE %s_operation_errors_total counter' % prefix)
+            for (structure, key, name), stats in sorted(self.operations.items()):
+                lines.append('%s_operation_errors_total{structure="%s",key="%s",'
+                    'operation="%s"} %d' % (prefix, structure, key, name, stats['errors']))
+            for metric, field in (('payload_bytes', 'size'),
+                ('serialization_seconds', 'latency')):
+                lines.append('# TYPE %s_%s histogram' % (prefix, metric))
+                for (structure, key, direction), stats in sorted(self.payloads.items()):
+                    labels = 'structure="%s",key="%s",direction="%s"' % (
+                        structure, key, direction)
+                    histogram('%s_%s' % (prefix, metric), labels, stats[field])
+        return '\n'.join(lines) + '\n'
+
+class StatsD(Instrument):
+    """
+    Sends timings and counts to a StatsD server over UDP, as
+    prefix.structure.operation (or prefix.structure.key.operation, with
+    perkey=True, for a bounded set of keys).
+    """
+    def __init__(self, host='localhost', port=8125, prefix='qr', perkey=False):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.perkey = perkey
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, structure, key, name):
+        if self.perkey:
+            return '%s.%s.%s.%s' % (self.prefix, structure, key.replace('.', '_'), name)
+        return '%s.%s.%s' % (self.prefix, structure, name)
+
+    def _send(self, *lines):
+        try:
+            self.socket.sendto('\n'.join(lines).encode('utf-8'), self.address)
+        except socket.error:
+            pass
+
+    def operation(self, structure, key, name, seconds, error):
+        metric = self._name(structure, key, name)
+        if error:
+            self._send('%s:%.3f|ms' % (metric, seconds * 1000), '%s.errors:1|c' % metric)
+        else:
+            self._send('%s:%.3f|ms' % (metric, seconds * 1000))
+
+    def serialized(self, structure, key, direction, size, seconds):
+        metric = self._name(structure, key, direction)
+        self._send('%s.bytes:%d|h' % (metric, size),
+            '%s.time:%.3f|ms' % (metric, seconds * 1000))
 
 class worker(object):
     def __init__(self, q, err=None, *args, **kwargs):
@@ -74,213 +572,2235 @@ class worker(object):
                         # Failing that, let's call the user's
                         # err-back, which we should keep from
                         # ever throwing an exception
-                        self.err(e, *args, **kwargs)
+                        self.err(e, *self.args, **self.kwargs)
                     except:
                         pass
         return wrapped
+
+class workers(object):
+    """
+    Like worker, but runs the callback on a pool of threads (or processes,
+    with processes=True). Each one pops up to prefetch messages per round
+    trip with pop_many, waiting at most timeout seconds for them, so
+    it notices promptly when it's asked to stop. On SIGTERM or SIGINT,
+    or a call to stop(), the pool stops popping, finishes the messages it
+    already holds and returns. stats() reports each worker's throughput.
+    """
+    def __init__(self, q, err=None, concurrency=4, processes=False,
+        prefetch=1, timeout=1, args=(), kwargs=None):
+        self.q = q
+        self.err = err
+        self.concurrency = concurrency
+        self.processes = processes
+        self.prefetch = prefetch
+        self.timeout = timeout
+        self.args = args
+        self.kwargs = kwargs or {}
+        if processes:
+            self._stopping = multiprocessing.Event()
+        else:
+            self._stopping = threading.Event()
+        # Messages processed, messages failed and seconds spent in the
+        # callback, for each worker. Every worker only writes its own
+        # slots, so there's no need for a lock.
+        self._counters = multiprocessing.Array('d', 3 * concurrency, lock=False)
+        self._started = None
+
+    def _handle(self, signum, frame):
+        log.info('Received signal %s, draining workers', signum)
+        self._stopping.set()
+
+    def _trap(self):
+        """Drain on SIGTERM and SIGINT, returning the old handlers"""
+        handlers = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                handlers[signum] = signal.signal(signum, self._handle)
+            except ValueError:
+                # Signals can only be trapped from the main thread
+                pass
+        return handlers
+
+    def _loop(self, index, f):
+        if self.processes:
+            self._trap()
+        counters, offset = self._counters, 3 * index
+        while not self._stopping.is_set():
+            batch = self.q.pop_many(self.prefetch, block=True, timeout=self.timeout)
+            # Whatever has been popped gets processed, even when stopping
+            for message in batch:
+                start = time.time()
+                try:
+                    f(message, *self.args, **self.kwargs)
+                    counters[offset] += 1
+                except Exception as e:
+                    counters[offset + 1] += 1
+                    if self.err is not None:
+                        try:
+                            self.err(e, *self.args, **self.kwargs)
+                        except:
+                            pass
+                counters[offset + 2] += time.time() - start
+
+    def stop(self):
+        """Ask the workers to finish what they hold and exit"""
+        self._stopping.set()
+
+    def stats(self):
+        """Return the throughput of each worker"""
+        elapsed = self._started and time.time() - self._started or 0
+        results = []
+        for index in range(self.concurrency):
+            processed, failed, busy = self._counters[3 * index:3 * index + 3]
+            results.append({
+                'processed': int(processed),
+                'failed'   : int(failed),
+                'busy'     : busy,
+                'rate'     : elapsed and (processed + failed) / elapsed or 0.0,
+            })
+        return results
+
+    def __call__(self, f):
+        def wrapped():
+            self._stopping.clear()
+            self._started = time.time()
+            if self.processes:
+                spawn = multiprocessing.Process
+            else:
+                spawn = threading.Thread
+            pool = [spawn(target=self._loop, args=(index, f))
+                for index in range(self.concurrency)]
+            handlers = self._trap()
+            try:
+                for member in pool:
+                    member.start()
+                for member in pool:
+                    # Join with a timeout, so the main thread still gets
+                    # to handle signals
+                    while member.is_alive():
+                        member.join(0.5)
+            finally:
+                for signum, handler in handlers.items():
+                    signal.signal(signum, handler)
+        wrapped.stop = self.stop
+        wrapped.stats = self.stats
+        return wrapped
         
+# Keyword arguments that configure a structure rather than its connection
+structureOptions = ('serializer', 'compress', 'size', 'consumer', 'timeout',
+    'target', 'group', 'maxlen', 'approximate', 'autoack', 'trim', 'every',
+    'window', 'offload', 'offload_ttl', 'spool', 'levels', 'overflow',
+    'overflow_timeout', 'packed')
+
+class Full(Exception):
+    """Raised when pushing onto a bounded structure that has no room"""
+
 class BaseQueue(object):
     """Base functionality common to queues"""
+
+    # The Redis type of the key a structure lives in, and the command that
+    # gives its length
+    redis_type = 'list'
+    length_command = 'LLEN'
+
     @staticmethod
     def all(t, pattern, **kwargs):
-        r = getRedis(**kwargs)
-        return [t(k, **kwargs) for k in r.keys(pattern)]
+        return list(BaseQueue.scan(t, pattern, **kwargs))
+
+    @staticmethod
+    def scan(t, pattern='*', count=1000, withsizes=False, **kwargs):
+        """
+        Lazily generate a structure of type t for every key matching
+        pattern that holds the right Redis type, as (structure, length)
+        pairs if withsizes. Keys are found with SCAN, count at a time, so
+        the server is never blocked the way KEYS blocks it. The types (and
+        lengths) of each page of keys are fetched in one round trip.
+        """
+        r = getRedis(**dict((k, v) for k, v in kwargs.items()
+            if k not in structureOptions))
+        cursor = 0
+        while True:
+            cursor, keys = r.scan(cursor, match=pattern, count=count)
+            if keys:
+                with r.pipeline(transaction=False) as pipe:
+                    for key in keys:
+                        pipe.type(key)
+                    types = pipe.execute()
+                keys = [native(key) for key, kind in zip(keys, types)
+                    if native(kind) == t.redis_type]
+            if keys and withsizes:
+                with r.pipeline(transaction=False) as pipe:
+                    for key in keys:
+                        pipe.execute_command(t.length_command, key)
+                    sizes = pipe.execute()
+                for key, size in zip(keys, sizes):
+                    yield (t(key, **kwargs), size)
+            else:
+                for key in keys:
+                    yield t(key, **kwargs)
+            if int(cursor) == 0:
+                break
     
-    def __init__(self, key, **kwargs):
-        self.serializer = pickle
+    # Payloads bigger than this many bytes are stored outside the structure
+    offload = None
+
+    # Whether popping an element is the end of it, and of its offloaded
+    # payload
+    consuming = True
+
+    # Whether a structure can be given a maxlen, what it can do when a
+    # push finds it full, and how often a blocked push looks for room
+    boundable = False
+    overflows = ('refuse', 'block', 'drop')
+    overflow_poll = 0.05
+
+    # Whether a structure can pack many elements into each list element
+    packable = False
+
+    def __init__(self, key, serializer=None, compress=None, offload=None,
+        offload_ttl=None, spool=None, maxlen=None, overflow='refuse',
+        overflow_timeout=None, packed=None, **kwargs):
+        if maxlen is not None and not self.boundable:
+            raise TypeError("%s can't be given a maxlen" % type(self).__name__)
+        if maxlen is not None and maxlen < 1:
+            raise ValueError('A maxlen must be at least 1')
+        if overflow not in self.overflows:
+            raise ValueError('Unknown overflow policy %r' % overflow)
+        if spool is not None and offload_ttl is not None:
+            # Expiring the key would leave the spooled file behind for good
+            raise ValueError("Spooled payloads can't be given an offload_ttl")
+        if packed is not None:
+            if not self.packable:
+                raise TypeError("%s can't be packed" % type(self).__name__)
+            if packed < 1:
+                raise ValueError('Packed chunks must hold at least 1 element')
+            if offload is not None or maxlen is not None:
+                raise ValueError("A packed structure can't offload or be bounded")
+            # Chunks can't move between structures as elements
+            self.move_out = self.move_in = None
+        self.serializer = getSerializer(serializer, compress)
         self.redis = getRedis(**kwargs)
         self.key = key
+        self.offload = offload
+        self.offload_ttl = offload_ttl
+        self.spool = spool
+        self.maxlen = maxlen
+        self.overflow = overflow
+        self.overflow_timeout = overflow_timeout
+        self.packed = packed
+        self.counter = '%s:count' % key
     
+    @instrumented
     def __len__(self):
         """Return the length of the queue"""
+        if self.packed:
+            return int(self.redis.get(self.counter) or 0)
         return self.redis.llen(self.key)
     
+    @instrumented
     def __getitem__(self, val):
         """Get a slice or a particular index."""
+        if self.packed:
+            raise TypeError("A packed %s can't be indexed" % type(self).__name__)
         try:
-            return [self._unpack(i) for i in self.redis.lrange(self.key, val.start, val.stop - 1)]
+            return self._unpack_many(self.redis.lrange(self.key, val.start, val.stop - 1))
         except AttributeError:
             return self._unpack(self.redis.lindex(self.key, val))
         except Exception as e:
-            log.error('Get item failed ** %s' % repr(e))
+            log.error('Get item failed ** %s', repr(e))
             return None
     
+    def _script(self, source):
+        """Return a registered Lua script for the given source"""
+        return getScript(self.redis, source)
+
+    def _dumps(self, val):
+        """Serializes a message"""
+        if not hooks:
+            return self.serializer.dumps(val)
+        start = clock()
+        packed = self.serializer.dumps(val)
+        emit('serialized', type(self).__name__, self.key, 'pack',
+            len(packed), clock() - start)
+        return packed
+
+    def _loads(self, val):
+        """Deserializes a message, or None for a missing one"""
+        if val is None:
+            return None
+        try:
+            if not hooks:
+                return self.serializer.loads(val)
+            start = clock()
+            unpacked = self.serializer.loads(val)
+            emit('serialized', type(self).__name__, self.key, 'unpack',
+                len(val), clock() - start)
+            return unpacked
+        except TypeError:
+            return None
+
     def _pack(self, val):
         """Prepares a message to go into Redis"""
-        return self.serializer.dumps(val, 1)
-    
-    def _unpack(self, val):
-        """Unpacks a message stored in Redis"""
+        return self._offload(self._dumps(val))
+
+    def _unpack(self, val, consume=False):
+        """
+        Unpacks a message stored in Redis. Popping consumes the message's
+        offloaded payload, if it has one.
+        """
+        if self.offload is None:
+            return self._loads(self._strip(val))
+        return self._unpack_many([val], consume)[0]
+
+    def _unpack_many(self, values, consume=False):
+        """Unpacks messages, fetching any offloaded payloads in one round trip"""
+        values = [self._strip(val) for val in values]
+        if self.offload is not None:
+            values = self._resolve(values, consume)
+        return [self._loads(val) for val in values]
+
+    def _strip(self, val):
+        """Returns the serialized message in what's stored in Redis"""
+        return val
+
+    # Offloaded payloads are kept in a hash, along with a count of the
+    # references to them. Add a reference to KEYS[1], storing ARGV[2] (if
+    # it's given) as the payload and expiring it in ARGV[1] seconds (if
+    # that's not 0).
+    STASH = """
+        if ARGV[2] then
+            redis.call('hset', KEYS[1], 'data', ARGV[2])
+        end
+        redis.call('hincrby', KEYS[1], 'refs', 1)
+        if tonumber(ARGV[1]) > 0 then
+            redis.call('expire', KEYS[1], ARGV[1])
+        end
+    """
+
+    # Drop a reference to each of KEYS, deleting them with their last one,
+    # and return each payload (if it's in Redis) and how many references
+    # are left
+    CONSUME = """
+        local results = {}
+        for i, key in ipairs(KEYS) do
+            local left = 0
+            results[2 * i - 1] = redis.call('hget', key, 'data') or false
+            if redis.call('exists', key) == 1 then
+                left = redis.call('hincrby', key, 'refs', -1)
+                if left <= 0 then
+                    redis.call('del', key)
+                end
+            end
+            results[2 * i] = left
+        end
+        return results
+    """
+
+    def _payload(self, digest):
+        """
+        The key holding an offloaded payload and its references. This
+        doesn't depend on the structure, so references stay good when
+        elements move between structures.
+        """
+        return 'qr:payload:%s' % native(digest)
+
+    def _spooled(self, digest):
+        """The path of a spooled payload"""
+        return os.path.join(self.spool, native(digest))
+
+    def _offload(self, packed, stash=True):
+        """
+        Stores a payload bigger than the offload threshold outside the
+        structure, returning the reference to keep in its place. Payloads
+        are addressed by content, so equal ones share storage, and packing
+        an element again gives the same reference.
+        """
+        if self.offload is None or len(packed) <= self.offload:
+            return packed
+        digest = hashlib.sha1(packed).hexdigest().encode('ascii')
+        if self.spool is None:
+            ref, args = refMarker + b'k:' + digest, [packed]
+        else:
+            ref, args = refMarker + b's:' + digest, []
+        if not stash:
+            return ref
+        if self.spool is not None and not os.path.exists(self._spooled(digest)):
+            # Write the file under a temporary name, so that readers never
+            # see part of it
+            path = self._spooled(digest)
+            temporary = '%s.%d.%d' % (path, os.getpid(), threading.current_thread().ident)
+            with open(temporary, 'wb') as f:
+                f.write(packed)
+            os.rename(temporary, path)
+        self._script(self.STASH)(keys=[self._payload(digest)],
+            args=[self.offload_ttl or 0] + args, client=self.redis)
+        log.debug('Offloaded ** %s ** bytes for key ** %s **', len(packed), self.key)
+        return ref
+
+    def _read_spool(self, digest):
+        """Read a spooled payload through a memory map, or None if it's gone"""
         try:
-            return self.serializer.loads(val)
-        except TypeError:
+            with open(self._spooled(digest), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    return mapped[:]
+                finally:
+                    mapped.close()
+        except (IOError, OSError):
             return None
+
+    def _parse(self, ref):
+        """Split a reference into its kind, b'k' (Redis) or b's' (spool), and digest"""
+        body = ref[len(refMarker):]
+        return body[:1], body[2:]
+
+    def _consume(self, refs):
+        """Drop a reference to each offloaded payload, returning their contents"""
+        refs = [self._parse(ref) for ref in refs]
+        results = self._script(self.CONSUME)(
+            keys=[self._payload(digest) for kind, digest in refs],
+            client=self.redis)
+        payloads = []
+        for index, (kind, digest) in enumerate(refs):
+            payload, left = results[2 * index], results[2 * index + 1]
+            if kind == b's':
+                payload = self._read_spool(digest)
+                if left <= 0:
+                    try:
+                        os.remove(self._spooled(digest))
+                    except OSError:
+                        pass
+            payloads.append(payload)
+        return payloads
+
+    def _fetch(self, refs):
+        """Return the contents of offloaded payloads, leaving them be"""
+        refs = [self._parse(ref) for ref in refs]
+        with self.redis.pipeline(transaction=False) as pipe:
+            for kind, digest in refs:
+                if kind == b'k':
+                    pipe.hget(self._payload(digest), 'data')
+            fetched = iter(pipe.execute())
+        payloads = []
+        for kind, digest in refs:
+            if kind == b'k':
+                payloads.append(next(fetched))
+            else:
+                payloads.append(self._read_spool(digest))
+        return payloads
+
+    def _resolve(self, values, consume=False):
+        """
+        Replaces the references among values with their payloads, fetching
+        all of those kept in Redis in one round trip
+        """
+        indices = [index for index, val in enumerate(values)
+            if val is not None and val[:len(refMarker)] == refMarker]
+        if not indices:
+            return values
+        values = list(values)
+        refs = [values[index] for index in indices]
+        if consume:
+            payloads = self._consume(refs)
+        else:
+            payloads = self._fetch(refs)
+        for index, payload in zip(indices, payloads):
+            values[index] = payload
+        return values
     
-    def dump(self, fobj):
-        """Destructively dump the contents of the queue into fp"""
-        next = self.redis.rpop(self.key)
-        while next:
-            fobj.write(next)
-            next = self.redis.rpop(self.key)
-    
-    def load(self, fobj):
-        """Load the contents of the provided fobj into the queue"""
-        try:
-            while True:
-                self.redis.lpush(self.key, self._pack(self.serializer.load(fobj)))
-        except:
+    # In packed mode, each list element is a chunk: a count of the
+    # elements in it, a colon, and then each serialized element, oldest
+    # first, prefixed by its length as 4 big-endian bytes. The count of
+    # every element in the structure is kept in a counter key. These
+    # are Lua helpers to count a chunk's elements, and split one in two
+    # after its first n.
+    CHUNKS = """
+        local function chunkCount(chunk)
+            return tonumber(string.match(chunk, '^%d+'))
+        end
+        local function splitChunk(chunk, n)
+            local colon = string.find(chunk, ':', 1, true)
+            local at = colon + 1
+            for i = 1, n do
+                local a, b, c, d = string.byte(chunk, at, at + 3)
+                at = at + 4 + ((a * 256 + b) * 256 + c) * 256 + d
+            end
+            return n .. ':' .. string.sub(chunk, colon + 1, at - 1),
+                (chunkCount(chunk) - n) .. ':' .. string.sub(chunk, at)
+        end
+    """
+
+    # Pack the framed elements ARGV[3...] onto list KEYS[1], filling its
+    # newest chunk up to ARGV[1] elements and then starting new ones, and
+    # add them to the counter KEYS[2]. If ARGV[2] isn't empty, drop the
+    # oldest elements past that many. Returns the new count.
+    PACK = CHUNKS + """
+        local limit = tonumber(ARGV[1])
+        local i = 3
+        local head = redis.call('lindex', KEYS[1], 0)
+        if head and i <= #ARGV and chunkCount(head) < limit then
+            local count = chunkCount(head)
+            local parts = {string.sub(head, string.find(head, ':', 1, true) + 1)}
+            while i <= #ARGV and count < limit do
+                parts[#parts + 1] = ARGV[i]
+                count = count + 1
+                i = i + 1
+            end
+            redis.call('lset', KEYS[1], 0, count .. ':' .. table.concat(parts))
+        end
+        while i <= #ARGV do
+            local parts = {}
+            while i <= #ARGV and #parts < limit do
+                parts[#parts + 1] = ARGV[i]
+                i = i + 1
+            end
+            redis.call('lpush', KEYS[1], #parts .. ':' .. table.concat(parts))
+        end
+        local total = redis.call('incrby', KEYS[2], #ARGV - 2)
+        if ARGV[2] ~= '' then
+            local size = tonumber(ARGV[2])
+            while total > size do
+                local oldest = redis.call('rpop', KEYS[1])
+                if not oldest then
+                    break
+                end
+                local count = chunkCount(oldest)
+                if count > total - size then
+                    local dropped, rest = splitChunk(oldest, total - size)
+                    redis.call('rpush', KEYS[1], rest)
+                    count = total - size
+                end
+                total = redis.call('decrby', KEYS[2], count)
+            end
+        end
+        return total
+    """
+
+    # Take up to ARGV[1] elements, oldest first, from the chunks in list
+    # KEYS[1], splitting the last chunk if need be, and take them off the
+    # counter KEYS[2]. Returns the chunks taken.
+    UNPACK = CHUNKS + """
+        local n = tonumber(ARGV[1])
+        local taken, got = {}, 0
+        while got < n do
+            local chunk = redis.call('rpop', KEYS[1])
+            if not chunk then
+                break
+            end
+            local count = chunkCount(chunk)
+            if got + count > n then
+                local rest
+                chunk, rest = splitChunk(chunk, n - got)
+                redis.call('rpush', KEYS[1], rest)
+                count = n - got
+            end
+            taken[#taken + 1] = chunk
+            got = got + count
+        end
+        if got > 0 and redis.call('decrby', KEYS[2], got) <= 0 then
+            redis.call('del', KEYS[2])
+        end
+        return taken
+    """
+
+    def _chunk(self, chunk):
+        """Split a chunk into the serialized elements in it, oldest first"""
+        colon = chunk.index(b':')
+        records, at = [], colon + 1
+        for i in range(int(chunk[:colon])):
+            length = struct.unpack('>I', chunk[at:at + 4])[0]
+            records.append(chunk[at + 4:at + 4 + length])
+            at += 4 + length
+        return records
+
+    def _pack_records(self, client, records, size=''):
+        """Pack serialized elements into chunks, in one script call"""
+        frames = [struct.pack('>I', len(r)) + r for r in records]
+        return self._script(self.PACK)(keys=[self.key, self.counter],
+            args=[self.packed, size] + frames, client=client)
+
+    def _unpack_records(self, n):
+        """Take up to n serialized elements out of their chunks, oldest first"""
+        chunks = self._script(self.UNPACK)(keys=[self.key, self.counter], args=[n])
+        return [record for chunk in chunks for record in self._chunk(chunk)]
+
+    def _oldest(self, chunk):
+        """The oldest serialized element in a chunk, if there's a chunk"""
+        if not chunk:
+            return None
+        return self._chunk(chunk)[0]
+
+    def _take(self, n):
+        """Destructively take up to n raw records, in the order dump writes them"""
+        if self.packed:
+            return self._unpack_records(n)
+        return self._pop_raw(n, right=True)
+
+    def _put(self, pipe, records):
+        """Queue up the commands to load raw records, as written by dump"""
+        if self.packed:
+            self._pack_records(pipe, records)
             return
-    
-    def dumpfname(self, fname, truncate=False):
-        """Destructively dump the contents of the queue into fname"""
-        if truncate:
-            with file(fname, 'w+') as f:
-                self.dump(f)
+        if self.maxlen is not None:
+            self._fit(pipe, records)
+            return self._fitted(records)
+        pipe.lpush(self.key, *records)
+
+    def _record(self, element):
+        """Pack an element into a raw record for _put"""
+        return self._pack(element)
+
+    def _stored(self, record):
+        """What's stored in Redis for a raw record"""
+        return record
+
+    def _restore(self, record, stored):
+        """A raw record with what's stored for it replaced"""
+        return stored
+
+    def _inline(self, records):
+        """
+        Replace the references to offloaded payloads among raw records with
+        the payloads, dropping the references, so a dump holds the elements
+        """
+        if self.offload is None:
+            return records
+        stored = [self._stored(record) for record in records]
+        values = [self._strip(val) for val in stored]
+        payloads = self._resolve(values, consume=True)
+        return [self._restore(record, val[:len(val) - len(value)] + (payload or value))
+            for record, val, value, payload in zip(records, stored, values, payloads)]
+
+    def _outline(self, records):
+        """Offload the payloads of raw records, as loaded, that are big enough"""
+        if self.offload is None:
+            return records
+        restored = []
+        for record in records:
+            val = self._stored(record)
+            value = self._strip(val)
+            restored.append(self._restore(record,
+                val[:len(val) - len(value)] + self._offload(value)))
+        return restored
+
+    def _write(self, fobj, records, format):
+        """Write raw records in the given format"""
+        if format == 'lines':
+            fobj.write(b''.join(base64.b64encode(r) + b'\n' for r in records))
+        elif format == 'length':
+            fobj.write(b''.join(struct.pack('>I', len(r)) + r for r in records))
+        else:
+            raise ValueError('Unknown dump format %r' % format)
+
+    def _read(self, fobj, format):
+        """Generate the raw records in fobj, written in the given format"""
+        if format == 'lines':
+            for line in fobj:
+                line = line.strip()
+                if line:
+                    yield base64.b64decode(line)
+        elif format == 'length':
+            while True:
+                header = fobj.read(4)
+                if not header:
+                    return
+                length, = struct.unpack('>I', self._exactly(header, 4))
+                yield self._exactly(fobj.read(length), length)
         else:
-            with file(fname, 'a+') as f:
-                self.dump(f)
+            raise ValueError('Unknown dump format %r' % format)
+
+    def _exactly(self, data, length):
+        """Make sure a read from a length-prefixed dump wasn't cut short"""
+        if len(data) != length:
+            raise ValueError('Truncated dump file')
+        return data
+
+    @instrumented
+    def dump(self, fobj, chunk=1000, format='lines'):
+        """
+        Destructively dump the contents of the queue into fobj, which should
+        be opened in binary mode. Elements move in chunks of the given size,
+        each taken off the queue in one round trip, so the queue is never
+        held in memory all at once. Elements are written still serialized:
+        base64, one per line, for the 'lines' format, or prefixed with their
+        length for 'length'. Offloaded payloads are written in place of
+        their references, which are dropped. Returns the number of elements
+        dumped.
+        """
+        count = 0
+        records = self._take(chunk)
+        while records:
+            self._write(fobj, self._inline(records), format)
+            count += len(records)
+            records = self._take(chunk)
+        log.debug('Dumped ** %s ** elements from key ** %s **', count, self.key)
+        return count
+
+    @instrumented
+    def load(self, fobj, chunk=1000, format='lines'):
+        """
+        Load the contents of fobj, as written by dump, into the queue,
+        pushing a chunk of elements per round trip. Payloads bigger than the
+        offload threshold are offloaded again. Returns the number of
+        elements loaded.
+        """
+        count = 0
+        records = []
+        for record in self._read(fobj, format):
+            records.append(record)
+            if len(records) >= chunk:
+                count += self._load(self._outline(records))
+                records = []
+        if records:
+            count += self._load(self._outline(records))
+        log.debug('Loaded ** %s ** elements into key ** %s **', count, self.key)
+        return count
+
+    def _load(self, records):
+        with self.redis.pipeline(transaction=False) as pipe:
+            parse = self._put(pipe, records)
+            replies = pipe.execute()
+        if parse is None:
+            return len(records)
+        # A bounded structure may not have taken all of them
+        return parse(replies)
+
+    def _open(self, fname, mode, compress):
+        """Open fname, through gzip if asked to or if it ends in .gz"""
+        if compress is None:
+            compress = fname.endswith('.gz')
+        if compress:
+            return gzip.open(fname, mode)
+        return open(fname, mode)
+
+    def dumpfname(self, fname, truncate=False, compress=None, **kwargs):
+        """Destructively dump the contents of the queue into fname"""
+        with self._open(fname, truncate and 'wb' or 'ab', compress) as f:
+            return self.dump(f, **kwargs)
     
-    def loadfname(self, fname):
+    def loadfname(self, fname, compress=None, **kwargs):
         """Load the contents of the contents of fname into the queue"""
-        with file(fname) as f:
-            self.load(f)
+        with self._open(fname, 'rb', compress) as f:
+            return self.load(f, **kwargs)
+
+    # How elements leave a structure when they're moved, in the order pops
+    # take them ('rpop', 'lpop', or 'zmin' for the lowest scores first),
+    # and how they go into one ('lpush' or 'zadd'), if they can be moved
+    # at all
+    move_out = 'rpop'
+    move_in = 'lpush'
+
+    # Move up to ARGV[3] elements from KEYS[1] onto KEYS[2], taking them
+    # with ARGV[1] and putting them with ARGV[2], as above. Sorted set
+    # sources only give up elements scored from ARGV[4] to ARGV[5], and
+    # elements from lists go into sorted sets scored ARGV[6]. ARGV[7], if
+    # it's not empty, is the most elements the target may hold, and lists
+    # are trimmed to ARGV[8] elements after, if it's not empty. Returns
+    # how many were moved, and how many there was room for, followed by
+    # the trimmed elements that start with ARGV[9], offloaded payloads'
+    # references, if it's not empty. Elements go in and out a slice of
+    # 1000 per command, to stay inside Lua's stack.
+    MOVE = """
+        local n = tonumber(ARGV[3])
+        if ARGV[7] ~= '' then
+            local length
+            if ARGV[2] == 'zadd' then
+                length = redis.call('zcard', KEYS[2])
+            else
+                length = redis.call('llen', KEYS[2])
+            end
+            n = math.min(n, tonumber(ARGV[7]) - length)
+        end
+        if n <= 0 then
+            return {0, 0}
+        end
+        local values, scores = {}, {}
+        if ARGV[1] == 'zmin' then
+            local taken = redis.call('zrangebyscore', KEYS[1], ARGV[4], ARGV[5],
+                'WITHSCORES', 'LIMIT', 0, n)
+            for i = 1, #taken, 2 do
+                values[#values + 1] = taken[i]
+                scores[#scores + 1] = taken[i + 1]
+            end
+            for first = 1, #values, 1000 do
+                redis.call('zrem', KEYS[1], unpack(values, first, math.min(first + 999, #values)))
+            end
+        else
+            for i = 1, n do
+                local value = redis.call(ARGV[1], KEYS[1])
+                if not value then
+                    break
+                end
+                values[i] = value
+                scores[i] = ARGV[6]
+            end
+        end
+        if #values == 0 then
+            return {0, n}
+        end
+        local results = {#values, n}
+        if ARGV[2] == 'zadd' then
+            for i, value in ipairs(values) do
+                redis.call('zadd', KEYS[2], scores[i], value)
+            end
+        else
+            for first = 1, #values, 1000 do
+                redis.call('lpush', KEYS[2], unpack(values, first, math.min(first + 999, #values)))
+            end
+            if ARGV[8] ~= '' and ARGV[9] == '' then
+                redis.call('ltrim', KEYS[2], 0, tonumber(ARGV[8]) - 1)
+            elseif ARGV[8] ~= '' then
+                for i = tonumber(ARGV[8]) + 1, redis.call('llen', KEYS[2]) do
+                    local dropped = redis.call('rpop', KEYS[2])
+                    if string.sub(dropped, 1, #ARGV[9]) == ARGV[9] then
+                        results[#results + 1] = dropped
+                    end
+                end
+            end
+        end
+        return results
+    """
+
+    def _server(self):
+        """The address and database of the Redis server the structure is on"""
+        kwargs = self.redis.connection_pool.connection_kwargs
+        return (kwargs.get('host', 'localhost'), kwargs.get('port', 6379),
+            kwargs.get('path'), kwargs.get('db') or 0)
+
+    @instrumented
+    def move_to(self, targets, count=None, min_score='-inf', max_score='+inf',
+        score=0, chunk=1000):
+        """
+        Move up to count elements (or all of them) onto another structure
+        on the same Redis server, in the order pops would take them, as if
+        each was popped and pushed again. Elements move still serialized,
+        chunk of them per script call, and never leave the server. Given a
+        list of targets, chunks are dealt out to them in turn. Elements
+        only leave a priority queue if they're scored from min_score to
+        max_score, and go into one with the given score. Bounded targets
+        stop taking elements once they're full. Returns the number moved.
+        """
+        if not isinstance(targets, (list, tuple)):
+            targets = [targets]
+        targets = list(targets)
+        for target in [self] + list(targets):
+            if target.move_out is None or target.move_in is None:
+                raise TypeError("%s can't move elements server-side" % type(target).__name__)
+        for target in targets:
+            if target._server() != self._server():
+                raise ValueError('%s is on a different Redis server from %s' % (
+                    target.key, self.key))
+            if target.key == self.key:
+                # Elements would go round and round
+                raise ValueError("Can't move elements from %s onto itself" % self.key)
+            if (self.offload is None) != (target.offload is None):
+                # References would end up where they can't be resolved,
+                # or payloads would lose theirs
+                raise ValueError('%s and %s must both offload, or neither' % (
+                    self.key, target.key))
+        moved, turn = 0, 0
+        while targets and (count is None or moved < count):
+            turn %= len(targets)
+            target = targets[turn]
+            n = chunk
+            if count is not None:
+                n = min(n, count - moved)
+            limit = ''
+            if target.maxlen is not None:
+                limit = target.maxlen
+            size, marker = '', b''
+            if isinstance(target, CappedCollection) and target.size:
+                size = target.size
+            if self.offload is not None:
+                marker = refMarker
+            results = self._script(self.MOVE)(keys=[self.key, target.key],
+                args=[self.move_out, target.move_in, n, min_score, max_score,
+                    score, limit, size, marker])
+            done, room = results[:2]
+            if len(results) > 2:
+                # Trimming the target dropped elements with offloaded payloads
+                self._consume(results[2:])
+            moved += done
+            if done < room:
+                # Nothing's left to move
+                break
+            if room < n:
+                targets.pop(turn)
+            else:
+                turn += 1
+        log.debug('Moved ** %s ** elements from key ** %s **', moved, self.key)
+        return moved
     
+    @instrumented
     def extend(self, vals):
-        """Extends the elements in the queue."""
+        """
+        Extends the elements in the queue. With a maxlen, returns how many
+        of them went in.
+        """
+        if self.maxlen is not None:
+            return self._bound([self._pack(val) for val in vals])
+        if self.packed:
+            self._pack_records(self.redis, [self._pack(val) for val in vals])
+            return
         with self.redis.pipeline(transaction=False) as pipe:
             for val in vals:
                 pipe.lpush(self.key, self._pack(val))
             pipe.execute()
-    
+
+    # Push ARGV[5...] onto list KEYS[1] with command ARGV[2] (lpush or
+    # rpush), keeping it to ARGV[1] elements. With ARGV[3] 'drop', the
+    # oldest elements, at the other end, make room; otherwise as many are
+    # pushed as fit. Returns how many were pushed, followed by the dropped
+    # elements that start with ARGV[4], offloaded payloads' references,
+    # if it's not empty.
+    BOUND = """
+        local maxlen = tonumber(ARGV[1])
+        local length = redis.call('llen', KEYS[1])
+        local last = #ARGV
+        if ARGV[3] ~= 'drop' then
+            last = math.min(last, 4 + maxlen - length)
+        end
+        for first = 5, last, 1000 do
+            redis.call(ARGV[2], KEYS[1], unpack(ARGV, first, math.min(first + 999, last)))
+        end
+        local results = {math.max(0, last - 4)}
+        local excess = length + results[1] - maxlen
+        if ARGV[3] ~= 'drop' or excess <= 0 then
+            return results
+        end
+        if ARGV[4] == '' then
+            if ARGV[2] == 'lpush' then
+                redis.call('ltrim', KEYS[1], 0, maxlen - 1)
+            else
+                redis.call('ltrim', KEYS[1], -maxlen, -1)
+            end
+            return results
+        end
+        local pop = 'rpop'
+        if ARGV[2] == 'rpush' then
+            pop = 'lpop'
+        end
+        for i = 1, excess do
+            local dropped = redis.call(pop, KEYS[1])
+            if string.sub(dropped, 1, #ARGV[4]) == ARGV[4] then
+                results[#results + 1] = dropped
+            end
+        end
+        return results
+    """
+
+    def _fit(self, client, records, command='lpush'):
+        """Push as many raw records as fit in the bounded list, in one script call"""
+        marker = b''
+        if self.offload is not None:
+            marker = refMarker
+        return self._script(self.BOUND)(keys=[self.key], args=[self.maxlen,
+            command, self.overflow, marker] + list(records), client=client)
+
+    def _release_refs(self, values):
+        """Drop the references to offloaded payloads among raw values"""
+        if self.offload is None:
+            return
+        refs = [val for val in values if val[:len(refMarker)] == refMarker]
+        if refs:
+            self._consume(refs)
+
+    def _fitted(self, records):
+        """
+        Parse the reply to a _fit queued up for records, dropping the
+        references among the elements it dropped or refused, and return
+        how many went in
+        """
+        def parse(replies):
+            results = replies[-1]
+            accepted = int(results[0])
+            self._release_refs(list(results[1:]) +
+                [self._stored(r) for r in records[accepted:]])
+            return accepted
+        return parse
+
+    def _bound(self, records, *args):
+        """
+        Push raw records onto a bounded structure and return how many went
+        in. Refused elements are always the last ones, so the caller can
+        retry records[accepted:]. With overflow='block', what's left is
+        retried until it fits or overflow_timeout passes.
+        """
+        accepted, deadline = 0, None
+        if self.overflow_timeout is not None:
+            deadline = time.time() + self.overflow_timeout
+        while True:
+            results = self._fit(self.redis, records[accepted:], *args)
+            accepted += int(results[0])
+            self._release_refs(results[1:])
+            if accepted >= len(records) or self.overflow != 'block':
+                break
+            wait = self.overflow_poll
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    break
+            time.sleep(wait)
+        self._release_refs([self._stored(r) for r in records[accepted:]])
+        log.debug('Pushed ** %s ** of ** %s ** elements onto bounded key ** %s **',
+            accepted, len(records), self.key)
+        return accepted
+
+    def _push_one(self, record, command='lpush'):
+        """Push one raw record, raising Full if a bounded structure refuses it"""
+        if self.maxlen is None:
+            return self.redis.execute_command(command.upper(), self.key, record)
+        if not self._bound([record], command):
+            raise Full('No room in key %s, with a maxlen of %s' % (self.key, self.maxlen))
+
+    def _pop_raw(self, n, right=True):
+        """Atomically pop up to n raw elements off one end of the list"""
+        if n <= 0:
+            return []
+        with self.redis.pipeline() as pipe:
+            if right:
+                pipe.lrange(self.key, -n, -1)
+                pipe.ltrim(self.key, 0, -n - 1)
+            else:
+                pipe.lrange(self.key, 0, n - 1)
+                pipe.ltrim(self.key, n, -1)
+            popped, trimmed = pipe.execute()
+        if right:
+            popped.reverse()
+        return popped
+
+    def _pop_many(self, n, block=False, timeout=None, right=True):
+        """
+        Atomically pop up to n elements off one end of the list, in the
+        order in which repeated single pops would have returned them. The
+        range read and the trim happen in one MULTI/EXEC, so this costs a
+        single round trip. When blocking and the list is empty, wait for
+        the first element and then take whatever else is available.
+        """
+        if n <= 0:
+            return []
+        if self.packed:
+            return self._pop_packed(n, block, timeout)
+        popped = self._pop_raw(n, right)
+        if not popped and block:
+            if right:
+                result = self.redis.brpop(self.key, timeout or 0)
+            else:
+                result = self.redis.blpop(self.key, timeout or 0)
+            if result is None:
+                return []
+            return [self._unpack(result[1], True)] + self._pop_many(n - 1, right=right)
+        log.debug('Popped ** %s ** from key ** %s **', popped, self.key)
+        return self._unpack_many(popped, True)
+
+    def _pop_packed(self, n, block=False, timeout=None):
+        """
+        Pop up to n elements out of their chunks, oldest first. When
+        blocking and there are none, wait for a chunk to arrive by moving
+        it from the end of the list back onto the end (Redis 6.2+).
+        """
+        popped = self._unpack_records(n)
+        if not popped and block:
+            if self.redis.blmove(self.key, self.key, timeout or 0, 'RIGHT', 'RIGHT') is None:
+                return []
+            popped = self._unpack_records(n)
+        log.debug('Popped ** %s ** from key ** %s **', popped, self.key)
+        return self._unpack_many(popped, True)
+
+    @instrumented
     def peek(self):
         """Look at the next item in the queue"""
-        return self[-1]
+        if self.packed:
+            return self._unpack(self._oldest(self.redis.lindex(self.key, -1)))
+        return self._unpack(self.redis.lindex(self.key, -1))
+
+    def _batch_pop(self, pipe):
+        """
+        Queue up a pop on a batch's pipeline, returning a function that
+        finds the raw popped element in the replies to what was queued
+        """
+        raise TypeError("%s can't pop in a batch" % type(self).__name__)
 
+    def _batch_pop_packed(self, pipe):
+        """Queue up taking an element out of its chunk on a batch's pipeline"""
+        self._script(self.UNPACK)(keys=[self.key, self.counter], args=[1], client=pipe)
+        return lambda replies: self._oldest(headReply(replies))
+
+    def _batch_peek(self, pipe):
+        """Queue up a peek on a batch's pipeline, like _batch_pop"""
+        pipe.lindex(self.key, -1)
+        if self.packed:
+            return lambda replies: self._oldest(replies[-1])
+        return lastReply
+
+    def _batch_len(self, pipe):
+        """Queue up finding the length on a batch's pipeline, like _batch_pop"""
+        if self.packed:
+            pipe.get(self.counter)
+            return lambda replies: int(replies[-1] or 0)
+        pipe.execute_command(self.length_command, self.key)
+        return lastReply
+
+    @instrumented
     def elements(self):
         """Return all elements as a Python list"""
-        return [self._unpack(o) for o in self.redis.lrange(self.key, 0, -1)]
+        if self.packed:
+            return self._unpack_many(self._unchunk(self.redis.lrange(self.key, 0, -1)))
+        return self._unpack_many(self.redis.lrange(self.key, 0, -1))
+
+    def _unchunk(self, chunks):
+        """The serialized elements in chunks, in the order lists keep them"""
+        return [record for chunk in chunks for record in reversed(self._chunk(chunk))]
     
     def elements_as_json(self):
         """Return all elements as JSON object"""
-        return json.dumps(self.elements)
+        return ''.join(self.iter_json())
+
+    def __iter__(self):
+        """Iterate over the elements, a page at a time"""
+        return self.iter_elements()
+
+    def _pages(self, page_size):
+        """
+        Generate the elements, a page of page_size per round trip. Packed
+        structures are read page_size elements' worth of chunks at a time.
+        """
+        if self.packed:
+            page_size = max(1, page_size // self.packed)
+        start = 0
+        while True:
+            page = self.redis.lrange(self.key, start, start + page_size - 1)
+            if page and self.packed:
+                yield self._unpack_many(self._unchunk(page))
+            elif page:
+                yield self._unpack_many(page)
+            if len(page) < page_size:
+                return
+            start += page_size
+
+    def iter_elements(self, page_size=1000, **kwargs):
+        """
+        Lazily generate the elements in the order elements() returns them,
+        fetching page_size of them per round trip, so memory use doesn't
+        grow with the length of the queue. This isn't a snapshot: pushes
+        and pops while iterating shift the pages.
+        """
+        for page in self._pages(page_size, **kwargs):
+            for element in page:
+                yield element
+
+    def iter_json(self, page_size=1000, **kwargs):
+        """Lazily generate the elements as a JSON array, in pieces"""
+        yield '['
+        separator = ''
+        for page in self._pages(page_size, **kwargs):
+            yield separator + ','.join(json.dumps(element) for element in page)
+            separator = ','
+        yield ']'
     
+    @instrumented
     def clear(self):
         """Removes all the elements in the queue"""
-        self.redis.delete(self.key)
+        if self.offload is not None:
+            self._drop_all()
+        if self.packed:
+            self.redis.delete(self.key, self.counter)
+        else:
+            self.redis.delete(self.key)
+
+    def _drop_all(self, chunk=1000):
+        """
+        Take every element, chunk at a time, dropping the references to
+        their offloaded payloads
+        """
+        records = self._take(chunk)
+        while records:
+            self._release_refs([self._strip(self._stored(r)) for r in records])
+            records = self._take(chunk)
 
 class Deque(BaseQueue):
     """Implements a double-ended queue"""
+
+    boundable = True
     
     @staticmethod
     def all(pattern='*', **kwargs):
         return BaseQueue.all(Deque, pattern, **kwargs)
 
+    @staticmethod
+    def scan(pattern='*', count=1000, withsizes=False, **kwargs):
+        return BaseQueue.scan(Deque, pattern, count, withsizes, **kwargs)
+
+    @instrumented
     def push_back(self, element):
         """Push an element to the back of the deque"""
-        self.redis.lpush(self.key, self._pack(element))
-        log.debug('Pushed ** %s ** for key ** %s **' % (element, self.key))
+        self._push_one(self._pack(element))
+        log.debug('Pushed ** %s ** for key ** %s **', element, self.key)
         
+    @instrumented
     def push_front(self, element):
         """Push an element to the front of the deque"""
-        key = self.key
-        push_it = self.redis.rpush(key, self._pack(element))
-        log.debug('Pushed ** %s ** for key ** %s **' % (element, self.key))
+        self._push_one(self._pack(element), 'rpush')
+        log.debug('Pushed ** %s ** for key ** %s **', element, self.key)
 
+    @instrumented
     def pop_front(self):
         """Pop an element from the front of the deque"""
         popped = self.redis.rpop(self.key)
-        log.debug('Popped ** %s ** from key ** %s **' % (popped, self.key))
-        return self._unpack(popped )
+        log.debug('Popped ** %s ** from key ** %s **', popped, self.key)
+        return self._unpack(popped, True)
 
+    @instrumented
     def pop_back(self):
         """Pop an element from the back of the deque"""
         popped = self.redis.lpop(self.key)
-        log.debug('Popped ** %s ** from key ** %s **' % (popped, self.key))
-        return self._unpack(popped)
+        log.debug('Popped ** %s ** from key ** %s **', popped, self.key)
+        return self._unpack(popped, True)
+
+    @instrumented
+    def pop_many_front(self, n, block=False, timeout=None):
+        """Pop up to n elements from the front of the deque"""
+        return self._pop_many(n, block, timeout, right=True)
+
+    @instrumented
+    def pop_many_back(self, n, block=False, timeout=None):
+        """Pop up to n elements from the back of the deque"""
+        return self._pop_many(n, block, timeout, right=False)
+
+    def _batch_pop(self, pipe):
+        pipe.rpop(self.key)
+        return lastReply
 
 class Queue(BaseQueue): 
     """Implements a FIFO queue"""
 
+    boundable = True
+    packable = True
+
     @staticmethod
     def all(pattern='*', **kwargs):
         return BaseQueue.all(Queue, pattern, **kwargs)
+
+    @staticmethod
+    def scan(pattern='*', count=1000, withsizes=False, **kwargs):
+        return BaseQueue.scan(Queue, pattern, count, withsizes, **kwargs)
     
+    @instrumented
     def push(self, element):
         """Push an element"""
-        self.redis.lpush(self.key, self._pack(element))
-        log.debug('Pushed ** %s ** for key ** %s **' % (element, self.key))
+        if self.packed:
+            self._pack_records(self.redis, [self._pack(element)])
+        else:
+            self._push_one(self._pack(element))
+        log.debug('Pushed ** %s ** for key ** %s **', element, self.key)
 
+    @instrumented
     def pop(self, block=False):
         """Pop an element"""
+        if self.packed:
+            popped = self._pop_packed(1, block)
+            return popped[0] if popped else None
         if not block:
             popped = self.redis.rpop(self.key)
         else:
             queue, popped = self.redis.brpop(self.key)
-        log.debug('Popped ** %s ** from key ** %s **' % (popped, self.key))
-        return self._unpack(popped)
-    
-class PriorityQueue(BaseQueue):
-    """A priority queue"""
-    def __len__(self):
-        """Return the length of the queue"""
-        return self.redis.zcard(self.key)
-    
-    def __getitem__(self, val):
-        """Get a slice or a particular index."""
-        try:
-            return [self._unpack(i) for i in self.redis.zrange(self.key, val.start, val.stop - 1)]
-        except AttributeError:
-            val = self.redis.zrange(self.key, val, val)
-            if val:
-                return self._unpack(val[0])
-            return None
-        except Exception as e:
-            log.error('Get item failed ** %s' % repr(e))
-            return None
-    
-    def dump(self, fobj):
-        """Destructively dump the contents of the queue into fp"""
-        next = self.pop()
-        while next:
-            self.serializer.dump(next[0], fobj)
-            next = self.pop()
-    
-    def load(self, fobj):
-        """Load the contents of the provided fobj into the queue"""
-        try:
-            while True:
-                value, score = self.serializer.load(fobj)
-                self.redis.zadd(self.key, value, score)
-        except Exception as e:
-            return
+        log.debug('Popped ** %s ** from key ** %s **', popped, self.key)
+        return self._unpack(popped, True)
+
+    @instrumented
+    def pop_many(self, n, block=False, timeout=None):
+        """Pop up to n elements, oldest first"""
+        return self._pop_many(n, block, timeout, right=True)
+
+    def _batch_pop(self, pipe):
+        if self.packed:
+            return self._batch_pop_packed(pipe)
+        pipe.rpop(self.key)
+        return lastReply
+
+class UniqueQueue(Queue):
+    """
+    A FIFO queue that skips elements that are already in it. A companion
+    set holds a 16 byte fingerprint (a truncated SHA1, computed by Lua) of
+    the serialized form of every element in the queue, and pushes and
+    pops check and update it atomically, in the same script call.
+    """
+
+    # Pushes check the fingerprints in their own script, which neither
+    # bound the queue, pack it, nor move elements into or out of it
+    boundable = packable = False
+    move_out = move_in = None
+
+    # Lua that turns a value into its fingerprint
+    FINGERPRINT = """
+        local function fingerprint(value)
+            local hex = string.sub(redis.sha1hex(value), 1, 32)
+            return (string.gsub(hex, '..', function(byte)
+                return string.char(tonumber(byte, 16))
+            end))
+        end
+    """
+
+    # Push each of ARGV[2...] that isn't already queued, returning how
+    # many were, followed by the skipped elements that start with ARGV[1],
+    # offloaded payloads' references, if it's not empty
+    PUSH = FINGERPRINT + """
+        local results = {0}
+        for i = 2, #ARGV do
+            local value = ARGV[i]
+            if redis.call('sadd', KEYS[2], fingerprint(value)) == 1 then
+                redis.call('lpush', KEYS[1], value)
+                results[1] = results[1] + 1
+            elseif ARGV[1] ~= '' and string.sub(value, 1, #ARGV[1]) == ARGV[1] then
+                results[#results + 1] = value
+            end
+        end
+        return results
+    """
+
+    # Pop up to ARGV[1] elements, forgetting their fingerprints
+    POP = FINGERPRINT + """
+        local popped = {}
+        for i = 1, tonumber(ARGV[1]) do
+            local value = redis.call('rpop', KEYS[1])
+            if not value then
+                break
+            end
+            redis.call('srem', KEYS[2], fingerprint(value))
+            popped[i] = value
+        end
+        return popped
+    """
+
+    @staticmethod
+    def all(pattern='*', **kwargs):
+        return BaseQueue.all(UniqueQueue, pattern, **kwargs)
+
+    @staticmethod
+    def scan(pattern='*', count=1000, withsizes=False, **kwargs):
+        return BaseQueue.scan(UniqueQueue, pattern, count, withsizes, **kwargs)
+
+    def __init__(self, key, **kwargs):
+        Queue.__init__(self, key, **kwargs)
+        self.fingerprints = '%s:fingerprints' % key
+
+    def _push_unique(self, client, records):
+        """Push the raw records that aren't already queued, in one script call"""
+        marker = b''
+        if self.offload is not None:
+            marker = refMarker
+        return self._script(self.PUSH)(keys=[self.key, self.fingerprints],
+            args=[marker] + list(records), client=client)
+
+    def _pushed(self, results):
+        """
+        Drop the references to the payloads of the elements a push
+        skipped, and return how many it pushed
+        """
+        self._release_refs(results[1:])
+        return int(results[0])
+
+    def _put(self, pipe, records):
+        # Keep each script call's arguments well inside Lua's stack
+        for start in range(0, len(records), 1000):
+            self._push_unique(pipe, records[start:start + 1000])
+        return lambda replies: sum(self._pushed(results) for results in replies)
+
+    def _pop_raw(self, n, right=True):
+        """Pop up to n raw elements, oldest first, forgetting their fingerprints"""
+        if n <= 0:
+            return []
+        return self._script(self.POP)(keys=[self.key, self.fingerprints],
+            args=[n], client=self.redis)
+
+    def _pop_many(self, n, block=False, timeout=None, right=True):
+        """
+        Pop up to n elements. When blocking and the queue is empty, wait for
+        an element by moving it from the end of the queue back onto the end
+        (Redis 6.2+), and then pop it like any other, so that an element is
+        never out of the queue while its fingerprint is still in the set.
+        """
+        if n <= 0:
+            return []
+        popped = self._pop_raw(n)
+        if not popped and block:
+            if self.redis.blmove(self.key, self.key, timeout or 0, 'RIGHT', 'RIGHT') is None:
+                return []
+            popped = self._pop_raw(n)
+        log.debug('Popped ** %s ** from key ** %s **', popped, self.key)
+        return self._unpack_many(popped, True)
+
+    @instrumented
+    def push(self, element):
+        """Push an element unless it's already queued, returning whether it was pushed"""
+        pushed = self._pushed(self._push_unique(self.redis, [self._pack(element)])) > 0
+        log.debug('Pushed ** %s ** for key ** %s **: %s', element, self.key, pushed)
+        return pushed
+
+    @instrumented
+    def extend(self, vals):
+        """Push the elements that aren't already queued, returning how many were"""
+        records = [self._pack(val) for val in vals]
+        if not records:
+            return 0
+        return self._load(records)
+
+    @instrumented
+    def pop(self, block=False, timeout=None):
+        """Pop an element"""
+        popped = self._pop_many(1, block, timeout)
+        if popped:
+            return popped[0]
+        return None
+
+    def _batch_pop(self, pipe):
+        self._script(self.POP)(keys=[self.key, self.fingerprints], args=[1],
+            client=pipe)
+        return headReply
+
+    @instrumented
+    def clear(self):
+        """Removes all the elements in the queue, and their fingerprints"""
+        if self.offload is not None:
+            self._drop_all()
+        self.redis.delete(self.key, self.fingerprints)
+
+class ReliableQueue(BaseQueue):
+    """
+    Implements a FIFO queue that doesn't lose elements when a consumer
+    dies. Popping atomically moves an element onto a processing list
+    belonging to the consumer, where it stays until it is acknowledged
+    with ack() or handed back with nack(). An element that hasn't been
+    acknowledged within the visibility timeout is put back at the front
+    of the queue by reap().
+
+    Every pop takes out a lease with its own id, and the processing list
+    and lease deadlines hold the element prefixed with the id and a
+    colon, so equal elements in flight together are leased separately.
+    Pop with withlease=True to get the lease id along with the element,
+    and acknowledge by lease id, which works even if the element has
+    changed since. A hash of each consumer's leases by id finds them
+    without scanning the processing list, as acknowledging by value does.
+    """
+
+    # Move up to ARGV[1] elements from the queue to the processing list,
+    # each under a new lease (numbered from the counter KEYS[5]) that ends
+    # at ARGV[2], and is kept in the hash KEYS[6] by its id
+    POP = """
+        local popped = {}
+        for i = 1, tonumber(ARGV[1]) do
+            local value = redis.call('rpop', KEYS[1])
+            if not value then
+                break
+            end
+            local lease = redis.call('incr', KEYS[5])
+            local leased = lease .. ':' .. value
+            redis.call('lpush', KEYS[2], leased)
+            redis.call('zadd', KEYS[3], ARGV[2], leased)
+            redis.call('hset', KEYS[6], lease, leased)
+            popped[i] = leased
+        end
+        if #popped > 0 then
+            redis.call('sadd', KEYS[4], ARGV[3])
+        end
+        return popped
+    """
+
+    # Lua to find the leased element with the lease id ARGV[2] in the hash
+    # KEYS[4], if ARGV[1] is 'lease', or otherwise the oldest with the value
+    # ARGV[2] in the processing list KEYS[2]. Returns the leased element,
+    # the value and the lease id.
+    FIND = """
+        local function find()
+            if ARGV[1] == 'lease' then
+                local leased = redis.call('hget', KEYS[4], ARGV[2])
+                if leased then
+                    return leased, string.sub(leased, #ARGV[2] + 2), ARGV[2]
+                end
+                return
+            end
+            local leased = redis.call('lrange', KEYS[2], 0, -1)
+            for i = #leased, 1, -1 do
+                local colon = string.find(leased[i], ':', 1, true)
+                if string.sub(leased[i], colon + 1) == ARGV[2] then
+                    return leased[i], ARGV[2], string.sub(leased[i], 1, colon - 1)
+                end
+            end
+        end
+    """
+
+    # Drop a leased element from the processing list, its deadline from
+    # KEYS[3] and its lease from KEYS[4], putting it back at the front of
+    # the queue if ARGV[3] is 1. Returns the element, if it was found.
+    RELEASE = FIND + """
+        local leased, value, lease = find()
+        if not leased then
+            return false
+        end
+        redis.call('lrem', KEYS[2], -1, leased)
+        redis.call('zrem', KEYS[3], leased)
+        redis.call('hdel', KEYS[4], lease)
+        if ARGV[3] == '1' then
+            redis.call('rpush', KEYS[1], value)
+        end
+        return value
+    """
+
+    # Move the deadline of a leased element in KEYS[3] to ARGV[3], and note
+    # the consumer ARGV[4] in KEYS[5]. Returns whether it was found.
+    TOUCH = FIND + """
+        local leased = find()
+        if not leased then
+            return 0
+        end
+        redis.call('zadd', KEYS[3], ARGV[3], leased)
+        redis.call('sadd', KEYS[5], ARGV[4])
+        return 1
+    """
+
+    # Put back up to ARGV[2] elements whose lease expired before ARGV[1],
+    # the latest first, so the earliest popped are popped again first, and
+    # drop their leases from KEYS[5].
+    # The oldest leases sit at the tail of the processing list, so scanning
+    # from there keeps each removal cheap.
+    REAP = """
+        local expired = redis.call('zrangebyscore', KEYS[3], '-inf', ARGV[1],
+            'LIMIT', 0, ARGV[2])
+        local count = 0
+        for i = #expired, 1, -1 do
+            local leased = expired[i]
+            local colon = string.find(leased, ':', 1, true)
+            if redis.call('lrem', KEYS[2], -1, leased) > 0 then
+                redis.call('rpush', KEYS[1], string.sub(leased, colon + 1))
+                count = count + 1
+            end
+            redis.call('zrem', KEYS[3], leased)
+            redis.call('hdel', KEYS[5], string.sub(leased, 1, colon - 1))
+        end
+        if redis.call('llen', KEYS[2]) == 0 then
+            redis.call('srem', KEYS[4], ARGV[3])
+        end
+        return count
+    """
+
+    @staticmethod
+    def all(pattern='*', **kwargs):
+        return BaseQueue.all(ReliableQueue, pattern, **kwargs)
+
+    @staticmethod
+    def scan(pattern='*', count=1000, withsizes=False, **kwargs):
+        return BaseQueue.scan(ReliableQueue, pattern, count, withsizes, **kwargs)
+
+    consuming = False
+
+    def __init__(self, key, consumer=None, timeout=30, **kwargs):
+        BaseQueue.__init__(self, key, **kwargs)
+        self.consumer = consumer or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.timeout = timeout
+        self.consumers = '%s:consumers' % key
+        self.leases = '%s:leases' % key
+        self.processing = self._processing(self.consumer)
+        self.deadlines = self._deadlines(self.consumer)
+        self.leased = self._leases(self.consumer)
+
+    def _processing(self, consumer):
+        """The key of the processing list for the given consumer"""
+        return '%s:processing:%s' % (self.key, consumer)
+
+    def _deadlines(self, consumer):
+        """The key of the lease deadlines for the given consumer"""
+        return '%s:deadlines:%s' % (self.key, consumer)
+
+    def _leases(self, consumer):
+        """The key of the given consumer's leased elements, by lease id"""
+        return '%s:leased:%s' % (self.key, consumer)
+
+    def _leased(self, leased):
+        """Split a leased element into its lease id and the raw element"""
+        lease, value = leased.split(b':', 1)
+        return native(lease), value
+
+    def _reserve(self, n, block=False, timeout=None):
+        """
+        Move up to n elements onto our processing list, as (lease, raw
+        element) pairs. When blocking and the queue is empty, wait for an
+        element by moving it from the end of the queue back onto the end
+        (Redis 6.2+), and then lease it like any other, so that an element
+        is never on the processing list without a deadline.
+        """
+        if n <= 0:
+            return []
+        keys = [self.key, self.processing, self.deadlines, self.consumers,
+            self.leases, self.leased]
+        script = self._script(self.POP)
+        popped = script(keys=keys, client=self.redis,
+            args=[n, time.time() + self.timeout, self.consumer])
+        if not popped and block:
+            if self.redis.blmove(self.key, self.key, timeout or 0, 'RIGHT', 'RIGHT') is None:
+                return []
+            popped = script(keys=keys, client=self.redis,
+                args=[n, time.time() + self.timeout, self.consumer])
+        log.debug('Popped ** %s ** from key ** %s **', popped, self.key)
+        return [self._leased(leased) for leased in popped]
+
+    def _release(self, element, lease, requeue):
+        """Take an element off our processing list, by its lease or its value"""
+        value = self._script(self.RELEASE)(
+            keys=[self.key, self.processing, self.deadlines, self.leased],
+            args=self._lookup(element, lease) + [requeue and 1 or 0],
+            client=self.redis)
+        if value is not None and not requeue and value[:len(refMarker)] == refMarker:
+            # The element is done with, and so is its offloaded payload
+            self._consume([value])
+        return value is not None
+
+    def _lookup(self, element, lease):
+        """The arguments FIND looks for a leased element by"""
+        if lease is not None:
+            return ['lease', lease]
+        return ['value', self._offload(self._dumps(element), stash=False)]
+
+    @instrumented
+    def push(self, element):
+        """Push an element"""
+        self.redis.lpush(self.key, self._pack(element))
+        log.debug('Pushed ** %s ** for key ** %s **', element, self.key)
+
+    @instrumented
+    def pop(self, block=False, timeout=None, withlease=False):
+        """
+        Pop an element, holding it until it is acknowledged, as (lease,
+        element) if withlease
+        """
+        popped = self.pop_many(1, block, timeout, withlease)
+        if popped:
+            return popped[0]
+        return withlease and (None, None) or None
+
+    @instrumented
+    def pop_many(self, n, block=False, timeout=None, withleases=False):
+        """
+        Pop up to n elements, oldest first, holding them until
+        acknowledged, as (lease, element) pairs if withleases
+        """
+        popped = self._reserve(n, block, timeout)
+        elements = self._unpack_many([value for lease, value in popped])
+        if withleases:
+            return [(lease, element) for (lease, value), element in zip(popped, elements)]
+        return elements
+
+    @instrumented
+    def ack(self, element=None, lease=None):
+        """
+        Acknowledge that a popped element has been dealt with, by its
+        lease id, or else by its value
+        """
+        return self._release(element, lease, False)
+
+    @instrumented
+    def nack(self, element=None, lease=None):
+        """Put a popped element back at the front of the queue"""
+        return self._release(element, lease, True)
+
+    @instrumented
+    def touch(self, element=None, timeout=None, lease=None):
+        """Extend the lease on a popped element, returning whether it was found"""
+        deadline = time.time() + (timeout or self.timeout)
+        return self._script(self.TOUCH)(
+            keys=[self.key, self.processing, self.deadlines, self.leased,
+                self.consumers],
+            args=self._lookup(element, lease) + [deadline, self.consumer],
+            client=self.redis) == 1
+
+    def in_flight(self):
+        """Return the number of elements this consumer hasn't acknowledged"""
+        return self.redis.llen(self.processing)
+
+    def _batch_pop(self, pipe):
+        keys = [self.key, self.processing, self.deadlines, self.consumers,
+            self.leases, self.leased]
+        self._script(self.POP)(keys=keys, client=pipe,
+            args=[1, time.time() + self.timeout, self.consumer])
+        return self._batch_leased
+
+    def _batch_leased(self, replies):
+        """The raw element leased by a pop in a batch"""
+        leased = headReply(replies)
+        if leased is None:
+            return None
+        return self._leased(leased)[1]
+
+    @instrumented
+    def reap(self, batch=1000):
+        """
+        Put every element whose lease has expired back at the front of the
+        queue, whichever consumer it belongs to, and return how many were
+        put back. All of the work happens server-side, with one script call
+        per consumer pipelined into a single round trip. At most batch
+        elements are put back per consumer per call.
+        """
+        consumers = self.redis.smembers(self.consumers)
+        if not consumers:
+            return 0
+        now = time.time()
+        script = self._script(self.REAP)
+        with self.redis.pipeline(transaction=False) as pipe:
+            for consumer in consumers:
+                consumer = native(consumer)
+                keys = [self.key, self._processing(consumer),
+                    self._deadlines(consumer), self.consumers,
+                    self._leases(consumer)]
+                script(keys=keys, args=[now, batch, consumer], client=pipe)
+            count = sum(pipe.execute())
+        log.debug('Reaped ** %s ** elements for key ** %s **', count, self.key)
+        return count
+
+class StreamQueue(BaseQueue):
+    """
+    A FIFO queue kept in a Redis stream (Redis 5.0+) and read through a
+    consumer group. Each group sees every element once, shared out between
+    its consumers, so several groups can read the same elements without
+    them being pushed more than once. With autoack, the default, elements
+    are acknowledged as they're read, like popping from a Queue. Without
+    it, they stay pending until ack()ed, and pending elements left by a
+    consumer that died can be taken over with reclaim(). Popping doesn't
+    remove elements from the stream, so pass maxlen to cap its length.
+    """
+
+    redis_type = 'stream'
+    length_command = 'XLEN'
+    move_out = move_in = None
+
+    # Take up to ARGV[1] of the oldest entries out of the stream, for dump
+    TAKE = """
+        local entries = redis.call('xrange', KEYS[1], '-', '+', 'COUNT', ARGV[1])
+        local values = {}
+        for i, entry in ipairs(entries) do
+            redis.call('xdel', KEYS[1], entry[1])
+            values[i] = entry[2][2]
+        end
+        return values
+    """
+
+    @staticmethod
+    def all(pattern='*', **kwargs):
+        return BaseQueue.all(StreamQueue, pattern, **kwargs)
+
+    @staticmethod
+    def scan(pattern='*', count=1000, withsizes=False, **kwargs):
+        return BaseQueue.scan(StreamQueue, pattern, count, withsizes, **kwargs)
+
+    def __init__(self, key, group='qr', consumer=None, maxlen=None,
+        approximate=True, autoack=True, timeout=30, **kwargs):
+        if maxlen is not None and kwargs.get('offload') is not None:
+            # Trimming the stream would drop references to payloads
+            raise ValueError("A StreamQueue with a maxlen can't offload")
+        BaseQueue.__init__(self, key, **kwargs)
+        self.group = group
+        self.consumer = consumer or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.maxlen = maxlen
+        self.approximate = approximate
+        self.autoack = autoack
+        self.timeout = timeout
+
+    @instrumented
+    def __len__(self):
+        """Return the number of elements in the stream, read or not"""
+        return self.redis.xlen(self.key)
+
+    def _add(self, client, packed):
+        """Append a packed element, trimming the stream to maxlen"""
+        client.xadd(self.key, {'v': packed}, maxlen=self.maxlen,
+            approximate=self.approximate)
+
+    def _entries(self, entries):
+        """Unpack (id, fields) stream entries into (id, element) pairs"""
+        entries = [(native(id), fields[b'v']) for id, fields in entries if fields]
+        return list(zip([id for id, value in entries],
+            self._unpack_many([value for id, value in entries])))
+
+    def _create(self):
+        """Create the consumer group, reading from the start of the stream"""
+        try:
+            self.redis.xgroup_create(self.key, self.group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def _readgroup(self, n, block=False, timeout=None, retry=True):
+        """Read up to n new (id, element) pairs as this consumer"""
+        if n <= 0:
+            return []
+        # BLOCK takes milliseconds, and 0 waits forever
+        ms = None
+        if block:
+            ms = timeout and max(1, int(timeout * 1000)) or 0
+        try:
+            result = self.redis.xreadgroup(self.group, self.consumer,
+                {self.key: '>'}, count=n, block=ms, noack=self.autoack)
+        except redis.ResponseError:
+            # Most likely there's no group yet, so make it and try again
+            if not retry:
+                raise
+            self._create()
+            return self._readgroup(n, block, timeout, False)
+        if not result:
+            return []
+        popped = self._entries(result[0][1])
+        log.debug('Popped ** %s ** from key ** %s **', popped, self.key)
+        return popped
+
+    def _take(self, n):
+        return self._script(self.TAKE)(keys=[self.key], args=[n], client=self.redis)
+
+    def _put(self, pipe, records):
+        for record in records:
+            self._add(pipe, record)
+
+    @instrumented
+    def push(self, element):
+        """Push an element"""
+        self._add(self.redis, self._pack(element))
+        log.debug('Pushed ** %s ** for key ** %s **', element, self.key)
+
+    @instrumented
+    def extend(self, vals):
+        """Push a collection of elements in one round trip"""
+        self._load([self._pack(val) for val in vals])
+
+    @instrumented
+    def pop(self, block=False, timeout=None, withid=False):
+        """Pop the next element for this group, as (id, element) if withid"""
+        popped = self._readgroup(1, block, timeout)
+        if popped:
+            return withid and popped[0] or popped[0][1]
+        return withid and (None, None) or None
+
+    @instrumented
+    def pop_many(self, n, block=False, timeout=None, withids=False):
+        """
+        Pop up to n elements for this group in one round trip, as (id,
+        element) pairs if withids. When blocking, wait for at most timeout
+        seconds (forever if it's None) for the first one.
+        """
+        popped = self._readgroup(n, block, timeout)
+        if withids:
+            return popped
+        return [element for id, element in popped]
+
+    @instrumented
+    def ack(self, *ids):
+        """Acknowledge popped elements by id, returning how many were pending"""
+        if not ids:
+            return 0
+        return self.redis.xack(self.key, self.group, *ids)
+
+    def pending(self):
+        """Return the number of elements this group hasn't acknowledged"""
+        try:
+            return self.redis.xpending(self.key, self.group)['pending']
+        except redis.ResponseError:
+            return 0
+
+    @instrumented
+    def reclaim(self, idle=None, count=100):
+        """
+        Take over up to count elements that have been pending for another
+        consumer for at least idle seconds (the timeout, by default), and
+        return them as (id, element) pairs, now pending for this consumer.
+        Needs Redis 6.2 or better.
+        """
+        if idle is None:
+            idle = self.timeout
+        idle = int(idle * 1000)
+        claimed, start = [], '0-0'
+        while len(claimed) < count:
+            result = self.redis.xautoclaim(self.key, self.group, self.consumer,
+                idle, start_id=start, count=count - len(claimed))
+            start, entries = native(result[0]), result[1]
+            claimed.extend(self._entries(entries))
+            if start == '0-0':
+                break
+        log.debug('Reclaimed ** %s ** from key ** %s **', claimed, self.key)
+        return claimed
+
+    @instrumented
+    def peek(self):
+        """Look at the oldest element in the stream"""
+        entries = self.redis.xrange(self.key, count=1)
+        if entries:
+            return self._entries(entries)[0][1]
+        return None
+
+    @instrumented
+    def elements(self):
+        """Return all elements in the stream as a Python list"""
+        return [element for id, element in self._entries(self.redis.xrange(self.key))]
+
+    def _batch_peek(self, pipe):
+        pipe.xrange(self.key, count=1)
+        return lambda replies: replies[-1] and replies[-1][0][1][b'v'] or None
+
+    def _pages(self, page_size):
+        start = '-'
+        while True:
+            entries = self.redis.xrange(self.key, start, count=page_size)
+            if entries:
+                yield [element for id, element in self._entries(entries)]
+            if len(entries) < page_size:
+                return
+            # Carry on just after the last entry
+            ms, seq = native(entries[-1][0]).split('-')
+            start = '%s-%d' % (ms, int(seq) + 1)
+
+class MultiQueue(object):
+    """
+    Consumes from several queues on the same Redis server at once, so one
+    consumer can serve many (say, per-tenant) queues without an idle loop
+    per key. Without weights, queues are served in strict priority order:
+    an element is only taken from a queue when every queue before it is
+    empty. With weights, queues are served by smooth weighted round-robin,
+    each getting a share of pops proportional to its weight, while pops
+    that a queue can't use go to the others rather than being wasted.
+    """
+
+    # Pop up to ARGV[1] elements across KEYS, taking at most ARGV[i + 1]
+    # from KEYS[i] on a first pass, and then filling up from the keys in
+    # order. Returns the index of the key and the element for each pop.
+    POP = """
+        local n = tonumber(ARGV[1])
+        local count = 0
+        local popped = {}
+        for pass = 1, 2 do
+            for i, key in ipairs(KEYS) do
+                local quota = n - count
+                if pass == 1 then
+                    quota = math.min(quota, tonumber(ARGV[i + 1]))
+                end
+                while quota > 0 do
+                    local value = redis.call('rpop', key)
+                    if not value then
+                        break
+                    end
+                    popped[#popped + 1] = i
+                    popped[#popped + 1] = value
+                    count = count + 1
+                    quota = quota - 1
+                end
+            end
+        end
+        return popped
+    """
+
+    def __init__(self, queues, weights=None):
+        self.queues = []
+        self.weights = None
+        self.redis = None
+        if weights is not None:
+            self.weights = []
+            self.current = []
+        for index, queue in enumerate(queues):
+            self.add(queue, weights[index] if weights else 1)
+
+    def __len__(self):
+        """Return the total length of the queues"""
+        with self.redis.pipeline(transaction=False) as pipe:
+            for queue in self.queues:
+                pipe.llen(queue.key)
+            return sum(pipe.execute())
+
+    def add(self, queue, weight=1):
+        """Start consuming from another queue"""
+        if not isinstance(queue, (Queue, CappedCollection)):
+            raise ValueError('MultiQueue only consumes from FIFO queues')
+        if queue.packed:
+            # Its list elements are chunks, not elements
+            raise ValueError("MultiQueue can't consume from a packed queue")
+        if isinstance(queue, UniqueQueue):
+            # Popping has to forget the element's fingerprint too
+            raise ValueError("MultiQueue can't consume from a UniqueQueue")
+        if self.redis is None:
+            self.redis = queue.redis
+        elif queue.redis.connection_pool is not self.redis.connection_pool:
+            raise ValueError('Queues must all use the same Redis connection')
+        self.queues.append(queue)
+        if self.weights is not None:
+            self.weights.append(weight)
+            self.current.append(0)
+
+    def remove(self, key):
+        """Stop consuming from the queue with the given key"""
+        for index, queue in enumerate(self.queues):
+            if queue.key == key:
+                del self.queues[index]
+                if self.weights is not None:
+                    del self.weights[index]
+                    del self.current[index]
+                return True
+        return False
+
+    def _schedule(self, n):
+        """
+        Return the order in which to try the queues, and the most to take
+        from each on a first pass, for a pop of n elements.
+        """
+        count = len(self.queues)
+        if self.weights is None:
+            return list(range(count)), [n] * count
+        total = sum(self.weights)
+        quotas = [0] * count
+        order = []
+        for pick in range(n):
+            for index, weight in enumerate(self.weights):
+                self.current[index] += weight
+            best = max(range(count), key=self.current.__getitem__)
+            self.current[best] -= total
+            if not quotas[best]:
+                order.append(best)
+            quotas[best] += 1
+        # Anything that didn't get a pick is tried last, most due first
+        rest = sorted((i for i in range(count) if not quotas[i]),
+            key=self.current.__getitem__, reverse=True)
+        return order + rest, quotas
+
+    def _pop_many(self, n, block=False, timeout=None):
+        """Pop up to n (queue, raw element) pairs"""
+        if n <= 0 or not self.queues:
+            return []
+        order, quotas = self._schedule(n)
+        queues = [self.queues[i] for i in order]
+        keys = [queue.key for queue in queues]
+        results = getScript(self.redis, self.POP)(keys=keys, client=self.redis,
+            args=[n] + [quotas[i] for i in order])
+        popped = [(queues[results[i] - 1], results[i + 1])
+            for i in range(0, len(results), 2)]
+        if not popped and block:
+            result = self.redis.brpop(keys, timeout or 0)
+            if result is None:
+                return []
+            key, value = result
+            queue = queues[keys.index(native(key))]
+            popped = [(queue, value)] + self._pop_many(n - 1)
+        log.debug('Popped ** %s ** from keys ** %s **', popped, keys)
+        return popped
+
+    def pop(self, block=False, timeout=None, withkey=False):
+        """Pop the next element, as (key, element) if withkey"""
+        popped = self.pop_many(1, block, timeout, withkey)
+        if popped:
+            return popped[0]
+        elif withkey:
+            return (None, None)
+        return None
+
+    def pop_many(self, n, block=False, timeout=None, withkey=False):
+        """Pop up to n elements, as (key, element) pairs if withkey"""
+        popped = [(queue.key, queue._unpack(value, True))
+            for queue, value in self._pop_many(n, block, timeout)]
+        if withkey:
+            return popped
+        return [value for key, value in popped]
+
+class PriorityQueue(BaseQueue):
+    """A priority queue"""
+
+    redis_type = 'zset'
+    length_command = 'ZCARD'
+    boundable = True
+    move_out = 'zmin'
+    move_in = 'zadd'
+
+    @staticmethod
+    def all(pattern='*', **kwargs):
+        return BaseQueue.all(PriorityQueue, pattern, **kwargs)
+
+    @staticmethod
+    def scan(pattern='*', count=1000, withsizes=False, **kwargs):
+        return BaseQueue.scan(PriorityQueue, pattern, count, withsizes, **kwargs)
+
+    @instrumented
+    def __len__(self):
+        """Return the length of the queue"""
+        return self.redis.zcard(self.key)
     
-    def dumpfname(self, fname, truncate=False):
-        """Destructively dump the contents of the queue into fname"""
-        if truncate:
-            with file(fname, 'w+') as f:
-                self.dump(f)
-        else:
-            with file(fname, 'a+') as f:
-                self.dump(f)
+    @instrumented
+    def __getitem__(self, val):
+        """Get a slice or a particular index."""
+        try:
+            return self._unpack_many(self.redis.zrange(self.key, val.start, val.stop - 1))
+        except AttributeError:
+            val = self.redis.zrange(self.key, val, val)
+            if val:
+                return self._unpack(val[0])
+            return None
+        except Exception as e:
+            log.error('Get item failed ** %s', repr(e))
+            return None
     
-    def loadfname(self, fname):
-        """Load the contents of the contents of fname into the queue"""
-        with file(fname) as f:
-            self.load(f)
+    def _take(self, n):
+        """Destructively take up to n (raw element, score) records"""
+        with self.redis.pipeline() as pipe:
+            pipe.zrange(self.key, 0, n - 1, withscores=True)
+            pipe.zremrangebyrank(self.key, 0, n - 1)
+            records, count = pipe.execute()
+        return records
+
+    def _put(self, pipe, records):
+        """Queue up the commands to load (raw element, score) records"""
+        if self.maxlen is not None:
+            self._fit(pipe, records)
+            return self._fitted(records)
+        args = []
+        for value, score in records:
+            args.extend((score, value))
+        pipe.execute_command('ZADD', self.key, *args)
+
+    def _record(self, value, score):
+        """Pack an element and its score into a raw record for _put"""
+        return (self._pack(value), score)
+
+    def _stored(self, record):
+        return record[0]
+
+    def _restore(self, record, stored):
+        return (stored, record[1])
+
+    def _write(self, fobj, records, format):
+        """Write (raw element, score) records in the given format"""
+        if format == 'lines':
+            fobj.write(b''.join(repr(float(score)).encode('ascii') + b' ' +
+                base64.b64encode(value) + b'\n' for value, score in records))
+        elif format == 'length':
+            fobj.write(b''.join(struct.pack('>dI', score, len(value)) + value
+                for value, score in records))
+        else:
+            raise ValueError('Unknown dump format %r' % format)
+
+    def _read(self, fobj, format):
+        """Generate the (raw element, score) records in fobj"""
+        if format == 'lines':
+            for line in fobj:
+                line = line.strip()
+                if line:
+                    score, value = line.split(b' ', 1)
+                    yield (base64.b64decode(value), float(score))
+        elif format == 'length':
+            while True:
+                header = fobj.read(12)
+                if not header:
+                    return
+                score, length = struct.unpack('>dI', self._exactly(header, 12))
+                yield (self._exactly(fobj.read(length), length), score)
+        else:
+            raise ValueError('Unknown dump format %r' % format)
     
+    @instrumented
     def extend(self, vals):
-        """Extends the elements in the queue."""
+        """
+        Extends the elements in the queue. With a maxlen, returns how many
+        of them went in.
+        """
+        if self.maxlen is not None:
+            return self._bound([self._record(val, score) for val, score in vals])
         with self.redis.pipeline(transaction=False) as pipe:
             for val, score in vals:
-                pipe.zadd(self.key, self._pack(val), score)
+                # ZADD's arguments differ between redis-py versions, so
+                # the command is sent as-is
+                pipe.execute_command('ZADD', self.key, score, self._pack(val))
             return pipe.execute()
 
-    def peek(self, withscores=False):
-        """Look at the next item in the queue"""
-        val = self.redis.zrange(self.key, 0, 0, withscores=True)
-        if val:
-            value, score = val[0]
-            value = self._unpack(value)
+    # Add the ARGV[4...] score and member pairs to zset KEYS[1], keeping it
+    # to ARGV[1] members. With ARGV[2] 'drop', the members that would be
+    # popped last, those with the highest scores, make room; otherwise
+    # pairs are added until a new member doesn't fit. Returns how many
+    # were added, followed by the dropped members that start with ARGV[3],
+    # if it's not empty.
+    BOUND = """
+        local maxlen = tonumber(ARGV[1])
+        local room = maxlen - redis.call('zcard', KEYS[1])
+        local added = 0
+        for i = 4, #ARGV, 2 do
+            if ARGV[2] ~= 'drop' and not redis.call('zscore', KEYS[1], ARGV[i + 1]) then
+                if room <= 0 then
+                    break
+                end
+                room = room - 1
+            end
+            redis.call('zadd', KEYS[1], ARGV[i], ARGV[i + 1])
+            added = added + 1
+        end
+        local results = {added}
+        local excess = redis.call('zcard', KEYS[1]) - maxlen
+        if ARGV[2] ~= 'drop' or excess <= 0 then
+            return results
+        end
+        if ARGV[3] ~= '' then
+            for _, dropped in ipairs(redis.call('zrange', KEYS[1], -excess, -1)) do
+                if string.sub(dropped, 1, #ARGV[3]) == ARGV[3] then
+                    results[#results + 1] = dropped
+                end
+            end
+        end
+        redis.call('zremrangebyrank', KEYS[1], -excess, -1)
+        return results
+    """
+
+    def _fit(self, client, records, command=None):
+        """Add as many (raw element, score) records as fit, in one script call"""
+        marker = b''
+        if self.offload is not None:
+            marker = refMarker
+        args = [self.maxlen, self.overflow, marker]
+        for value, score in records:
+            args.extend((score, value))
+        return self._script(self.BOUND)(keys=[self.key], args=args, client=client)
+
+    def _zpeek(self, n, highest=False):
+        """Return up to n (value, score) pairs from one end of the zset"""
+        if n <= 0:
+            return []
+        if highest:
+            results = self.redis.zrevrange(self.key, 0, n - 1, withscores=True)
+        else:
+            results = self.redis.zrange(self.key, 0, n - 1, withscores=True)
+        return list(zip(self._unpack_many([value for value, score in results]),
+            [score for value, score in results]))
+
+    def _zpop(self, n, block=False, timeout=None, highest=False):
+        """
+        Atomically pop up to n (value, score) pairs from one end of the
+        zset. The range read and the removal go out in one MULTI/EXEC, so
+        this is a single round trip. When blocking on an empty queue,
+        the server is left to wait for the first element (BZPOPMIN or
+        BZPOPMAX, Redis 5.0+), after which anything else available is
+        taken as well.
+        """
+        if n <= 0:
+            return []
+        with self.redis.pipeline() as pipe:
+            if highest:
+                pipe.zrevrange(self.key, 0, n - 1, withscores=True)
+                pipe.zremrangebyrank(self.key, -n, -1)
+            else:
+                pipe.zrange(self.key, 0, n - 1, withscores=True)
+                pipe.zremrangebyrank(self.key, 0, n - 1)
+            results, count = pipe.execute()
+        if not results and block:
+            command = highest and 'BZPOPMAX' or 'BZPOPMIN'
+            result = self.redis.execute_command(command, self.key, timeout or 0)
+            if not result:
+                return []
+            key, value, score = result
+            return [(self._unpack(value, True), float(score))] + self._zpop(
+                n - 1, highest=highest)
+        log.debug('Popped ** %s ** from key ** %s **', results, self.key)
+        return list(zip(self._unpack_many([value for value, score in results], True),
+            [score for value, score in results]))
+
+    def _first(self, results, withscores):
+        """Shape the head of a list of (value, score) pairs like pop does"""
+        if results:
+            value, score = results[0]
             if withscores:
                 return (value, score)
             return value
@@ -288,84 +2808,1087 @@ class PriorityQueue(BaseQueue):
             return (None, 0.0)
         return None
 
+    def _many(self, results, withscores):
+        """Shape a list of (value, score) pairs like pop_many does"""
+        if withscores:
+            return results
+        return [value for value, score in results]
+
+    @instrumented
+    def peek(self, withscores=False):
+        """Look at the next item in the queue"""
+        return self._first(self._zpeek(1), withscores)
+
+    @instrumented
+    def peek_many(self, n, withscores=False):
+        """Look at the n elements with the lowest scores"""
+        return self._many(self._zpeek(n), withscores)
+
+    @instrumented
+    def peek_max(self, withscores=False):
+        """Look at the element with the highest score"""
+        return self._first(self._zpeek(1, highest=True), withscores)
+
+    @instrumented
     def elements(self):
         """Return all elements as a Python list"""
-        return [self._unpack(o) for o in self.redis.zrange(self.key, 0, -1)]
+        return self._unpack_many(self.redis.zrange(self.key, 0, -1))
+
+    def _pages(self, page_size, withscores=False):
+        """Generate the elements, lowest score first, page_size per round trip"""
+        start = 0
+        while True:
+            page = self.redis.zrange(self.key, start, start + page_size - 1,
+                withscores=withscores)
+            if page and withscores:
+                yield list(zip(self._unpack_many([v for v, score in page]),
+                    [score for v, score in page]))
+            elif page:
+                yield self._unpack_many(page)
+            if len(page) < page_size:
+                return
+            start += page_size
 
-    def pop(self, withscores=False):
+    @instrumented
+    def pop(self, withscores=False, block=False, timeout=None):
         """Get the element with the lowest score, and pop it off"""
-        with self.redis.pipeline() as pipe:
-            o = pipe.zrange(self.key, 0, 0, withscores=True)
-            o = pipe.zremrangebyrank(self.key, 0, 0)
-            results, count = pipe.execute()
-            if results:
-                value, score = results[0]
-                value = self._unpack(value)
-                if withscores:
-                    return (value, score)
-                return value
-            elif withscores:
-                return (None, 0.0)
-            return None
+        return self._first(self._zpop(1, block, timeout), withscores)
+
+    @instrumented
+    def pop_many(self, n, withscores=False, block=False, timeout=None):
+        """Pop up to n elements with the lowest scores, lowest first"""
+        return self._many(self._zpop(n, block, timeout), withscores)
+
+    @instrumented
+    def pop_max(self, withscores=False, block=False, timeout=None):
+        """Get the element with the highest score, and pop it off"""
+        return self._first(
+            self._zpop(1, block, timeout, highest=True), withscores)
+
+    @instrumented
+    def pop_max_many(self, n, withscores=False, block=False, timeout=None):
+        """Pop up to n elements with the highest scores, highest first"""
+        return self._many(
+            self._zpop(n, block, timeout, highest=True), withscores)
+
+    def _batch_pop(self, pipe):
+        pipe.execute_command('ZPOPMIN', self.key)
+        return headReply
+
+    def _batch_peek(self, pipe):
+        pipe.zrange(self.key, 0, 0)
+        return headReply
     
+    @instrumented
     def push(self, value, score):
         '''Add an element with a given score'''
-        return self.redis.zadd(self.key, self._pack(value), score)
+        if self.maxlen is not None:
+            return self._push_one(self._record(value, score))
+        return self.redis.execute_command('ZADD', self.key, score, self._pack(value))
+
+class DelayedQueue(PriorityQueue):
+    """
+    Schedules elements to become available at a later time. Elements are
+    held in a sorted set scored by the time they're due, and are moved in
+    bulk, server-side and still serialized, onto a target Queue once
+    they're due, which is where consumers pop them from. A blocking pop
+    sleeps on the server until the next element is due, an element
+    arrives on the target, or a push wakes it up through a wake-up list,
+    for at most poll seconds at a time. As in any priority queue, equal
+    elements are only scheduled once.
+    """
+
+    # Due elements move server-side, so nothing would bound the target
+    boundable = False
+
+    # The longest a blocking pop sleeps before looking for due elements
+    # again, in case it missed a wake-up
+    poll = 1
+
+    # Move up to ARGV[2] elements due by ARGV[1] onto the target queue,
+    # earliest first, a slice of them per command to stay inside Lua's
+    # stack
+    MOVE = """
+        local due = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1],
+            'LIMIT', 0, ARGV[2])
+        for first = 1, #due, 1000 do
+            local last = math.min(first + 999, #due)
+            redis.call('lpush', KEYS[2], unpack(due, first, last))
+            redis.call('zrem', KEYS[1], unpack(due, first, last))
+        end
+        return #due
+    """
+
+    @staticmethod
+    def all(pattern='*', **kwargs):
+        return BaseQueue.all(DelayedQueue, pattern, **kwargs)
+
+    @staticmethod
+    def scan(pattern='*', count=1000, withsizes=False, **kwargs):
+        return BaseQueue.scan(DelayedQueue, pattern, count, withsizes, **kwargs)
+
+    def __init__(self, key, target=None, **kwargs):
+        PriorityQueue.__init__(self, key, **kwargs)
+        if target is None:
+            target = '%s:ready' % key
+        if not isinstance(target, Queue):
+            target = Queue(target, **kwargs)
+        self.target = target
+        self.wake = '%s:wake' % key
+
+    def _record(self, element, delay=0, when=None):
+        """Pack an element and its due time into a raw record for _put"""
+        if when is None:
+            when = time.time() + delay
+        return (self._pack(element), when)
+
+    def _put(self, pipe, records):
+        """Queue up scheduling (raw element, due time) records, and a wake-up"""
+        PriorityQueue._put(self, pipe, records)
+        # The wake-up list never holds more than one token
+        pipe.lpush(self.wake, 1)
+        pipe.ltrim(self.wake, 0, 0)
+
+    @instrumented
+    def push(self, element, delay=0, when=None):
+        """Schedule an element for delay seconds from now, or for when"""
+        with self.redis.pipeline(transaction=False) as pipe:
+            self._put(pipe, [self._record(element, delay, when)])
+            return pipe.execute()[0]
+
+    @instrumented
+    def extend(self, vals):
+        """Schedule (element, when) pairs, when being a Unix timestamp"""
+        records = [self._record(val, when=when) for val, when in vals]
+        if records:
+            self._load(records)
+
+    def _batch_pop(self, pipe):
+        raise TypeError("DelayedQueue can't pop in a batch")
+
+    @instrumented
+    def move_due(self, now=None, chunk=1000):
+        """
+        Move every element that's due onto the target queue, chunk at a
+        time, and return how many were moved. Elements never leave the
+        server.
+        """
+        if now is None:
+            now = time.time()
+        moved, script = 0, self._script(self.MOVE)
+        while True:
+            count = script(keys=[self.key, self.target.key],
+                args=[repr(float(now)), chunk], client=self.redis)
+            moved += count
+            if count < chunk:
+                break
+        if moved:
+            log.debug('Moved ** %s ** due elements from key ** %s **', moved, self.key)
+        return moved
+
+    def next_due(self):
+        """Return when the next element is due, or None if there isn't one"""
+        results = self.redis.zrange(self.key, 0, 0, withscores=True)
+        if results:
+            return results[0][1]
+        return None
+
+    @instrumented
+    def pop(self, block=False, timeout=None):
+        """Pop the next element that's due"""
+        popped = self.pop_many(1, block, timeout)
+        if popped:
+            return popped[0]
+        return None
+
+    @instrumented
+    def pop_many(self, n, block=False, timeout=None):
+        """
+        Pop up to n elements that are due, earliest first. When blocking,
+        wait for at most timeout seconds (forever if it's None).
+        """
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout
+        while True:
+            self.move_due()
+            popped = self.target.pop_many(n)
+            if popped or not block:
+                return popped
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                return []
+            # Sleep on the server until an element arrives on the target,
+            # a push wakes us, the next element is due or the deadline
+            # passes. Redis takes fractions of a second (from 6.0), and a
+            # timeout of 0 would be forever.
+            wait = [t - now for t in (self.next_due(), deadline) if t is not None]
+            wait = max(0.01, min(wait + [self.poll]))
+            result = self.redis.brpop([self.target.key, self.wake], wait)
+            if result is not None and native(result[0]) == self.target.key:
+                return [self.target._unpack(result[1], True)] + self.target.pop_many(n - 1)
+
+    @instrumented
+    def clear(self):
+        """Removes all the scheduled elements"""
+        if self.offload is not None:
+            self._drop_all()
+        self.redis.delete(self.key, self.wake)
+
+class BucketPriorityQueue(BaseQueue):
+    """
+    A priority queue for a small range of integer priorities, from 0 to
+    levels - 1, keeping one list per priority under key:<priority>.
+    Elements with the highest priority are popped first, and elements
+    with the same priority in the order they were pushed. Pushes and pops
+    are O(1), and lists take far less memory than a sorted set.
+    """
+
+    # Elements are spread over a list per level
+    move_out = move_in = None
+
+    # Pop up to ARGV[1] elements from KEYS, which run from the highest
+    # priority down, returning the index of the key and the element for
+    # each pop
+    POP = """
+        local n = tonumber(ARGV[1])
+        local popped = {}
+        for i, key in ipairs(KEYS) do
+            while #popped < 2 * n do
+                local value = redis.call('rpop', key)
+                if not value then
+                    break
+                end
+                popped[#popped + 1] = i
+                popped[#popped + 1] = value
+            end
+            if #popped >= 2 * n then
+                break
+            end
+        end
+        return popped
+    """
+
+    # Find the next element in KEYS, which run from the highest priority
+    # down, returning the index of its key and the element
+    PEEK = """
+        for i, key in ipairs(KEYS) do
+            local value = redis.call('lindex', key, -1)
+            if value then
+                return {i, value}
+            end
+        end
+        return {}
+    """
+
+    @staticmethod
+    def all(pattern='*', **kwargs):
+        return list(BucketPriorityQueue.scan(pattern, **kwargs))
+
+    @staticmethod
+    def scan(pattern='*', count=1000, withsizes=False, **kwargs):
+        """
+        Lazily generate a BucketPriorityQueue for every key matching pattern
+        with a list for any priority, as (queue, length) pairs if withsizes.
+        Queues are found by their lists, key:<priority>, so pass levels if
+        they don't have the default number.
+        """
+        r = getRedis(**dict((k, v) for k, v in kwargs.items()
+            if k not in structureOptions))
+        seen = set()
+        cursor = 0
+        while True:
+            cursor, buckets = r.scan(cursor, match='%s:[0-9]*' % pattern, count=count)
+            buckets = [native(bucket) for bucket in buckets]
+            buckets = [bucket for bucket in buckets
+                if bucket.rpartition(':')[2].isdigit()]
+            if buckets:
+                with r.pipeline(transaction=False) as pipe:
+                    for bucket in buckets:
+                        pipe.type(bucket)
+                    types = pipe.execute()
+                buckets = [bucket for bucket, kind in zip(buckets, types)
+                    if native(kind) == 'list']
+            queues = []
+            for bucket in buckets:
+                key = bucket.rpartition(':')[0]
+                if key not in seen:
+                    seen.add(key)
+                    queues.append(BucketPriorityQueue(key, **kwargs))
+            for queue in queues:
+                if withsizes:
+                    yield (queue, len(queue))
+                else:
+                    yield queue
+            if int(cursor) == 0:
+                break
+
+    # Records are (element, priority) pairs, written like a PriorityQueue's
+    _write = PriorityQueue.__dict__['_write']
+    _read = PriorityQueue.__dict__['_read']
+    _stored = PriorityQueue.__dict__['_stored']
+    _restore = PriorityQueue.__dict__['_restore']
+
+    def __init__(self, key, levels=10, **kwargs):
+        BaseQueue.__init__(self, key, **kwargs)
+        self.levels = levels
+        # Highest priority first
+        self.buckets = ['%s:%d' % (key, level) for level in reversed(range(levels))]
+
+    def _bucket(self, priority):
+        """The key of the list for the given priority"""
+        if not 0 <= priority < self.levels:
+            raise ValueError('Priorities run from 0 to %d' % (self.levels - 1))
+        return self.buckets[self.levels - 1 - int(priority)]
+
+    @instrumented
+    def __len__(self):
+        """Return the number of elements, at every priority"""
+        with self.redis.pipeline(transaction=False) as pipe:
+            for bucket in self.buckets:
+                pipe.llen(bucket)
+            return sum(pipe.execute())
+
+    def _record(self, element, priority=0):
+        """Pack an element and its priority into a raw record for _put"""
+        self._bucket(priority)
+        return (self._pack(element), priority)
+
+    def _put(self, pipe, records):
+        for value, priority in records:
+            pipe.lpush(self._bucket(priority), value)
+
+    def _take(self, n):
+        return [(value, self.levels - index) for index, value in self._pop_levels(n)]
+
+    def _pop_levels(self, n):
+        """Pop up to n (key index, raw element) pairs, highest priority first"""
+        if n <= 0:
+            return []
+        results = self._script(self.POP)(keys=self.buckets, args=[n],
+            client=self.redis)
+        return [(results[i], results[i + 1]) for i in range(0, len(results), 2)]
+
+    @instrumented
+    def push(self, element, priority=0):
+        """Push an element with the given priority"""
+        self.redis.lpush(self._bucket(priority), self._pack(element))
+        log.debug('Pushed ** %s ** for key ** %s **', element, self.key)
+
+    @instrumented
+    def extend(self, vals):
+        """Push a collection of (element, priority) pairs in one round trip"""
+        self._load([self._record(val, priority) for val, priority in vals])
+
+    @instrumented
+    def pop(self, block=False, timeout=None):
+        """Pop the oldest element with the highest priority"""
+        popped = self.pop_many(1, block, timeout)
+        if popped:
+            return popped[0]
+        return None
+
+    @instrumented
+    def pop_many(self, n, block=False, timeout=None):
+        """
+        Pop up to n elements, highest priority first, in one round trip.
+        When blocking on an empty queue, wait for at most timeout seconds
+        (forever if it's None) for the first element, and then take
+        whatever else is available.
+        """
+        if n <= 0:
+            return []
+        popped = [value for index, value in self._pop_levels(n)]
+        if not popped and block:
+            # BRPOP takes from the first of its keys that isn't empty
+            result = self.redis.brpop(self.buckets, timeout or 0)
+            if result is None:
+                return []
+            popped = [result[1]] + [value for index, value in self._pop_levels(n - 1)]
+        log.debug('Popped ** %s ** from key ** %s **', popped, self.key)
+        return self._unpack_many(popped, True)
+
+    @instrumented
+    def peek(self):
+        """Look at the next element to be popped"""
+        result = self._script(self.PEEK)(keys=self.buckets, client=self.redis)
+        if result:
+            return self._unpack(result[1])
+        return None
+
+    @instrumented
+    def elements(self):
+        """Return all elements in the order they'd be popped"""
+        with self.redis.pipeline(transaction=False) as pipe:
+            for bucket in self.buckets:
+                pipe.lrange(bucket, 0, -1)
+            buckets = pipe.execute()
+        return self._unpack_many([value for bucket in buckets
+            for value in reversed(bucket)])
+
+    def _pages(self, page_size):
+        """Generate the elements in pop order, a page per round trip"""
+        for bucket in self.buckets:
+            start = 0
+            while True:
+                # The oldest elements are at the tail of each list
+                page = self.redis.lrange(bucket, -start - page_size, -start - 1)
+                if page:
+                    yield self._unpack_many(reversed(page))
+                if len(page) < page_size:
+                    break
+                start += page_size
+
+    @instrumented
+    def clear(self):
+        """Removes all the elements in the queue"""
+        if self.offload is not None:
+            self._drop_all()
+        self.redis.delete(*self.buckets)
+
+    def _batch_pop(self, pipe):
+        self._script(self.POP)(keys=self.buckets, args=[1], client=pipe)
+        return lambda replies: replies[-1] and replies[-1][1] or None
+
+    def _batch_peek(self, pipe):
+        self._script(self.PEEK)(keys=self.buckets, client=pipe)
+        return lambda replies: replies[-1] and replies[-1][1] or None
+
+    def _batch_len(self, pipe):
+        for bucket in self.buckets:
+            pipe.llen(bucket)
+        return sum
+
+class ShardedQueue(object):
+    """
+    One logical FIFO queue spread over several Redis servers, so that its
+    throughput grows with the number of servers. shards is a list of
+    connection keyword arguments, as any structure takes, and the same
+    key is used on each. Producers place elements round-robin, or by a
+    hash of the serialized element. Consumers drain the shards fairly,
+    starting from a different shard each time. Order is only kept within
+    a shard. Since a blocking pop can't wait on several servers at once,
+    it waits on each shard in turn for up to poll seconds.
+    """
+
+    cls = Queue
+    placements = ('roundrobin', 'hash')
+
+    def __init__(self, key, shards, placement='roundrobin', poll=1, **kwargs):
+        if placement not in self.placements:
+            raise ValueError('Unknown placement %r' % placement)
+        if not shards:
+            raise ValueError('A sharded queue needs at least one shard')
+        self.key = key
+        self.placement = placement
+        self.poll = poll
+        self.shards = [self.cls(key, **dict(kwargs, **config)) for config in shards]
+        # Producers start at a random shard, so they don't all pile onto
+        # the first one
+        self.cursor = random.randrange(len(self.shards))
+
+    def __len__(self):
+        """Return the total length of the shards"""
+        return sum(len(shard) for shard in self.shards)
+
+    def _place(self, record):
+        """Return the index of the shard a raw record goes to"""
+        if self.placement == 'hash':
+            return (zlib.crc32(self._raw(record)) & 0xffffffff) % len(self.shards)
+        self.cursor = (self.cursor + 1) % len(self.shards)
+        return self.cursor
+
+    def _raw(self, record):
+        """The serialized element in a raw record"""
+        return record
+
+    def _rotation(self):
+        """The shards in the order to try them, advancing the rotation"""
+        self.cursor = (self.cursor + 1) % len(self.shards)
+        return self.shards[self.cursor:] + self.shards[:self.cursor]
+
+    def _offload(self, shard, record):
+        """Offload a serialized record's payload to the shard it's placed on"""
+        return shard._offload(record)
+
+    def _extend(self, records):
+        """Load serialized records, grouped into one pipeline per shard"""
+        placed = {}
+        for record in records:
+            placed.setdefault(self._place(record), []).append(record)
+        for index, group in placed.items():
+            shard = self.shards[index]
+            shard._load([self._offload(shard, record) for record in group])
+        return len(records)
+
+    @instrumented
+    def push(self, element):
+        """Push an element onto one of the shards"""
+        self._extend([self.shards[0]._dumps(element)])
+
+    @instrumented
+    def extend(self, elements):
+        """Push a collection of elements, one round trip per shard"""
+        return self._extend([self.shards[0]._dumps(e) for e in elements])
+
+    @instrumented
+    def pop(self, block=False, timeout=None):
+        """Pop an element from the next non-empty shard"""
+        popped = self.pop_many(1, block, timeout)
+        if popped:
+            return popped[0]
+        return None
+
+    @instrumented
+    def pop_many(self, n, block=False, timeout=None):
+        """
+        Pop up to n elements, taking from each shard in turn until there
+        are n. When blocking, wait for at most timeout seconds (forever if
+        it's None).
+        """
+        popped = self._take(n)
+        if popped or not block:
+            return popped
+        return self._wait(n, timeout)
+
+    def _take(self, n):
+        """Pop up to n elements without blocking, from each shard in turn"""
+        popped = []
+        for shard in self._rotation():
+            if len(popped) >= n:
+                break
+            popped.extend(shard.pop_many(n - len(popped)))
+        return popped
+
+    def _wait(self, n, timeout=None):
+        """Block on each shard in turn until one has elements to pop"""
+        deadline = timeout and time.time() + timeout
+        while True:
+            for shard in self._rotation():
+                wait = self.poll
+                if deadline:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        return []
+                # Redis takes fractions of a second (from 6.0), and a
+                # timeout of 0 would be forever
+                popped = shard.pop_many(n, block=True, timeout=max(0.01, wait))
+                if popped:
+                    return popped
+
+    def clear(self):
+        """Clear every shard"""
+        for shard in self.shards:
+            shard.clear()
+
+class ShardedPriorityQueue(ShardedQueue):
+    """
+    One logical priority queue spread over several Redis servers. Unlike
+    ShardedQueue, elements are placed by a hash of the serialized element
+    by default, so that pushing the same element again updates its score
+    rather than adding a copy on another shard. pop_many takes the lowest
+    scores across all of the shards, though the order is only approximate
+    while other consumers are popping at the same time.
+    """
+
+    cls = PriorityQueue
+
+    def __init__(self, key, shards, placement='hash', poll=1, **kwargs):
+        ShardedQueue.__init__(self, key, shards, placement, poll, **kwargs)
+
+    def _raw(self, record):
+        return record[0]
+
+    def _offload(self, shard, record):
+        return (shard._offload(record[0]), record[1])
+
+    @instrumented
+    def push(self, value, score):
+        """Push a value with a score onto one of the shards"""
+        self._extend([(self.shards[0]._dumps(value), score)])
+
+    @instrumented
+    def extend(self, vals):
+        """Push a collection of (value, score) pairs, one round trip per shard"""
+        return self._extend([(self.shards[0]._dumps(v), s) for v, s in vals])
+
+    def _take(self, n):
+        """
+        Pop up to the n elements with the lowest scores across the shards,
+        by finding out how many of them each shard holds and then taking
+        that many from each.
+        """
+        if n <= 0:
+            return []
+        heads = []
+        for index, shard in enumerate(self.shards):
+            for value, score in shard.redis.zrange(shard.key, 0, n - 1,
+                withscores=True):
+                heads.append((score, index))
+        counts = {}
+        for score, index in sorted(heads)[:n]:
+            counts[index] = counts.get(index, 0) + 1
+        popped = []
+        for index, count in counts.items():
+            popped.extend(self.shards[index]._zpop(count))
+        return [value for value, score in sorted(popped, key=lambda p: p[1])]
 
 class CappedCollection(BaseQueue):
     """
     Implements a capped collection (the collection never
-    gets larger than the specified size).
+    gets larger than the specified size). With a window, elements older
+    than window seconds are dropped as well, and size may be left out.
+
+    By default every push trims the collection, in the same script call.
+    For high push rates, trim='every' trims on every'th push from this
+    client, and trim='random' on one push in every at random (which also
+    suits many short-lived instances), at the cost of the collection
+    growing past its size in between.
     """
-    
+
+    trims = ('exact', 'every', 'random')
+    packable = True
+
+    # Push ARGV[4...] and then trim the list to ARGV[1] elements (if it's
+    # not 0), and drop elements stamped before ARGV[2] (if it's not empty)
+    # from the old end. Returns the references to offloaded payloads,
+    # which start with ARGV[3] (if it's not empty), among the dropped
+    # elements, without their stamps.
+    PUSH = """
+        if #ARGV > 3 then
+            redis.call('lpush', KEYS[1], unpack(ARGV, 4))
+        end
+        local refs = {}
+        local at = 1
+        if ARGV[2] ~= '' then
+            at = 18
+        end
+        local function drop()
+            local dropped = redis.call('rpop', KEYS[1])
+            if ARGV[3] ~= '' and string.sub(dropped, at, at + #ARGV[3] - 1) == ARGV[3] then
+                refs[#refs + 1] = string.sub(dropped, at)
+            end
+        end
+        local size = tonumber(ARGV[1])
+        if size > 0 and ARGV[3] == '' then
+            redis.call('ltrim', KEYS[1], 0, size - 1)
+        elseif size > 0 then
+            for i = size + 1, redis.call('llen', KEYS[1]) do
+                drop()
+            end
+        end
+        if ARGV[2] ~= '' then
+            local cutoff = tonumber(ARGV[2])
+            while true do
+                local oldest = redis.call('lindex', KEYS[1], -1)
+                if not oldest or tonumber(string.sub(oldest, 1, 17)) >= cutoff then
+                    break
+                end
+                drop()
+            end
+        end
+        return refs
+    """
+
     @staticmethod
     def all(pattern='*', **kwargs):
         return BaseQueue.all(CappedCollection, pattern, **kwargs)
 
-    def __init__(self, key, size, **kwargs):
+    @staticmethod
+    def scan(pattern='*', count=1000, withsizes=False, **kwargs):
+        return BaseQueue.scan(CappedCollection, pattern, count, withsizes, **kwargs)
+
+    def __init__(self, key, size=None, trim='exact', every=100, window=None, **kwargs):
+        if size is None and window is None:
+            raise ValueError('A capped collection needs a size or a window')
+        if trim not in self.trims:
+            raise ValueError('Unknown trim mode %r' % trim)
+        if window is not None and kwargs.get('packed') is not None:
+            raise ValueError("A packed capped collection can't have a window")
         BaseQueue.__init__(self, key, **kwargs)
         self.size = size
+        self.trim = trim
+        self.every = every
+        self.window = window
+        self.pushes = 0
+        if window is not None:
+            # Stamped elements can't move between structures as they are
+            self.move_out = self.move_in = None
+
+    def _pack(self, val):
+        """With a window, elements are stamped with when they were pushed"""
+        packed = BaseQueue._pack(self, val)
+        if self.window is None:
+            return packed
+        return ('%017.6f' % time.time()).encode('ascii') + packed
+
+    def _strip(self, val):
+        if self.window is not None and val is not None:
+            return val[17:]
+        return val
 
+    def _trimming(self, count=1):
+        """Whether pushing count elements should trim the collection too"""
+        if self.trim == 'exact':
+            return True
+        elif self.trim == 'random':
+            return random.random() * self.every < count
+        self.pushes += count
+        if self.pushes < self.every:
+            return False
+        self.pushes %= self.every
+        return True
+
+    def _push(self, client, records):
+        """
+        Push raw records and trim, in one script call, which returns the
+        references to the offloaded payloads of the elements it dropped
+        """
+        cutoff, marker = '', b''
+        if self.window is not None:
+            cutoff = '%.6f' % (time.time() - self.window)
+        if self.offload is not None:
+            marker = refMarker
+        return self._script(self.PUSH)(keys=[self.key],
+            args=[self.size or 0, cutoff, marker] + list(records), client=client)
+
+    def _trimmed(self, replies, count):
+        """Drop the references trimming pushes returned, and return count"""
+        for refs in replies:
+            self._release_refs(refs)
+        return count
+
+    @instrumented
     def push(self, element):
-        size = self.size
-        with self.redis.pipeline() as pipe:
-            # ltrim is zero-indexed 
-            pipe = pipe.lpush(self.key, self._pack(element)).ltrim(self.key, 0, size-1)
-            pipe.execute()
+        if self.packed:
+            self._pack_records(self.redis, [self._pack(element)], self._cap())
+        elif self._trimming():
+            self._release_refs(self._push(self.redis, [self._pack(element)]))
+        else:
+            self.redis.lpush(self.key, self._pack(element))
 
+    @instrumented
     def extend(self, vals):
         """Extends the elements in the queue."""
-        with self.redis.pipeline() as pipe:
-            for val in vals:
-                pipe.lpush(self.key, self._pack(val))
-            pipe.ltrim(self.key, 0, self.size-1)
-            pipe.execute()
+        records = [self._pack(val) for val in vals]
+        if records:
+            self._load(records)
+
+    def _cap(self, count=1):
+        """The size to trim a packed collection to after pushing count elements, if any"""
+        if self._trimming(count):
+            return self.size
+        return ''
 
+    def _put(self, pipe, records):
+        """Queue up the commands to load raw records, as written by dump"""
+        if self.packed:
+            self._pack_records(pipe, records, self._cap(len(records)))
+            return
+        trimming = self._trimming(len(records))
+        # Keep each script call's arguments well inside Lua's stack
+        for start in range(0, len(records), 1000):
+            chunk = records[start:start + 1000]
+            if trimming:
+                self._push(pipe, chunk)
+            else:
+                pipe.lpush(self.key, *chunk)
+        if trimming and self.offload is not None:
+            return lambda replies: self._trimmed(replies, len(records))
+
+    @instrumented
     def pop(self, block=False):
+        if self.packed:
+            popped = self._pop_packed(1, block)
+            return popped[0] if popped else None
         if not block:
             popped = self.redis.rpop(self.key)
         else:
             queue, popped = self.redis.brpop(self.key)
-        log.debug('Popped ** %s ** from key ** %s **' % (popped, self.key))
-        return self._unpack(popped)
+        log.debug('Popped ** %s ** from key ** %s **', popped, self.key)
+        return self._unpack(popped, True)
+
+    @instrumented
+    def pop_many(self, n, block=False, timeout=None):
+        """Pop up to n elements, oldest first"""
+        return self._pop_many(n, block, timeout, right=True)
+
+    def _batch_pop(self, pipe):
+        if self.packed:
+            return self._batch_pop_packed(pipe)
+        pipe.rpop(self.key)
+        return lastReply
 
 class Stack(BaseQueue):
     """Implements a LIFO stack""" 
 
+    boundable = True
+    move_out = 'lpop'
+
     @staticmethod
     def all(pattern='*', **kwargs):
         return BaseQueue.all(Stack, pattern, **kwargs)
+
+    @staticmethod
+    def scan(pattern='*', count=1000, withsizes=False, **kwargs):
+        return BaseQueue.scan(Stack, pattern, count, withsizes, **kwargs)
     
+    @instrumented
     def push(self, element):
         """Push an element"""
-        self.redis.lpush(self.key, self._pack(element))
-        log.debug('Pushed ** %s ** for key ** %s **' % (element, self.key))
+        self._push_one(self._pack(element))
+        log.debug('Pushed ** %s ** for key ** %s **', element, self.key)
          
+    @instrumented
     def pop(self, block=False):
         """Pop an element"""
         if not block:
             popped = self.redis.lpop(self.key)
         else:
             queue, popped = self.redis.blpop(self.key)
-        log.debug('Popped ** %s ** from key ** %s **' % (popped, self.key))
-        return self._unpack(popped)
+        log.debug('Popped ** %s ** from key ** %s **', popped, self.key)
+        return self._unpack(popped, True)
+
+    @instrumented
+    def pop_many(self, n, block=False, timeout=None):
+        """Pop up to n elements, most recently pushed first"""
+        return self._pop_many(n, block, timeout, right=False)
+
+    def _batch_pop(self, pipe):
+        pipe.lpop(self.key)
+        return lastReply
+
+class Batcher(object):
+    """
+    Buffers pushes to a structure and sends them as one pipelined,
+    multi-value push once count elements or size bytes of payload have
+    built up, or once the oldest element has waited linger seconds. With
+    background=True, a thread flushes lingering elements even when no
+    more pushes come. Whatever is left is flushed on close(), on leaving
+    a with block, and at interpreter exit.
+    """
+    def __init__(self, q, count=100, size=None, linger=None, background=False):
+        self.q = q
+        self.count = count
+        self.size = size
+        self.linger = linger
+        self._lock = threading.Lock()
+        self._records = []
+        self._bytes = 0
+        self._oldest = None
+        self._closed = False
+        self._stopping = threading.Event()
+        self._thread = None
+        if background and linger:
+            self._thread = threading.Thread(target=self._flusher)
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.close)
+
+    def __len__(self):
+        """Return the number of buffered elements"""
+        return len(self._records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _due(self):
+        """Whether the buffered elements should be flushed"""
+        if len(self._records) >= self.count:
+            return True
+        if self.size is not None and self._bytes >= self.size:
+            return True
+        if self.linger is not None and self._oldest is not None:
+            return time.time() - self._oldest >= self.linger
+        return False
+
+    def _flusher(self):
+        while not self._stopping.wait(self.linger / 2.0):
+            if self._due():
+                try:
+                    self.flush()
+                except Exception as e:
+                    log.error('Background flush failed ** %s', repr(e))
+
+    def push(self, *args):
+        """Buffer a push, with the same arguments as the structure's push"""
+        record = self.q._record(*args)
+        payload = record[0] if isinstance(record, tuple) else record
+        with self._lock:
+            if not self._records:
+                self._oldest = time.time()
+            self._records.append(record)
+            self._bytes += len(payload)
+            due = self._due()
+        if due:
+            self.flush()
+
+    def extend(self, vals):
+        """Buffer several pushes, each one element (or argument tuple)"""
+        for val in vals:
+            if isinstance(self.q, (PriorityQueue, BucketPriorityQueue)):
+                self.push(*val)
+            else:
+                self.push(val)
+
+    def flush(self):
+        """
+        Push everything buffered, in one round trip, returning how many
+        elements the structure took. A bounded structure may refuse some,
+        and a UniqueQueue skips those already in it.
+        """
+        with self._lock:
+            if not self._records:
+                return 0
+            # Elements stay buffered if the push fails
+            accepted = self.q._load(self._records)
+            count = len(self._records)
+            self._records, self._bytes, self._oldest = [], 0, None
+        if accepted < count:
+            log.info('Key ** %s ** took ** %s ** of ** %s ** flushed elements',
+                self.q.key, accepted, count)
+        log.debug('Flushed ** %s ** elements to key ** %s **', count, self.q.key)
+        return accepted
+
+    def close(self):
+        """Flush whatever is buffered and stop the background flusher"""
+        if self._closed:
+            return
+        self._closed = True
+        if hasattr(atexit, 'unregister'):
+            # Python 2 has no way to, so closed Batchers stay registered
+            atexit.unregister(self.close)
+        self._stopping.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+
+class Future(object):
+    """The result of an operation in a batch, available once the batch has run"""
+    def __init__(self):
+        self.done = False
+        self._result = None
+        self._error = None
+
+    def _resolve(self, result=None, error=None):
+        self.done = True
+        self._result = result
+        self._error = error
+
+    def result(self):
+        """Return the result, or raise the error, of the operation"""
+        if not self.done:
+            raise RuntimeError('The batch has not run yet')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+class batch(object):
+    """
+    Groups operations on any number of structures into one pipeline per
+    connection pool, so they cost one round trip between them. Each
+    operation returns a Future, resolved when the batch runs on leaving
+    the with block (or on execute()). Popped and peeked elements are
+    unpacked together, once per structure. With transaction=True, each
+    pipeline runs as a MULTI/EXEC transaction.
+
+        with qr.batch() as b:
+            b.push(events, 'login')
+            pending = b.len(jobs)
+            job = b.pop(jobs)
+        print(pending.result(), job.result())
+    """
+    def __init__(self, transaction=False):
+        self.transaction = transaction
+        self.pipes = {}
+        self.operations = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.execute()
+        else:
+            self.reset()
+
+    def _queue(self, q, queue, parse=None, unpack=False, consume=False):
+        """
+        Queue up an operation on q's pipeline. queue queues its commands
+        on the pipeline, and returns how to find the result in their
+        replies if parse isn't given.
+        """
+        pool = q.redis.connection_pool
+        if pool not in self.pipes:
+            self.pipes[pool] = q.redis.pipeline(transaction=self.transaction)
+        pipe = self.pipes[pool]
+        start = len(pipe)
+        found = queue(pipe)
+        parse = parse or found
+        future = Future()
+        self.operations.append((q, pipe, start, len(pipe), parse, unpack,
+            consume, future))
+        return future
+
+    def push(self, q, *args):
+        """Push onto q, with the same arguments as its push"""
+        return self._queue(q, lambda pipe: q._put(pipe, [q._record(*args)]))
+
+    def pop(self, q):
+        """Pop the next element from q"""
+        return self._queue(q, q._batch_pop, unpack=True, consume=q.consuming)
+
+    def peek(self, q):
+        """Look at the next element in q"""
+        return self._queue(q, q._batch_peek, unpack=True)
+
+    def len(self, q):
+        """Find the length of q"""
+        return self._queue(q, q._batch_len)
+
+    def reset(self):
+        """Throw away everything queued up"""
+        for pipe in self.pipes.values():
+            pipe.reset()
+        self.pipes, self.operations = {}, []
+
+    def execute(self):
+        """Run everything queued up, one round trip per connection pool"""
+        replies = {}
+        for pool, pipe in self.pipes.items():
+            try:
+                replies[pipe] = pipe.execute(raise_on_error=False)
+            except Exception as e:
+                # The transaction failed as a whole
+                replies[pipe] = e
+            finally:
+                pipe.reset()
+        # Find every operation's result, and gather the raw elements to
+        # unpack for each structure
+        resolved, raw = [], {}
+        for q, pipe, start, stop, parse, unpack, consume, future in self.operations:
+            error, result, group = replies[pipe], None, None
+            if not isinstance(error, Exception):
+                mine, error = error[start:stop], None
+                for reply in mine:
+                    if isinstance(reply, Exception):
+                        error = reply
+                if error is None and parse is not None:
+                    result = parse(mine)
+            if unpack and error is None:
+                group = (q, consume)
+                raw.setdefault(group, []).append(result)
+            resolved.append((future, result, error, group))
+        unpacked = dict((group, iter(group[0]._unpack_many(values, group[1])))
+            for group, values in raw.items())
+        for future, result, error, group in resolved:
+            if group is not None:
+                result = next(unpacked[group])
+            future._resolve(result, error)
+        count = len(self.operations)
+        self.pipes, self.operations = {}, []
+        log.debug('Ran a batch of ** %s ** operations', count)
+        return count
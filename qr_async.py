@@ -0,0 +1,444 @@
+"""
+QR | asyncio versions of the Redis-based data structures in qr
+
+These use the same key layout and serialization as the classes in qr, so
+sync and async producers and consumers can share the same keys.
+"""
+
+import os
+import asyncio
+import weakref
+import functools
+import qr
+
+from redis import asyncio as aioredis
+
+log = qr.log
+
+# Connection pools for asyncio clients, keyed by event loop and then the same
+# way as qr's. A pool's connections belong to the loop that opened them.
+connectionPools = weakref.WeakKeyDictionary()
+poolsPid = os.getpid()
+
+def runningLoop():
+    """Return the running event loop, or None outside of one"""
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+def makePool(kwargs):
+    """Create an asyncio connection pool from qr.getRedis-style options"""
+    options = dict(kwargs)
+    if options.pop('blocking_pool', False):
+        options['timeout'] = options.pop('pool_timeout', 20)
+        return aioredis.BlockingConnectionPool(**options)
+    options.pop('pool_timeout', None)
+    return aioredis.ConnectionPool(**options)
+
+def getRedis(**kwargs):
+    """
+    Match up the provided kwargs with an existing asyncio connection pool for
+    the running event loop, creating one if there isn't one yet. Takes the
+    same pool options as qr.getRedis. Outside of a running loop, returns a
+    client with a pool of its own.
+    """
+    global connectionPools, poolsPid
+    if poolsPid != os.getpid():
+        connectionPools, poolsPid = weakref.WeakKeyDictionary(), os.getpid()
+    loop = runningLoop()
+    if loop is None:
+        return aioredis.Redis(connection_pool=makePool(kwargs))
+    pools = connectionPools.setdefault(loop, {})
+    key = qr.poolKey(kwargs)
+    try:
+        return aioredis.Redis(connection_pool=pools[key])
+    except KeyError:
+        cp = pools[key] = makePool(kwargs)
+        return aioredis.Redis(connection_pool=cp)
+
+async def closePools():
+    """Disconnect and forget every asyncio connection pool of the running loop"""
+    pools = list(connectionPools.pop(runningLoop(), {}).values())
+    for cp in pools:
+        await cp.disconnect()
+
+def instrumented(f):
+    """Like qr.instrumented, for coroutines"""
+    name = f.__name__
+    @functools.wraps(f)
+    async def wrapped(self, *args, **kwargs):
+        if not qr.hooks:
+            return await f(self, *args, **kwargs)
+        start = qr.clock()
+        try:
+            result = await f(self, *args, **kwargs)
+        except Exception:
+            qr.emit('operation', type(self).__name__, self.key, name,
+                qr.clock() - start, True)
+            raise
+        qr.emit('operation', type(self).__name__, self.key, name,
+            qr.clock() - start, False)
+        return result
+    return wrapped
+
+class worker(object):
+    """
+    Like qr.worker, but for coroutines. The wrapped callback may be a
+    plain function or a coroutine function.
+    """
+    def __init__(self, q, err=None, *args, **kwargs):
+        self.q = q
+        self.err = err
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self, f):
+        async def wrapped():
+            while True:
+                # Blocking pop
+                next = await self.q.pop(block=True)
+                if next is None:
+                    continue
+                try:
+                    # Try to execute the user's callback.
+                    result = f(next, *self.args, **self.kwargs)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    try:
+                        # Failing that, let's call the user's err-back,
+                        # which we should keep from ever throwing
+                        result = self.err(e, *self.args, **self.kwargs)
+                        if asyncio.iscoroutine(result):
+                            await result
+                    except Exception:
+                        pass
+        return wrapped
+
+class BaseQueue(object):
+    """Base functionality common to queues"""
+
+    # Serialization is shared with qr, so payloads are interchangeable
+    _pack = qr.BaseQueue._dumps
+    _unpack = qr.BaseQueue._loads
+
+    def __init__(self, key, serializer=None, compress=None, **kwargs):
+        self.serializer = qr.getSerializer(serializer, compress)
+        self.options = kwargs
+        self.key = key
+
+    @property
+    def redis(self):
+        """A client on the running event loop's connection pool"""
+        return getRedis(**self.options)
+
+    @instrumented
+    async def length(self):
+        """Return the length of the queue"""
+        return await self.redis.llen(self.key)
+
+    @instrumented
+    async def __getitem__(self, val):
+        """Get a slice or a particular index."""
+        try:
+            return [self._unpack(i) for i in
+                await self.redis.lrange(self.key, val.start, val.stop - 1)]
+        except AttributeError:
+            return self._unpack(await self.redis.lindex(self.key, val))
+        except Exception as e:
+            log.error('Get item failed ** %s', repr(e))
+            return None
+
+    @instrumented
+    async def extend(self, vals):
+        """Extends the elements in the queue."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for val in vals:
+                pipe.lpush(self.key, self._pack(val))
+            await pipe.execute()
+
+    async def _pop_many(self, n, block=False, timeout=None, right=True):
+        """Atomically pop up to n elements off one end of the list"""
+        if n <= 0:
+            return []
+        async with self.redis.pipeline() as pipe:
+            if right:
+                pipe.lrange(self.key, -n, -1)
+                pipe.ltrim(self.key, 0, -n - 1)
+            else:
+                pipe.lrange(self.key, 0, n - 1)
+                pipe.ltrim(self.key, n, -1)
+            popped, trimmed = await pipe.execute()
+        if right:
+            popped.reverse()
+        if not popped and block:
+            if right:
+                result = await self.redis.brpop(self.key, timeout or 0)
+            else:
+                result = await self.redis.blpop(self.key, timeout or 0)
+            if result is None:
+                return []
+            return [self._unpack(result[1])] + await self._pop_many(
+                n - 1, right=right)
+        log.debug('Popped ** %s ** from key ** %s **', popped, self.key)
+        return [self._unpack(p) for p in popped]
+
+    async def _pop(self, block=False, timeout=None, right=True):
+        """Pop a single element off one end of the list"""
+        if not block:
+            if right:
+                popped = await self.redis.rpop(self.key)
+            else:
+                popped = await self.redis.lpop(self.key)
+        else:
+            if right:
+                result = await self.redis.brpop(self.key, timeout or 0)
+            else:
+                result = await self.redis.blpop(self.key, timeout or 0)
+            popped = result and result[1]
+        log.debug('Popped ** %s ** from key ** %s **', popped, self.key)
+        return self._unpack(popped)
+
+    @instrumented
+    async def peek(self):
+        """Look at the next item in the queue"""
+        return self._unpack(await self.redis.lindex(self.key, -1))
+
+    @instrumented
+    async def elements(self):
+        """Return all elements as a Python list"""
+        return [self._unpack(o) for o in await self.redis.lrange(self.key, 0, -1)]
+
+    async def elements_as_json(self):
+        """Return all elements as JSON object"""
+        return qr.json.dumps(await self.elements())
+
+    @instrumented
+    async def clear(self):
+        """Removes all the elements in the queue"""
+        await self.redis.delete(self.key)
+
+class Deque(BaseQueue):
+    """Implements a double-ended queue"""
+
+    @instrumented
+    async def push_back(self, element):
+        """Push an element to the back of the deque"""
+        await self.redis.lpush(self.key, self._pack(element))
+        log.debug('Pushed ** %s ** for key ** %s **', element, self.key)
+
+    @instrumented
+    async def push_front(self, element):
+        """Push an element to the front of the deque"""
+        await self.redis.rpush(self.key, self._pack(element))
+        log.debug('Pushed ** %s ** for key ** %s **', element, self.key)
+
+    @instrumented
+    async def pop_front(self):
+        """Pop an element from the front of the deque"""
+        return await self._pop(right=True)
+
+    @instrumented
+    async def pop_back(self):
+        """Pop an element from the back of the deque"""
+        return await self._pop(right=False)
+
+    @instrumented
+    async def pop_many_front(self, n, block=False, timeout=None):
+        """Pop up to n elements from the front of the deque"""
+        return await self._pop_many(n, block, timeout, right=True)
+
+    @instrumented
+    async def pop_many_back(self, n, block=False, timeout=None):
+        """Pop up to n elements from the back of the deque"""
+        return await self._pop_many(n, block, timeout, right=False)
+
+class Queue(BaseQueue):
+    """Implements a FIFO queue"""
+
+    @instrumented
+    async def push(self, element):
+        """Push an element"""
+        await self.redis.lpush(self.key, self._pack(element))
+        log.debug('Pushed ** %s ** for key ** %s **', element, self.key)
+
+    @instrumented
+    async def pop(self, block=False, timeout=None):
+        """Pop an element"""
+        return await self._pop(block, timeout, right=True)
+
+    @instrumented
+    async def pop_many(self, n, block=False, timeout=None):
+        """Pop up to n elements, oldest first"""
+        return await self._pop_many(n, block, timeout, right=True)
+
+class PriorityQueue(BaseQueue):
+    """A priority queue"""
+
+    _first = qr.PriorityQueue._first
+    _many = qr.PriorityQueue._many
+
+    @instrumented
+    async def length(self):
+        """Return the length of the queue"""
+        return await self.redis.zcard(self.key)
+
+    @instrumented
+    async def __getitem__(self, val):
+        """Get a slice or a particular index."""
+        try:
+            return [self._unpack(i) for i in
+                await self.redis.zrange(self.key, val.start, val.stop - 1)]
+        except AttributeError:
+            val = await self.redis.zrange(self.key, val, val)
+            if val:
+                return self._unpack(val[0])
+            return None
+        except Exception as e:
+            log.error('Get item failed ** %s', repr(e))
+            return None
+
+    @instrumented
+    async def extend(self, vals):
+        """Extends the elements in the queue."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for val, score in vals:
+                pipe.zadd(self.key, {self._pack(val): score})
+            return await pipe.execute()
+
+    @instrumented
+    async def push(self, value, score):
+        """Add an element with a given score"""
+        return await self.redis.zadd(self.key, {self._pack(value): score})
+
+    async def _zpeek(self, n, highest=False):
+        """Return up to n (value, score) pairs from one end of the zset"""
+        if n <= 0:
+            return []
+        if highest:
+            results = await self.redis.zrevrange(self.key, 0, n - 1, withscores=True)
+        else:
+            results = await self.redis.zrange(self.key, 0, n - 1, withscores=True)
+        return [(self._unpack(value), score) for value, score in results]
+
+    async def _zpop(self, n, block=False, timeout=None, highest=False):
+        """Atomically pop up to n (value, score) pairs from one end of the zset"""
+        if n <= 0:
+            return []
+        async with self.redis.pipeline() as pipe:
+            if highest:
+                pipe.zrevrange(self.key, 0, n - 1, withscores=True)
+                pipe.zremrangebyrank(self.key, -n, -1)
+            else:
+                pipe.zrange(self.key, 0, n - 1, withscores=True)
+                pipe.zremrangebyrank(self.key, 0, n - 1)
+            results, count = await pipe.execute()
+        if not results and block:
+            if highest:
+                result = await self.redis.bzpopmax(self.key, timeout or 0)
+            else:
+                result = await self.redis.bzpopmin(self.key, timeout or 0)
+            if not result:
+                return []
+            key, value, score = result
+            return [(self._unpack(value), float(score))] + await self._zpop(
+                n - 1, highest=highest)
+        log.debug('Popped ** %s ** from key ** %s **', results, self.key)
+        return [(self._unpack(value), score) for value, score in results]
+
+    @instrumented
+    async def peek(self, withscores=False):
+        """Look at the next item in the queue"""
+        return self._first(await self._zpeek(1), withscores)
+
+    @instrumented
+    async def peek_many(self, n, withscores=False):
+        """Look at the n elements with the lowest scores"""
+        return self._many(await self._zpeek(n), withscores)
+
+    @instrumented
+    async def peek_max(self, withscores=False):
+        """Look at the element with the highest score"""
+        return self._first(await self._zpeek(1, highest=True), withscores)
+
+    @instrumented
+    async def elements(self):
+        """Return all elements as a Python list"""
+        return [self._unpack(o) for o in await self.redis.zrange(self.key, 0, -1)]
+
+    @instrumented
+    async def pop(self, withscores=False, block=False, timeout=None):
+        """Get the element with the lowest score, and pop it off"""
+        return self._first(await self._zpop(1, block, timeout), withscores)
+
+    @instrumented
+    async def pop_many(self, n, withscores=False, block=False, timeout=None):
+        """Pop up to n elements with the lowest scores, lowest first"""
+        return self._many(await self._zpop(n, block, timeout), withscores)
+
+    @instrumented
+    async def pop_max(self, withscores=False, block=False, timeout=None):
+        """Get the element with the highest score, and pop it off"""
+        return self._first(
+            await self._zpop(1, block, timeout, highest=True), withscores)
+
+    @instrumented
+    async def pop_max_many(self, n, withscores=False, block=False, timeout=None):
+        """Pop up to n elements with the highest scores, highest first"""
+        return self._many(
+            await self._zpop(n, block, timeout, highest=True), withscores)
+
+class CappedCollection(BaseQueue):
+    """
+    Implements a capped collection (the collection never
+    gets larger than the specified size).
+    """
+
+    def __init__(self, key, size, **kwargs):
+        BaseQueue.__init__(self, key, **kwargs)
+        self.size = size
+
+    @instrumented
+    async def push(self, element):
+        async with self.redis.pipeline() as pipe:
+            # ltrim is zero-indexed
+            pipe.lpush(self.key, self._pack(element)).ltrim(self.key, 0, self.size - 1)
+            await pipe.execute()
+
+    @instrumented
+    async def extend(self, vals):
+        """Extends the elements in the queue."""
+        async with self.redis.pipeline() as pipe:
+            for val in vals:
+                pipe.lpush(self.key, self._pack(val))
+            pipe.ltrim(self.key, 0, self.size - 1)
+            await pipe.execute()
+
+    @instrumented
+    async def pop(self, block=False, timeout=None):
+        return await self._pop(block, timeout, right=True)
+
+    @instrumented
+    async def pop_many(self, n, block=False, timeout=None):
+        """Pop up to n elements, oldest first"""
+        return await self._pop_many(n, block, timeout, right=True)
+
+class Stack(BaseQueue):
+    """Implements a LIFO stack"""
+
+    @instrumented
+    async def push(self, element):
+        """Push an element"""
+        await self.redis.lpush(self.key, self._pack(element))
+        log.debug('Pushed ** %s ** for key ** %s **', element, self.key)
+
+    @instrumented
+    async def pop(self, block=False, timeout=None):
+        """Pop an element"""
+        return await self._pop(block, timeout, right=False)
+
+    @instrumented
+    async def pop_many(self, n, block=False, timeout=None):
+        """Pop up to n elements, most recently pushed first"""
+        return await self._pop_many(n, block, timeout, right=False)
@@ -39,7 +39,7 @@ setup(
     keywords             = 'Redis, queue, data structures',
     license              = 'MIT',
     packages             = find_packages(),
-    py_modules           = ['qr'],
+    py_modules           = ['qr', 'qr_async'],
     include_package_data = True,
     zip_safe             = False,
     classifiers          = [
@@ -0,0 +1,92 @@
+import qr
+import redis
+import qr_async
+import unittest
+
+r = redis.Redis()
+
+class Queue(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        r.delete('qrtestasyncqueue')
+        self.q = qr_async.Queue(key='qrtestasyncqueue')
+
+    async def asyncTearDown(self):
+        await qr_async.closePools()
+
+    async def test_roundtrip(self):
+        await self.q.push('foo')
+        self.assertEqual(await self.q.length(), 1)
+        self.assertEqual(await self.q.pop(), 'foo')
+        self.assertEqual(await self.q.pop(block=True, timeout=1), None)
+
+    async def test_pop_many(self):
+        await self.q.extend(range(5))
+        self.assertEqual(await self.q[0], 4)
+        self.assertEqual(await self.q.pop_many(3), [0, 1, 2])
+        self.assertEqual(await self.q.pop_many(3, block=True, timeout=1), [3, 4])
+
+    async def test_empty_json(self):
+        q = qr_async.Queue(key='qrtestasyncqueue', serializer='json')
+        self.assertEqual(await q.pop(), None)
+        self.assertEqual(await q.peek(), None)
+        self.assertEqual(await q[0], None)
+
+    async def test_pools(self):
+        '''Clients on the same loop share a pool, which closePools forgets'''
+        pool = self.q.redis.connection_pool
+        self.assertTrue(qr_async.getRedis().connection_pool is pool)
+        await qr_async.closePools()
+        self.assertFalse(self.q.redis.connection_pool is pool)
+
+    async def test_interop(self):
+        '''Sync producers and async consumers can share a key'''
+        qr.Queue(key='qrtestasyncqueue', serializer='json').push({'a': 1})
+        q = qr_async.Queue(key='qrtestasyncqueue', serializer='json')
+        self.assertEqual(await q.pop(), {'a': 1})
+        await q.push([1, 2])
+        self.assertEqual(qr.Queue(key='qrtestasyncqueue', serializer='json').pop(), [1, 2])
+
+class Stack(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        r.delete('qrtestasyncstack')
+        self.stack = qr_async.Stack(key='qrtestasyncstack')
+
+    async def asyncTearDown(self):
+        await qr_async.closePools()
+
+    async def test_order(self):
+        await self.stack.extend(['foo', 'bar', 'baz'])
+        self.assertEqual(await self.stack.pop(), 'baz')
+        self.assertEqual(await self.stack.pop_many(5), ['bar', 'foo'])
+
+class PriorityQueue(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        r.delete('qrtestasyncpq')
+        self.q = qr_async.PriorityQueue(key='qrtestasyncpq')
+
+    async def asyncTearDown(self):
+        await qr_async.closePools()
+
+    async def test_order(self):
+        await self.q.extend([('foo', 2), ('bar', 1), ('baz', 3)])
+        self.assertEqual(await self.q.length(), 3)
+        self.assertEqual(await self.q.peek(), 'bar')
+        self.assertEqual(await self.q.pop(withscores=True), ('bar', 1.0))
+        self.assertEqual(await self.q.pop_max(), 'baz')
+        self.assertEqual(await self.q.pop_many(5, block=True, timeout=1), ['foo'])
+
+class CappedCollection(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        r.delete('qrtestasynccc')
+        self.cc = qr_async.CappedCollection(key='qrtestasynccc', size=2)
+
+    async def asyncTearDown(self):
+        await qr_async.closePools()
+
+    async def test_limit(self):
+        await self.cc.extend(['a', 'b', 'c'])
+        await self.cc.push('d')
+        self.assertEqual(await self.cc.elements(), ['d', 'c'])
+
+if __name__ == '__main__':
+    unittest.main()
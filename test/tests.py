@@ -1,5 +1,13 @@
 import os
+import gc
+import atexit
+import weakref
 import qr
+import json
+import time
+import shutil
+import threading
+import tempfile
 import redis
 import unittest
 
@@ -73,6 +81,17 @@ class Queue(unittest.TestCase):
         self.assertEquals(self.q.elements(), [count - i - 1 for i in range(count)])
         self.q.clear()
             
+    def test_iter_elements(self):
+        count = 25
+        self.q.extend(range(count))
+        self.assertEquals(list(self.q), self.q.elements())
+        self.assertEquals(list(self.q.iter_elements(page_size=4)), self.q.elements())
+        self.assertEquals(''.join(self.q.iter_json(page_size=4)),
+            json.dumps(self.q.elements(), separators=(',', ':')))
+        self.assertEquals(json.loads(self.q.elements_as_json()), self.q.elements())
+        self.q.clear()
+        self.assertEquals(self.q.elements_as_json(), '[]')
+
     def test_pack_unpack(self):
         '''Make sure that it behaves like python-object-in, python-object-out'''
         count = 100
@@ -82,12 +101,22 @@ class Queue(unittest.TestCase):
             self.assertTrue(isinstance(next, dict))
             next = self.q.pop()
     
+    def test_pop_many(self):
+        self.q.extend(range(10))
+        self.assertEquals(self.q.pop_many(3), [0, 1, 2])
+        self.assertEquals(len(self.q), 7)
+        self.assertEquals(self.q.pop_many(100), [3, 4, 5, 6, 7, 8, 9])
+        self.assertEquals(self.q.pop_many(5), [])
+        self.assertEquals(self.q.pop_many(5, block=True, timeout=1), [])
+        self.q.push('foo')
+        self.assertEquals(self.q.pop_many(5, block=True, timeout=1), ['foo'])
+
     def test_dump_load(self):
         # Get a temporary file to dump a queue to that file
         count = 100
         self.q.extend(range(count))
         self.assertEquals(self.q.elements(), [count - i - 1for i in range(count)])
-        with os.tmpfile() as f:
+        with tempfile.TemporaryFile() as f:
             self.q.dump(f)
             # Now, assert that it is empty
             self.assertEquals(len(self.q), 0)
@@ -99,7 +128,815 @@ class Queue(unittest.TestCase):
             # Now clean up after myself
             f.truncate()
             self.q.clear()
+
+    def test_dump_load_formats(self):
+        count = 25
+        for format in ('lines', 'length'):
+            self.q.extend(range(count))
+            with tempfile.TemporaryFile() as f:
+                self.assertEquals(self.q.dump(f, chunk=7, format=format), count)
+                self.assertEquals(len(self.q), 0)
+                f.seek(0)
+                self.assertEquals(self.q.load(f, chunk=7, format=format), count)
+            self.assertEquals(self.q.pop_many(count), list(range(count)))
+
+    def test_dumpfname_gzip(self):
+        count = 25
+        path = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(path, 'dump.gz')
+            self.q.extend(range(count))
+            self.assertEquals(self.q.dumpfname(fname, truncate=True), count)
+            self.assertEquals(self.q.loadfname(fname), count)
+            self.assertEquals(self.q.pop_many(count), list(range(count)))
+        finally:
+            shutil.rmtree(path)
     
+class Bounded(unittest.TestCase):
+    def setUp(self):
+        r.delete('qrbounded')
+        for key in r.keys('qr:payload:*'):
+            r.delete(key)
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_refuse(self):
+        q = qr.Queue('qrbounded', maxlen=3)
+        self.assertEquals(q.extend(['a', 'b']), 2)
+        q.push('c')
+        self.assertRaises(qr.Full, q.push, 'd')
+        self.assertEquals(q.extend(['d', 'e']), 0)
+        q.pop()
+        self.assertEquals(q.extend(['d', 'e']), 1)
+        self.assertEquals(q.pop_many(5), ['b', 'c', 'd'])
+
+    def test_drop(self):
+        q = qr.Queue('qrbounded', maxlen=3, overflow='drop')
+        self.assertEquals(q.extend(range(5)), 5)
+        q.push(5)
+        self.assertEquals(len(q), 3)
+        self.assertEquals(q.pop_many(5), [3, 4, 5])
+
+    def test_drop_deque(self):
+        q = qr.Deque('qrbounded', maxlen=2, overflow='drop')
+        q.push_back('a')
+        q.push_back('b')
+        q.push_front('c')
+        self.assertEquals(q.pop_many_front(5), ['c', 'a'])
+        s = qr.Stack('qrbounded', maxlen=2, overflow='drop')
+        s.extend(['a', 'b', 'c'])
+        self.assertEquals(s.pop_many(5), ['c', 'b'])
+
+    def test_block(self):
+        q = qr.Queue('qrbounded', maxlen=1, overflow='block', overflow_timeout=0.2)
+        q.push('a')
+        start = time.time()
+        self.assertRaises(qr.Full, q.push, 'b')
+        self.assertTrue(time.time() - start >= 0.2)
+        threading.Timer(0.1, q.pop).start()
+        q.push('b')
+        self.assertEquals(q.pop(), 'b')
+
+    def test_priority(self):
+        q = qr.PriorityQueue('qrbounded', maxlen=2)
+        self.assertEquals(q.extend([('a', 1), ('b', 2), ('c', 3)]), 2)
+        # Rescoring an element takes no room
+        q.push('a', 5)
+        self.assertRaises(qr.Full, q.push, 'c', 0)
+        q = qr.PriorityQueue('qrbounded', maxlen=2, overflow='drop')
+        q.push('c', 0)
+        self.assertEquals(q.pop_many(5), ['c', 'b'])
+
+    def test_offload(self):
+        q = qr.Queue('qrbounded', maxlen=1, overflow='drop', offload=100)
+        q.push('x' * 1000)
+        q.push('y' * 1000)
+        self.assertEquals(len(r.keys('qr:payload:*')), 1)
+        q = qr.Queue('qrbounded', maxlen=1, offload=100)
+        self.assertEquals(q.extend(['x' * 1000]), 0)
+        self.assertEquals(len(r.keys('qr:payload:*')), 1)
+        self.assertEquals(q.pop(), 'y' * 1000)
+        self.assertEquals(r.keys('qr:payload:*'), [])
+
+    def test_batch(self):
+        q = qr.Queue('qrbounded', maxlen=1)
+        with qr.batch() as b:
+            first = b.push(q, 'a')
+            second = b.push(q, 'b')
+        self.assertEquals((first.result(), second.result()), (1, 0))
+        self.assertEquals(q.elements(), ['a'])
+
+    def test_unboundable(self):
+        self.assertRaises(TypeError, qr.UniqueQueue, 'qrbounded', maxlen=1)
+        self.assertRaises(ValueError, qr.Queue, 'qrbounded', maxlen=1, overflow='spill')
+
+class Move(unittest.TestCase):
+    keys = ['qrmove', 'qrmove:a', 'qrmove:b']
+
+    def setUp(self):
+        r.delete(*self.keys)
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_requeue(self):
+        dead = qr.Stack('qrmove')
+        dead.extend(range(5))
+        q = qr.Queue('qrmove:a')
+        self.assertEquals(dead.move_to(q, chunk=2), 5)
+        self.assertEquals(len(dead), 0)
+        self.assertEquals(q.pop_many(5), [4, 3, 2, 1, 0])
+
+    def test_count(self):
+        q = qr.Queue('qrmove')
+        q.extend(range(5))
+        other = qr.Queue('qrmove:a')
+        self.assertEquals(q.move_to(other, count=3, chunk=2), 3)
+        self.assertEquals(other.pop_many(5), [0, 1, 2])
+        self.assertEquals(q.pop_many(5), [3, 4])
+
+    def test_big_chunk(self):
+        '''Chunks bigger than Lua's stack move in slices'''
+        q = qr.Queue('qrmove')
+        q.extend(range(10000))
+        pq = qr.PriorityQueue('qrmove:a')
+        self.assertEquals(q.move_to(pq, chunk=10000), 10000)
+        self.assertEquals(pq.move_to(qr.Queue('qrmove:b'), chunk=10000), 10000)
+        self.assertEquals(len(qr.Queue('qrmove:b')), 10000)
+
+    def test_scores(self):
+        pq = qr.PriorityQueue('qrmove')
+        pq.extend([('a', 1), ('b', 2), ('c', 3), ('d', 4)])
+        other = qr.PriorityQueue('qrmove:a')
+        self.assertEquals(pq.move_to(other, min_score=2, max_score=3), 2)
+        self.assertEquals(other.pop_many(5, withscores=True), [('b', 2.0), ('c', 3.0)])
+        q = qr.Queue('qrmove:b')
+        self.assertEquals(pq.move_to(q), 2)
+        self.assertEquals(q.pop_many(5), ['a', 'd'])
+        q.extend(['e', 'f'])
+        self.assertEquals(q.move_to(pq, score=7), 2)
+        self.assertEquals(pq.pop_many(5, withscores=True), [('e', 7.0), ('f', 7.0)])
+
+    def test_split(self):
+        q = qr.Queue('qrmove')
+        q.extend(range(6))
+        a, b = qr.Queue('qrmove:a', maxlen=1), qr.Queue('qrmove:b')
+        self.assertEquals(q.move_to([a, b], chunk=2), 6)
+        self.assertEquals(a.elements(), [0])
+        self.assertEquals(b.pop_many(5), [1, 2, 3, 4, 5])
+
+    def test_capped(self):
+        q = qr.Queue('qrmove')
+        q.extend(range(5))
+        capped = qr.CappedCollection('qrmove:a', size=2)
+        self.assertEquals(q.move_to(capped), 5)
+        self.assertEquals(capped.pop_many(5), [3, 4])
+
+    def test_unmovable(self):
+        q = qr.Queue('qrmove')
+        self.assertRaises(TypeError, q.move_to, qr.UniqueQueue('qrmove:a'))
+        self.assertRaises(ValueError, q.move_to, qr.Queue('qrmove:a', db=1))
+        self.assertRaises(ValueError, q.move_to, q)
+        self.assertRaises(ValueError, q.move_to, [qr.Queue('qrmove:b'), qr.Queue(q.key)])
+        self.assertRaises(ValueError, q.move_to, qr.Queue('qrmove:a', offload=100))
+        self.assertRaises(ValueError, qr.Queue('qrmove:a', offload=100).move_to, q)
+
+class Packed(unittest.TestCase):
+    def setUp(self):
+        self.q = qr.Queue('qrpacked', packed=3)
+        self.q.clear()
+
+    def tearDown(self):
+        self.q.clear()
+
+    def test_order(self):
+        self.q.extend(range(5))
+        self.q.push(5)
+        self.q.push(6)
+        self.assertEquals(len(self.q), 7)
+        self.assertEquals(r.llen('qrpacked'), 3)
+        self.assertEquals(self.q.peek(), 0)
+        self.assertEquals(self.q.elements(), [6, 5, 4, 3, 2, 1, 0])
+        self.assertEquals(list(self.q.iter_elements(page_size=3)), [6, 5, 4, 3, 2, 1, 0])
+        self.assertEquals(self.q.pop(), 0)
+        self.assertEquals(self.q.pop_many(4), [1, 2, 3, 4])
+        self.assertEquals(len(self.q), 2)
+        self.assertEquals(self.q.pop_many(5), [5, 6])
+        self.assertEquals(self.q.pop(), None)
+        self.assertEquals(len(self.q), 0)
+        self.assertFalse(r.exists('qrpacked:count'))
+
+    def test_blocking_pop(self):
+        self.assertEquals(self.q.pop_many(2, block=True, timeout=1), [])
+        threading.Timer(0.1, self.q.extend, [['a', 'b']]).start()
+        self.assertEquals(self.q.pop_many(5, block=True, timeout=1), ['a', 'b'])
+
+    def test_dump_load(self):
+        self.q.extend(range(7))
+        dumped = tempfile.TemporaryFile()
+        self.assertEquals(self.q.dump(dumped, chunk=2), 7)
+        dumped.seek(0)
+        # Dumps hold each element on its own, packed or not
+        plain = qr.Queue('qrpacked:plain')
+        self.assertEquals(plain.load(dumped), 7)
+        dumped = tempfile.TemporaryFile()
+        self.assertEquals(plain.dump(dumped), 7)
+        dumped.seek(0)
+        self.assertEquals(self.q.load(dumped), 7)
+        self.assertEquals(self.q.pop_many(10), list(range(7)))
+
+    def test_batch(self):
+        with qr.batch() as b:
+            b.push(self.q, 'a')
+            b.push(self.q, 'b')
+            count = b.len(self.q)
+            peeked = b.peek(self.q)
+            popped = b.pop(self.q)
+        self.assertEquals((count.result(), peeked.result(), popped.result()), (2, 'a', 'a'))
+        self.assertEquals(self.q.elements(), ['b'])
+
+    def test_capped(self):
+        capped = qr.CappedCollection('qrpacked', size=5, packed=3)
+        capped.extend(range(4))
+        capped.extend(range(4, 8))
+        self.assertEquals(len(capped), 5)
+        self.assertEquals(capped.pop_many(10), [3, 4, 5, 6, 7])
+
+    def test_options(self):
+        self.assertRaises(TypeError, qr.Stack, 'qrpacked', packed=3)
+        self.assertRaises(ValueError, qr.Queue, 'qrpacked', packed=3, offload=100)
+        self.assertRaises(TypeError, self.q.__getitem__, 0)
+
+class BucketPriorityQueue(unittest.TestCase):
+    def setUp(self):
+        self.q = qr.BucketPriorityQueue('qrbucket', levels=3)
+        self.q.clear()
+
+    def tearDown(self):
+        self.q.clear()
+
+    def test_scan(self):
+        self.q.extend([('a', 0), ('b', 2), ('c', 2)])
+        r.delete('qrbucketother')
+        qr.Queue('qrbucketother').push('x')
+        found = qr.BucketPriorityQueue.all('qrbucket*', levels=3)
+        self.assertEquals([q.key for q in found], ['qrbucket'])
+        self.assertEquals(found[0].pop_many(3), ['b', 'c', 'a'])
+        self.q.push('d', 1)
+        self.assertEquals([(q.key, size) for q, size in qr.BucketPriorityQueue.scan(
+            'qrbucket', count=1, withsizes=True, levels=3)], [('qrbucket', 1)])
+        r.delete('qrbucketother')
+
+    def test_order(self):
+        self.q.push('low')
+        self.q.push('high', 2)
+        self.q.extend([('middle', 1), ('higher', 2)])
+        self.assertEquals(len(self.q), 4)
+        self.assertEquals(self.q.peek(), 'high')
+        self.assertEquals(self.q.elements(), ['high', 'higher', 'middle', 'low'])
+        self.assertEquals(list(self.q.iter_elements(page_size=1)),
+            ['high', 'higher', 'middle', 'low'])
+        self.assertEquals(self.q.pop(), 'high')
+        self.assertEquals(self.q.pop_many(5), ['higher', 'middle', 'low'])
+        self.assertEquals(self.q.pop(), None)
+        self.assertEquals(self.q.peek(), None)
+
+    def test_levels(self):
+        self.assertRaises(ValueError, self.q.push, 'too high', 3)
+        self.assertRaises(ValueError, self.q.push, 'too low', -1)
+
+    def test_blocking_pop(self):
+        self.q.extend([('a', 0), ('b', 1)])
+        self.assertEquals(self.q.pop_many(2, block=True, timeout=1), ['b', 'a'])
+        self.assertEquals(self.q.pop(block=True, timeout=1), None)
+
+    def test_dump_load(self):
+        self.q.extend([('a', 0), ('b', 2), ('c', 1)])
+        dumped = tempfile.TemporaryFile()
+        self.assertEquals(self.q.dump(dumped), 3)
+        self.assertEquals(len(self.q), 0)
+        dumped.seek(0)
+        self.assertEquals(self.q.load(dumped), 3)
+        self.assertEquals(self.q.elements(), ['b', 'c', 'a'])
+
+    def test_batch(self):
+        self.q.extend([('a', 0), ('b', 2)])
+        with qr.batch() as b:
+            length = b.len(self.q)
+            head = b.peek(self.q)
+            popped = b.pop(self.q)
+        self.assertEquals(length.result(), 2)
+        self.assertEquals(head.result(), 'b')
+        self.assertEquals(popped.result(), 'b')
+
+class Batch(unittest.TestCase):
+    def setUp(self):
+        r.delete('qrbatchqueue', 'qrbatchstack', 'qrbatchpriority')
+        self.queue = qr.Queue('qrbatchqueue')
+        self.stack = qr.Stack('qrbatchstack')
+        self.priority = qr.PriorityQueue('qrbatchpriority')
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_batch(self):
+        self.queue.extend(['a', 'b'])
+        self.stack.extend(['x', 'y'])
+        with qr.batch() as b:
+            pushed = b.push(self.priority, 'high', 1)
+            b.push(self.priority, 'low', 0)
+            length = b.len(self.queue)
+            head = b.peek(self.queue)
+            popped = [b.pop(self.queue), b.pop(self.stack), b.pop(self.priority)]
+            empty = b.pop(qr.Queue('qrbatchempty'))
+            self.assertRaises(RuntimeError, length.result)
+        self.assertEquals(pushed.result(), None)
+        self.assertEquals(length.result(), 2)
+        self.assertEquals(head.result(), 'a')
+        self.assertEquals([f.result() for f in popped], ['a', 'y', 'low'])
+        self.assertEquals(empty.result(), None)
+        self.assertEquals(len(self.priority), 1)
+
+    def test_transaction(self):
+        with qr.batch(transaction=True) as b:
+            b.push(self.queue, 'a')
+            popped = b.pop(self.queue)
+        self.assertEquals(popped.result(), 'a')
+
+    def test_errors(self):
+        r.set('qrbatchqueue', 'not a list')
+        with qr.batch() as b:
+            broken = b.pop(self.queue)
+            length = b.len(self.stack)
+        self.assertRaises(redis.ResponseError, broken.result)
+        self.assertEquals(length.result(), 0)
+        self.assertRaises(TypeError, b.pop, qr.DelayedQueue('qrbatchdelayed'))
+
+    def test_abandoned(self):
+        try:
+            with qr.batch() as b:
+                b.push(self.queue, 'a')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEquals(len(self.queue), 0)
+
+class Batcher(unittest.TestCase):
+    def setUp(self):
+        r.delete('qrtestbatcher')
+        self.q = qr.Queue(key='qrtestbatcher')
+
+    def test_count(self):
+        batcher = qr.Batcher(self.q, count=3)
+        batcher.extend(['a', 'b'])
+        self.assertEquals(len(self.q), 0)
+        batcher.push('c')
+        self.assertEquals(len(batcher), 0)
+        self.assertEquals(self.q.pop_many(5), ['a', 'b', 'c'])
+        batcher.push('d')
+        batcher.close()
+        self.assertEquals(self.q.pop_many(5), ['d'])
+
+    def test_size(self):
+        with qr.Batcher(self.q, count=100, size=100) as batcher:
+            batcher.push('x' * 50)
+            self.assertEquals(len(self.q), 0)
+            batcher.push('y' * 50)
+            self.assertEquals(len(self.q), 2)
+            batcher.push('z')
+        self.assertEquals(len(self.q), 3)
+
+    def test_linger(self):
+        batcher = qr.Batcher(self.q, count=100, linger=0.05, background=True)
+        batcher.push('a')
+        time.sleep(0.5)
+        self.assertEquals(self.q.pop(), 'a')
+        batcher.close()
+
+    def test_priority_queue(self):
+        r.delete('qrtestbatcherpq')
+        q = qr.PriorityQueue(key='qrtestbatcherpq')
+        with qr.Batcher(q) as batcher:
+            batcher.push('foo', 2)
+            batcher.extend([('bar', 1)])
+        self.assertEquals(q.pop_many(2), ['bar', 'foo'])
+
+    def test_accepted(self):
+        q = qr.Queue(key='qrtestbatcher', maxlen=2)
+        batcher = qr.Batcher(q)
+        batcher.extend(['a', 'b', 'c'])
+        self.assertEquals(batcher.flush(), 2)
+        self.assertEquals(len(batcher), 0)
+        batcher.close()
+        self.assertEquals(q.pop_many(5), ['a', 'b'])
+
+    @unittest.skipUnless(hasattr(atexit, 'unregister'), 'needs Python 3')
+    def test_unregister(self):
+        '''Closing a Batcher lets go of it at exit'''
+        batcher = qr.Batcher(self.q)
+        batcher.close()
+        ref = weakref.ref(batcher)
+        del batcher
+        gc.collect()
+        self.assertTrue(ref() is None)
+
+class Unprintable(object):
+    def __eq__(self, other):
+        return isinstance(other, Unprintable)
+
+    def __repr__(self):
+        raise AssertionError('Formatted an element while logging was off')
+
+class Instrumentation(unittest.TestCase):
+    def setUp(self):
+        r.delete('qrtestmetrics')
+        self.q = qr.Queue(key='qrtestmetrics')
+        self.metrics = qr.instrument(qr.Metrics())
+
+    def tearDown(self):
+        qr.uninstrument(self.metrics)
+
+    def test_metrics(self):
+        self.q.push('foo')
+        self.q.pop()
+        self.q.pop_many(5)
+        self.assertRaises(TypeError, self.q.pop_many)
+        snapshot = self.metrics.snapshot()
+        operations = snapshot['operations']
+        self.assertEquals(operations[('Queue', 'qrtestmetrics', 'push')]['count'], 1)
+        self.assertEquals(operations[('Queue', 'qrtestmetrics', 'pop_many')]['count'], 2)
+        self.assertEquals(operations[('Queue', 'qrtestmetrics', 'pop_many')]['errors'], 1)
+        packed = snapshot['payloads'][('Queue', 'qrtestmetrics', 'pack')]
+        self.assertEquals(packed['count'], 1)
+        self.assertEquals(packed['bytes'], len(self.q.serializer.dumps('foo')))
+        text = self.metrics.prometheus()
+        self.assertTrue('qr_operation_seconds_count{structure="Queue",'
+            'key="qrtestmetrics",operation="push"} 1' in text)
+        self.assertTrue('qr_payload_bytes_bucket{structure="Queue",'
+            'key="qrtestmetrics",direction="pack",le="+Inf"} 1' in text)
+
+    def test_broken_hook(self):
+        class Broken(qr.Instrument):
+            def operation(self, *args):
+                raise ValueError()
+        broken = qr.instrument(Broken())
+        try:
+            self.q.push('foo')
+            self.assertEquals(self.q.pop(), 'foo')
+        finally:
+            qr.uninstrument(broken)
+
+    def test_lazy_logging(self):
+        qr.uninstrument(self.metrics)
+        self.q.push(Unprintable())
+        self.assertEquals(self.q.pop_many(1), [Unprintable()])
+        qr.instrument(self.metrics)
+
+class Pools(unittest.TestCase):
+    def tearDown(self):
+        qr.closePools()
+
+    def test_canonical(self):
+        qr.closePools()
+        qr.getRedis(db=0, socket_timeout=5)
+        qr.getRedis(socket_timeout=5, db=0)
+        self.assertEquals(len(qr.connectionPools), 1)
+
+    def test_options(self):
+        qr.getRedis(blocking_pool=True, max_connections=2, pool_timeout=1)
+        pool = qr.connectionPools[qr.poolKey({'blocking_pool': True,
+            'max_connections': 2, 'pool_timeout': 1})]
+        self.assertTrue(isinstance(pool, qr.BlockingConnectionPool))
+        self.assertEquals(pool.max_connections, 2)
+
+    def test_stats(self):
+        pool = qr.ConnectionPool()
+        connection = pool.get_connection('PING')
+        self.assertEquals(pool.stats()['in_use'], 1)
+        pool.release(connection)
+        pool.release(pool.get_connection('PING'))
+        stats = pool.stats()
+        self.assertEquals(stats['in_use'], 0)
+        self.assertEquals(stats['created'], 1)
+        self.assertEquals(stats['checkouts'], 2)
+        pool.disconnect()
+
+    def test_waits(self):
+        pool = qr.BlockingConnectionPool(max_connections=1, timeout=0.1)
+        connection = pool.get_connection('PING')
+        self.assertRaises(redis.ConnectionError, pool.get_connection, 'PING')
+        pool.release(connection)
+        self.assertEquals(pool.stats()['waits'], 1)
+        pool.disconnect()
+
+    def test_fork(self):
+        qr.getRedis(db=0)
+        pools = qr.connectionPools
+        # Pretend that this is a child of the process that made the pools
+        qr.poolsPid = -1
+        qr.getRedis(db=0)
+        self.assertTrue(qr.connectionPools is not pools)
+        self.assertEquals(len(qr.connectionPools), 1)
+
+class Offload(unittest.TestCase):
+    big = 'x' * 1000
+
+    def setUp(self):
+        r.delete('qroffload')
+        for key in r.keys('qr:payload:*'):
+            r.delete(key)
+        self.q = qr.Queue('qroffload', offload=100)
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_roundtrip(self):
+        self.q.extend([self.big, 'small'])
+        raw = r.lrange('qroffload', 0, -1)
+        self.assertTrue(raw[1].startswith(qr.refMarker))
+        self.assertTrue(len(raw[1]) < 100)
+        self.assertEquals(len(r.keys('qr:payload:*')), 1)
+        self.assertEquals(self.q.elements(), ['small', self.big])
+        self.assertEquals(self.q.peek(), self.big)
+        self.assertEquals(self.q.pop_many(5), [self.big, 'small'])
+        self.assertEquals(r.keys('qr:payload:*'), [])
+
+    def test_shared(self):
+        self.q.push(self.big)
+        self.q.push(self.big)
+        self.assertEquals(len(r.keys('qr:payload:*')), 1)
+        self.assertEquals(self.q.pop(), self.big)
+        self.assertEquals(len(r.keys('qr:payload:*')), 1)
+        self.assertEquals(self.q.pop(), self.big)
+        self.assertEquals(r.keys('qr:payload:*'), [])
+
+    def test_ttl(self):
+        q = qr.Queue('qroffload', offload=100, offload_ttl=60)
+        q.push(self.big)
+        self.assertTrue(0 < r.ttl(r.keys('qr:payload:*')[0]) <= 60)
+        self.assertRaises(ValueError, qr.Queue, 'qroffload', offload=100,
+            offload_ttl=60, spool=tempfile.gettempdir())
+
+    def test_spool(self):
+        spool = tempfile.mkdtemp()
+        try:
+            q = qr.Queue('qroffload', offload=100, spool=spool)
+            q.extend([self.big, self.big, 'small'])
+            self.assertEquals(len(os.listdir(spool)), 1)
+            self.assertEquals(r.hget(r.keys('qr:payload:*')[0], 'data'), None)
+            self.assertEquals(q.pop_many(2), [self.big, self.big])
+            self.assertEquals(os.listdir(spool), [])
+            self.assertEquals(q.pop(), 'small')
+        finally:
+            shutil.rmtree(spool)
+
+    def test_reliable(self):
+        r.delete('qroffload:processing:me', 'qroffload:deadlines:me')
+        q = qr.ReliableQueue('qroffload', consumer='me', offload=100)
+        q.push(self.big)
+        self.assertEquals(q.pop(), self.big)
+        self.assertTrue(q.nack(self.big))
+        self.assertEquals(q.pop(), self.big)
+        self.assertTrue(q.ack(self.big))
+        self.assertEquals(r.keys('qr:payload:*'), [])
+        r.delete('qroffload:consumers')
+
+    def test_priority(self):
+        q = qr.PriorityQueue('qroffload', offload=100)
+        q.extend([(self.big, 2), ('small', 1)])
+        self.assertEquals(q.peek_many(2), ['small', self.big])
+        self.assertEquals(q.pop_many(2), ['small', self.big])
+        self.assertEquals(r.keys('qr:payload:*'), [])
+
+    def test_dump(self):
+        '''Dumps hold the payloads, and loading offloads them again'''
+        self.q.extend([self.big, 'small'])
+        with tempfile.TemporaryFile() as f:
+            self.assertEquals(self.q.dump(f), 2)
+            self.assertEquals(r.keys('qr:payload:*'), [])
+            f.seek(0)
+            self.assertEquals(qr.Queue('qroffload').load(f), 2)
+            self.assertEquals(qr.Queue('qroffload').pop_many(2), [self.big, 'small'])
+            f.seek(0)
+            self.assertEquals(self.q.load(f), 2)
+        self.assertEquals(len(r.keys('qr:payload:*')), 1)
+        self.assertEquals(self.q.pop_many(2), [self.big, 'small'])
+        self.assertEquals(r.keys('qr:payload:*'), [])
+
+    def test_dump_priority(self):
+        q = qr.PriorityQueue('qroffload', offload=100)
+        q.extend([(self.big, 2), ('small', 1)])
+        with tempfile.TemporaryFile() as f:
+            q.dump(f, format='length')
+            self.assertEquals(r.keys('qr:payload:*'), [])
+            f.seek(0)
+            q.load(f, format='length')
+        self.assertEquals(len(r.keys('qr:payload:*')), 1)
+        self.assertEquals(q.pop_many(2), ['small', self.big])
+
+    def test_trimmed(self):
+        '''Elements trimmed off a capped collection drop their payloads'''
+        for kwargs in [{'size': 1}, {'size': 1, 'window': 60}, {'size': 1, 'trim': 'every', 'every': 2}]:
+            r.delete('qroffload')
+            c = qr.CappedCollection('qroffload', offload=100, **kwargs)
+            c.push(self.big)
+            c.extend(['small', 'other'])
+            self.assertEquals(r.keys('qr:payload:*'), [])
+            self.assertEquals(c.pop(), 'other')
+        window = qr.CappedCollection('qroffload', window=0.01, offload=100)
+        window.push(self.big)
+        time.sleep(0.02)
+        window.push('small')
+        self.assertEquals(r.keys('qr:payload:*'), [])
+
+    def test_moved_trimmed(self):
+        r.delete('qroffloadcapped')
+        c = qr.CappedCollection('qroffloadcapped', size=1, offload=100)
+        self.q.extend([self.big, 'small'])
+        self.assertEquals(self.q.move_to(c), 2)
+        self.assertEquals(r.keys('qr:payload:*'), [])
+        self.assertEquals(c.pop(), 'small')
+
+    def test_clear(self):
+        for q in [self.q, qr.UniqueQueue('qroffload', offload=100),
+            qr.PriorityQueue('qroffload', offload=100),
+            qr.BucketPriorityQueue('qroffload', offload=100)]:
+            q.clear()
+            if isinstance(q, (qr.PriorityQueue, qr.BucketPriorityQueue)):
+                q.extend([(self.big, 1), ('small', 0)])
+            else:
+                q.extend([self.big, 'small'])
+            self.assertEquals(len(r.keys('qr:payload:*')), 1)
+            q.clear()
+            self.assertEquals(r.keys('qr:payload:*'), [])
+            self.assertEquals(len(q), 0)
+
+    def test_stream(self):
+        self.assertRaises(ValueError, qr.StreamQueue, 'qroffload', maxlen=10, offload=100)
+
+    def test_unique(self):
+        '''Skipped duplicates don't keep their payloads around'''
+        q = qr.UniqueQueue('qroffload', offload=100)
+        q.clear()
+        self.assertTrue(q.push(self.big))
+        self.assertFalse(q.push(self.big))
+        self.assertEquals(q.extend([self.big, 'small']), 1)
+        self.assertEquals(q.pop(), self.big)
+        self.assertEquals(r.keys('qr:payload:*'), [])
+        q.clear()
+
+    def test_reliable_clear(self):
+        q = qr.ReliableQueue('qroffload', consumer='me', offload=100)
+        q.push(self.big)
+        q.clear()
+        self.assertEquals(r.keys('qr:payload:*'), [])
+        r.delete('qroffload:consumers')
+
+    def test_refused(self):
+        '''Loads and Batchers drop the payloads of elements a bound refused'''
+        q = qr.Queue('qroffload', maxlen=1, offload=100)
+        batcher = qr.Batcher(q)
+        batcher.extend(['small', self.big])
+        self.assertEquals(batcher.flush(), 1)
+        batcher.close()
+        self.assertEquals(r.keys('qr:payload:*'), [])
+        self.assertEquals(q.pop(), 'small')
+
+class Discovery(unittest.TestCase):
+    def setUp(self):
+        for key in r.keys('qrtestscan*'):
+            r.delete(key)
+        qr.Queue(key='qrtestscan:a').extend([1, 2])
+        qr.Queue(key='qrtestscan:b').push(1)
+        qr.PriorityQueue(key='qrtestscan:c').push(1, 1)
+
+    def test_all(self):
+        queues = qr.Queue.all('qrtestscan:*')
+        self.assertEquals(sorted(q.key for q in queues), ['qrtestscan:a', 'qrtestscan:b'])
+        self.assertEquals([q.key for q in qr.PriorityQueue.all('qrtestscan:*')], ['qrtestscan:c'])
+
+    def test_scan(self):
+        sizes = dict((q.key, size) for q, size in
+            qr.Queue.scan('qrtestscan:*', count=1, withsizes=True))
+        self.assertEquals(sizes, {'qrtestscan:a': 2, 'qrtestscan:b': 1})
+        capped = list(qr.CappedCollection.scan('qrtestscan:*', size=5))
+        self.assertEquals(set(c.size for c in capped), set([5]))
+
+class Serializer(unittest.TestCase):
+    def setUp(self):
+        r.delete('qrtestserializer')
+
+    def test_named(self):
+        for name in ('pickle', 'json', 'marshal'):
+            q = qr.Queue(key='qrtestserializer', serializer=name)
+            q.push({'key': [1, 2, 3]})
+            self.assertEquals(q.pop(), {'key': [1, 2, 3]})
+        self.assertRaises(ValueError, qr.Queue, 'qrtestserializer', serializer='nope')
+
+    def test_compress(self):
+        q = qr.Queue(key='qrtestserializer', serializer='json', compress=100)
+        small, large = 'foo', 'x' * 1000
+        q.extend([small, large])
+        raw = r.lrange('qrtestserializer', 0, -1)
+        self.assertTrue(len(raw[0]) < 100)
+        self.assertEquals(raw[1][:1], qr.CompressedSerializer.PLAIN)
+        self.assertEquals(q.pop_many(2), [small, large])
+
+    def test_empty(self):
+        '''Every serializer gives None for a missing element'''
+        for name in ('pickle', 'json', 'marshal'):
+            q = qr.Queue(key='qrtestserializer', serializer=name)
+            q.clear()
+            self.assertEquals(q.pop(), None)
+            self.assertEquals(q.peek(), None)
+            self.assertEquals(q[0], None)
+
+    def test_compress_legacy(self):
+        '''Payloads pushed before compression was turned on still load'''
+        qr.Queue(key='qrtestserializer').push({'a': 1})
+        qr.Queue(key='qrtestserializer', serializer='json').push([1])
+        q = qr.Queue(key='qrtestserializer', compress=True)
+        self.assertEquals(q.pop(), {'a': 1})
+        q = qr.Queue(key='qrtestserializer', serializer='json', compress=True)
+        self.assertEquals(q.pop(), [1])
+
+class Workers(unittest.TestCase):
+    def setUp(self):
+        r.delete('qrtestworkers')
+        self.q = qr.Queue(key='qrtestworkers')
+
+    def test_drain(self):
+        count = 50
+        seen = []
+        self.q.extend(range(count))
+        def handle(message):
+            if message % 10 == 0:
+                raise ValueError(message)
+            seen.append(message)
+            if len(seen) >= count - 5:
+                pool.stop()
+        pool = qr.workers(self.q, concurrency=3, prefetch=4, timeout=1)
+        run = pool(handle)
+        run()
+        self.assertEquals(sorted(seen), [i for i in range(count) if i % 10])
+        self.assertEquals(len(self.q), 0)
+        stats = run.stats()
+        self.assertEquals(len(stats), 3)
+        self.assertEquals(sum(s['processed'] for s in stats), count - 5)
+        self.assertEquals(sum(s['failed'] for s in stats), 5)
+
+class ShardedQueue(unittest.TestCase):
+    # Two databases on the same server stand in for two servers
+    shards = [{'db': 0}, {'db': 1}]
+
+    def setUp(self):
+        self.q = qr.ShardedQueue('qrsharded', self.shards)
+        self.q.clear()
+
+    def tearDown(self):
+        self.q.clear()
+
+    def test_roundrobin(self):
+        self.q.extend(range(10))
+        self.assertEquals(len(self.q), 10)
+        self.assertEquals([len(shard) for shard in self.q.shards], [5, 5])
+        self.assertEquals(sorted(self.q.pop_many(20)), list(range(10)))
+        self.assertEquals(self.q.pop(), None)
+
+    def test_hash(self):
+        q = qr.ShardedQueue('qrsharded', self.shards, placement='hash')
+        for i in range(3):
+            q.push('same')
+        self.assertEquals(sorted(len(shard) for shard in q.shards), [0, 3])
+        self.assertRaises(ValueError, qr.ShardedQueue, 'qrsharded',
+            self.shards, placement='random')
+
+    def test_fair(self):
+        self.q.shards[0].extend(['a'] * 10)
+        self.q.shards[1].extend(['b'] * 10)
+        popped = [self.q.pop() for i in range(4)]
+        self.assertEquals(sorted(popped), ['a', 'a', 'b', 'b'])
+
+    def test_blocking_pop(self):
+        self.q.shards[1].push('late')
+        self.assertEquals(self.q.pop(block=True, timeout=2), 'late')
+        start = time.time()
+        self.assertEquals(self.q.pop(block=True, timeout=0.2), None)
+        self.assertTrue(time.time() - start < 0.6)
+
+    def test_priority(self):
+        q = qr.ShardedPriorityQueue('qrshardedpriority', self.shards)
+        q.clear()
+        q.extend((i, i) for i in range(20))
+        q.push(5, 100)
+        self.assertEquals(len(q), 20)
+        self.assertTrue(all(len(shard) for shard in q.shards))
+        self.assertEquals(q.pop_many(3), [0, 1, 2])
+        self.assertEquals(q.pop(), 3)
+        self.assertEquals(q.pop_many(100)[-1], 5)
+        self.assertEquals(q.pop(block=True, timeout=1), None)
+
 class CappedCollection(unittest.TestCase):
     def setUp(self):
         r.delete('qrtestcc')
@@ -148,6 +985,55 @@ class CappedCollection(unittest.TestCase):
         self.assertEquals(len(self.aq), self.aq.size)
         self.aq.clear()
 
+    def test_pop_many(self):
+        self.aq.extend(['a', 'b', 'c', 'd'])
+        self.assertEquals(self.aq.pop_many(2), ['b', 'c'])
+        self.assertEquals(self.aq.pop_many(2), ['d'])
+        self.assertEquals(len(self.aq), 0)
+
+    def test_trim_every(self):
+        aq = qr.CappedCollection('qrtestcc', size=3, trim='every', every=4)
+        for i in range(3):
+            aq.push(i)
+        aq.push(3)
+        self.assertEquals(len(aq), 3)
+        for i in range(4, 7):
+            aq.push(i)
+        self.assertEquals(len(aq), 6)
+        aq.extend([7, 8])
+        self.assertEquals(aq.elements(), [8, 7, 6])
+
+    def test_trim_random(self):
+        aq = qr.CappedCollection('qrtestcc', size=3, trim='random', every=1)
+        aq.extend(range(10))
+        self.assertEquals(len(aq), 3)
+        self.assertRaises(ValueError, qr.CappedCollection, 'qrtestcc', 3,
+            trim='sometimes')
+
+    def test_window(self):
+        aq = qr.CappedCollection('qrtestcc', window=60)
+        # Elements stamped two minutes ago
+        stamp = ('%017.6f' % (time.time() - 120)).encode('ascii')
+        r.lpush('qrtestcc', stamp + aq.serializer.dumps('older'),
+            stamp + aq.serializer.dumps('old'))
+        aq.push('new')
+        self.assertEquals(aq.elements(), ['new'])
+        self.assertEquals(aq.pop(), 'new')
+        self.assertRaises(ValueError, qr.CappedCollection, 'qrtestcc')
+
+class Deque(unittest.TestCase):
+    def setUp(self):
+        r.delete('qrtestdeque')
+        self.d = qr.Deque(key='qrtestdeque')
+
+    def test_pop_many(self):
+        for i in range(6):
+            self.d.push_back(i)
+        self.assertEquals(self.d.pop_many_front(2), [0, 1])
+        self.assertEquals(self.d.pop_many_back(2), [5, 4])
+        self.assertEquals(self.d.pop_many_front(10), [2, 3])
+        self.assertEquals(self.d.pop_many_back(10), [])
+
 class Stack(unittest.TestCase):
     def setUp(self):
         r.delete('qrteststack')
@@ -203,12 +1089,18 @@ class Stack(unittest.TestCase):
             last = now
         self.stack.clear()
 
+    def test_pop_many(self):
+        self.stack.extend(range(5))
+        self.assertEquals(self.stack.pop_many(2), [4, 3])
+        self.assertEquals(self.stack.pop_many(10), [2, 1, 0])
+        self.assertEquals(self.stack.pop_many(1), [])
+
     def test_dump_load(self):
         # Get a temporary file to dump a queue to that file
         count = 100
         self.stack.extend(range(count))
         self.assertEquals(self.stack.elements(), [count - i - 1 for i in range(count)])
-        with os.tmpfile() as f:
+        with tempfile.TemporaryFile() as f:
             self.stack.dump(f)
             # Now, assert that it is empty
             self.assertEquals(len(self.stack), 0)
@@ -221,6 +1113,234 @@ class Stack(unittest.TestCase):
             f.truncate()
             self.stack.clear()
 
+class StreamQueue(unittest.TestCase):
+    def setUp(self):
+        r.delete('qrstream')
+        self.q = qr.StreamQueue('qrstream')
+
+    def tearDown(self):
+        r.delete('qrstream')
+
+    def test_roundtrip(self):
+        self.q.push('foo')
+        self.q.extend(['bar', 'baz'])
+        self.assertEquals(len(self.q), 3)
+        self.assertEquals(self.q.peek(), 'foo')
+        self.assertEquals(self.q.pop(), 'foo')
+        self.assertEquals(self.q.pop_many(5), ['bar', 'baz'])
+        self.assertEquals(self.q.pop(), None)
+        self.assertEquals(self.q.pending(), 0)
+
+    def test_groups(self):
+        other = qr.StreamQueue('qrstream', group='other')
+        self.q.extend(range(3))
+        self.assertEquals(self.q.pop_many(3), [0, 1, 2])
+        self.assertEquals(other.pop_many(3), [0, 1, 2])
+
+    def test_consumers(self):
+        first = qr.StreamQueue('qrstream', consumer='first')
+        second = qr.StreamQueue('qrstream', consumer='second')
+        self.q.extend(range(4))
+        self.assertEquals(first.pop_many(2) + second.pop_many(5), [0, 1, 2, 3])
+
+    def test_ack_and_reclaim(self):
+        dead = qr.StreamQueue('qrstream', consumer='dead', autoack=False)
+        alive = qr.StreamQueue('qrstream', consumer='alive', autoack=False)
+        self.q.extend(['a', 'b'])
+        popped = dead.pop_many(2, withids=True)
+        self.assertEquals([element for id, element in popped], ['a', 'b'])
+        self.assertEquals(dead.pending(), 2)
+        self.assertEquals(dead.ack(popped[0][0]), 1)
+        self.assertEquals(alive.reclaim(idle=60), [])
+        reclaimed = alive.reclaim(idle=0)
+        self.assertEquals(reclaimed, popped[1:])
+        self.assertEquals(alive.ack(*[id for id, element in reclaimed]), 1)
+        self.assertEquals(alive.pending(), 0)
+
+    def test_maxlen(self):
+        q = qr.StreamQueue('qrstream', maxlen=5, approximate=False)
+        q.extend(range(20))
+        self.assertEquals(len(q), 5)
+        self.assertEquals(q.elements(), [15, 16, 17, 18, 19])
+        self.assertEquals(list(q.iter_elements(page_size=2)), [15, 16, 17, 18, 19])
+
+    def test_blocking_pop(self):
+        start = time.time()
+        self.assertEquals(self.q.pop(block=True, timeout=0.2), None)
+        self.assertTrue(time.time() - start < 2)
+        self.q.push('foo')
+        self.assertEquals(self.q.pop(block=True, timeout=1), 'foo')
+
+    def test_dump_load(self):
+        self.q.extend(range(5))
+        dumped = tempfile.TemporaryFile()
+        self.assertEquals(self.q.dump(dumped, chunk=2), 5)
+        self.assertEquals(len(self.q), 0)
+        dumped.seek(0)
+        self.assertEquals(self.q.load(dumped), 5)
+        self.assertEquals(self.q.elements(), list(range(5)))
+
+class MultiQueue(unittest.TestCase):
+    def setUp(self):
+        self.queues = []
+        for key in ('qrtestmultia', 'qrtestmultib', 'qrtestmultic'):
+            r.delete(key)
+            self.queues.append(qr.Queue(key=key))
+
+    def test_priority(self):
+        a, b, c = self.queues
+        m = qr.MultiQueue(self.queues)
+        b.extend(['b1', 'b2'])
+        c.push('c1')
+        self.assertEquals(len(m), 3)
+        self.assertEquals(m.pop(withkey=True), ('qrtestmultib', 'b1'))
+        a.push('a1')
+        self.assertEquals(m.pop_many(5), ['a1', 'b2', 'c1'])
+        self.assertEquals(m.pop(block=True, timeout=1), None)
+        c.push('c2')
+        self.assertEquals(m.pop_many(5, block=True, timeout=1, withkey=True),
+            [('qrtestmultic', 'c2')])
+
+    def test_weighted(self):
+        a, b, c = self.queues
+        m = qr.MultiQueue(self.queues, weights=[3, 1, 0])
+        a.extend(['a'] * 10)
+        b.extend(['b'] * 10)
+        c.extend(['c'] * 10)
+        self.assertEquals(sorted(m.pop_many(8)), ['a'] * 6 + ['b'] * 2)
+        # Unused share goes to the other queues
+        a.clear()
+        self.assertEquals(sorted(m.pop_many(10)), ['b'] * 8 + ['c'] * 2)
+        self.assertTrue(m.remove('qrtestmultic'))
+        self.assertEquals(m.pop_many(10), [])
+
+    def test_add(self):
+        m = qr.MultiQueue(self.queues)
+        self.assertRaises(ValueError, m.add, qr.Queue('qrtestmultid', packed=3))
+        self.assertRaises(ValueError, m.add, qr.PriorityQueue('qrtestmultid'))
+        self.assertRaises(ValueError, m.add, qr.UniqueQueue('qrtestmultid'))
+
+class UniqueQueue(unittest.TestCase):
+    def setUp(self):
+        self.q = qr.UniqueQueue('qrunique')
+        self.q.clear()
+
+    def tearDown(self):
+        self.q.clear()
+
+    def test_push(self):
+        self.assertTrue(self.q.push('a'))
+        self.assertFalse(self.q.push('a'))
+        self.assertEquals(len(self.q), 1)
+        self.assertEquals(r.scard('qrunique:fingerprints'), 1)
+        self.assertEquals(len(r.smembers('qrunique:fingerprints').pop()), 16)
+
+    def test_extend(self):
+        self.q.push('a')
+        self.assertEquals(self.q.extend(['a', 'b', 'c', 'b']), 2)
+        self.assertEquals(self.q.extend([]), 0)
+        self.assertEquals(self.q.pop_many(5), ['a', 'b', 'c'])
+
+    def test_pop_forgets(self):
+        self.q.extend(['a', 'b'])
+        self.assertEquals(self.q.pop(), 'a')
+        self.assertTrue(self.q.push('a'))
+        self.assertEquals(self.q.pop_many(5), ['b', 'a'])
+        self.assertEquals(r.scard('qrunique:fingerprints'), 0)
+
+    def test_blocking_pop(self):
+        self.q.push('a')
+        self.assertEquals(self.q.pop(block=True, timeout=1), 'a')
+        self.assertEquals(self.q.pop(block=True, timeout=1), None)
+        self.assertTrue(self.q.push('a'))
+        self.assertEquals(self.q.pop(), 'a')
+        threading.Timer(0.1, self.q.push, ['late']).start()
+        self.assertEquals(self.q.pop(block=True, timeout=2), 'late')
+        self.assertEquals(r.scard('qrunique:fingerprints'), 0)
+
+    def test_dump_load(self):
+        self.q.extend(range(5))
+        dumped = tempfile.TemporaryFile()
+        self.assertEquals(self.q.dump(dumped), 5)
+        self.assertEquals(r.scard('qrunique:fingerprints'), 0)
+        self.q.push(0)
+        dumped.seek(0)
+        self.q.load(dumped)
+        self.assertEquals(self.q.elements(), [4, 3, 2, 1, 0])
+
+class ReliableQueue(unittest.TestCase):
+    def setUp(self):
+        for key in r.keys('qrtestreliable*'):
+            r.delete(key)
+        self.q = qr.ReliableQueue(key='qrtestreliable', consumer='a', timeout=30)
+
+    def test_ack(self):
+        self.q.extend(['foo', 'bar'])
+        self.assertEquals(self.q.pop(), 'foo')
+        self.assertEquals(len(self.q), 1)
+        self.assertEquals(self.q.in_flight(), 1)
+        self.assertTrue(self.q.ack('foo'))
+        self.assertFalse(self.q.ack('foo'))
+        self.assertEquals(self.q.in_flight(), 0)
+
+    def test_nack(self):
+        self.q.extend(['foo', 'bar'])
+        self.assertEquals(self.q.pop_many(5), ['foo', 'bar'])
+        self.assertTrue(self.q.nack('bar'))
+        self.assertEquals(self.q.in_flight(), 1)
+        self.assertEquals(self.q.pop(block=True, timeout=1), 'bar')
+
+    def test_reap(self):
+        dead = qr.ReliableQueue(key='qrtestreliable', consumer='b', timeout=-1)
+        self.q.extend(['foo', 'bar', 'baz'])
+        self.assertEquals(dead.pop_many(2), ['foo', 'bar'])
+        self.assertEquals(self.q.pop(), 'baz')
+        self.assertEquals(self.q.reap(), 2)
+        self.assertEquals(dead.in_flight(), 0)
+        self.assertEquals(self.q.in_flight(), 1)
+        self.assertEquals(self.q.pop_many(5), ['foo', 'bar'])
+        self.assertEquals(self.q.reap(), 0)
+
+    def test_blocking_pop(self):
+        self.assertEquals(self.q.pop(block=True, timeout=0.1), None)
+        threading.Timer(0.1, self.q.push, ['late']).start()
+        self.assertEquals(self.q.pop(block=True, timeout=2), 'late')
+        # What's in flight always has a deadline to be reaped by
+        self.assertEquals(r.zcard('qrtestreliable:deadlines:a'), 1)
+
+    def test_leases(self):
+        dead = qr.ReliableQueue(key='qrtestreliable', consumer='b', timeout=-1)
+        self.q.extend(['a', 'a', {'n': 1}])
+        (first, a), (second, same) = dead.pop_many(2, withleases=True)
+        self.assertNotEquals(first, second)
+        # Equal elements in flight have a lease each
+        self.assertTrue(dead.ack('a'))
+        self.assertEquals(dead.in_flight(), 1)
+        self.assertEquals(self.q.reap(), 1)
+        self.assertEquals(self.q.pop(), 'a')
+        lease, element = self.q.pop(withlease=True)
+        element['n'] = 2
+        self.assertFalse(self.q.touch(element))
+        self.assertTrue(self.q.touch(lease=lease))
+        self.assertTrue(self.q.ack(lease=lease))
+        self.assertFalse(self.q.ack(lease=lease))
+        self.assertEquals(self.q.pop(withlease=True), (None, None))
+        # Leases are forgotten however their elements leave
+        self.assertTrue(self.q.ack('a'))
+        self.assertEquals(r.hlen('qrtestreliable:leased:a'), 0)
+        self.assertEquals(r.hlen('qrtestreliable:leased:b'), 0)
+
+    def test_lease_lookup(self):
+        '''Leases are found by id without scanning the processing list'''
+        self.q.extend(range(3))
+        leases = [lease for lease, element in self.q.pop_many(3, withleases=True)]
+        self.assertEquals(r.hget('qrtestreliable:leased:a', leases[1]),
+            r.lindex('qrtestreliable:processing:a', 1))
+        self.assertTrue(self.q.nack(lease=leases[1]))
+        self.assertEquals(sorted(r.hkeys('qrtestreliable:leased:a')),
+            sorted([leases[0].encode(), leases[2].encode()]))
+        self.assertEquals(self.q.pop(), 1)
+
 class PriorityQueue(unittest.TestCase):
     def setUp(self):
         r.delete('qrpriorityqueue')
@@ -288,6 +1408,32 @@ class PriorityQueue(unittest.TestCase):
             self.assertEqual(value + score, count)
             value, score = self.q.pop(withscores=True)
         
+    def test_pop_many(self):
+        self.q.extend([('a', 3), ('b', 1), ('c', 2), ('d', 4)])
+        self.assertEquals(self.q.peek_many(2), ['b', 'c'])
+        self.assertEquals(self.q.pop_many(2, withscores=True),
+            [('b', 1.0), ('c', 2.0)])
+        self.assertEquals(self.q.peek_max(), 'd')
+        self.assertEquals(self.q.pop_max(), 'd')
+        self.assertEquals(self.q.pop_max_many(5), ['a'])
+        self.assertEquals(self.q.pop_many(5), [])
+        self.assertEquals(self.q.pop_max(withscores=True), (None, 0.0))
+
+    def test_pop_block(self):
+        self.assertEquals(self.q.pop(block=True, timeout=1), None)
+        self.q.push('foo', 1)
+        self.q.push('bar', 2)
+        self.assertEquals(self.q.pop(withscores=True, block=True, timeout=1),
+            ('foo', 1.0))
+        self.assertEquals(self.q.pop_many(5, block=True, timeout=1), ['bar'])
+
+    def test_iter_elements(self):
+        self.q.extend([('foo', 2), ('bar', 1), ('baz', 3)])
+        self.assertEquals(list(self.q), ['bar', 'foo', 'baz'])
+        self.assertEquals(list(self.q.iter_elements(page_size=2, withscores=True)),
+            [('bar', 1.0), ('foo', 2.0), ('baz', 3.0)])
+        self.assertEquals(json.loads(self.q.elements_as_json()), ['bar', 'foo', 'baz'])
+
     def test_uniqueness(self):
         count = 100
         # Push the same value on with different scores
@@ -302,7 +1448,7 @@ class PriorityQueue(unittest.TestCase):
         items = [i for i in range(count)]
         self.q.extend(zip(items, items))
         self.assertEquals(self.q.elements(), items)
-        with os.tmpfile() as f:
+        with tempfile.TemporaryFile() as f:
             self.q.dump(f)
             # Now, assert that it is empty
             self.assertEquals(len(self.q), 0)
@@ -315,5 +1461,76 @@ class PriorityQueue(unittest.TestCase):
             f.truncate()
             self.q.clear()
 
+    def test_dump_load_scores(self):
+        self.q.extend([('foo', 1.5), ('bar', -2), ('baz', float('inf'))])
+        for format in ('lines', 'length'):
+            with tempfile.TemporaryFile() as f:
+                self.assertEquals(self.q.dump(f, chunk=2, format=format), 3)
+                f.seek(0)
+                self.assertEquals(self.q.load(f, chunk=2, format=format), 3)
+            self.assertEquals(self.q.peek_many(3, withscores=True),
+                [('bar', -2.0), ('foo', 1.5), ('baz', float('inf'))])
+
+class DelayedQueue(unittest.TestCase):
+    def setUp(self):
+        r.delete('qrdelayed', 'qrdelayed:ready', 'qrdelayed:wake')
+        self.q = qr.DelayedQueue('qrdelayed')
+
+    def tearDown(self):
+        r.delete('qrdelayed', 'qrdelayed:ready', 'qrdelayed:wake')
+
+    def test_not_due(self):
+        self.q.push('later', delay=60)
+        self.assertEquals(self.q.pop(), None)
+        self.assertEquals(len(self.q), 1)
+        self.assertTrue(self.q.next_due() > time.time())
+
+    def test_due_in_order(self):
+        now = time.time()
+        self.q.push('b', when=now - 1)
+        self.q.push('a', when=now - 2)
+        self.q.push('c', delay=60)
+        self.assertEquals(self.q.pop_many(5), ['a', 'b'])
+        self.assertEquals(len(self.q), 1)
+        self.assertEquals(len(self.q.target), 0)
+
+    def test_move_due(self):
+        now = time.time()
+        self.q.extend((i, now - 9.5 + i) for i in range(25))
+        self.assertEquals(self.q.move_due(now, chunk=4), 10)
+        self.assertEquals(len(self.q.target), 10)
+        self.assertEquals(self.q.target.pop_many(10), list(range(10)))
+
+    def test_move_due_big_chunk(self):
+        self.q.extend((i, 0) for i in range(10000))
+        self.assertEquals(self.q.move_due(chunk=10000), 10000)
+        self.assertEquals(len(self.q.target), 10000)
+
+    def test_target(self):
+        target = qr.Queue('qrdelayed:ready')
+        q = qr.DelayedQueue('qrdelayed', target=target)
+        q.push('now')
+        self.assertEquals(q.pop(), 'now')
+        q.push('elsewhere')
+        q.move_due()
+        self.assertEquals(target.pop(), 'elsewhere')
+
+    def test_blocking_pop(self):
+        self.q.push('soon', delay=0.5)
+        start = time.time()
+        self.assertEquals(self.q.pop(block=True, timeout=5), 'soon')
+        self.assertTrue(time.time() - start < 5)
+        self.assertEquals(self.q.pop(block=True, timeout=1), None)
+
+    def test_blocking_pop_woken(self):
+        # Consumers already asleep wake up for new, sooner elements
+        self.q.push('later', delay=3600)
+        threading.Timer(0.2, self.q.push, ['now']).start()
+        threading.Timer(0.4, self.q.push, ['soon'], {'delay': 0.1}).start()
+        start = time.time()
+        self.assertEquals(self.q.pop(block=True), 'now')
+        self.assertEquals(self.q.pop(block=True, timeout=5), 'soon')
+        self.assertTrue(time.time() - start < 1)
+
 if __name__ == '__main__':
     unittest.main()